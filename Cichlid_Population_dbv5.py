@@ -11,8 +11,13 @@ import re
 import datetime
 from urllib.request import urlopen
 from dao.mysql.mysql_db_access_object import MySQLDataAccessObject
+from dao.mysql.mysql_connection_pool import MySQLConnectionPool
+from dao.mysql.id_allocator import BlockIdAllocator
+from dao.mysql.lineage_closure import LineageClosure
+from dao.mysql.bulk_loader import BulkLoader
 from dao.mysql import StudyDAO
 import Get_taxonomy_from_NCBI as TaxUtils
+from Species_name_index import SpeciesNameIndex
 
 
 __author__ = 'Hubert Denise, Mar. 2019'
@@ -42,6 +47,14 @@ if cur_version < req_version:
 usage: Cichlid_Population_db.py automates entry of data from json files and spreadsheets into the Cichlid db. Type Population_db.py -h for help.
     Usage: Population_db.py (-o) (-v) (-c) (-j <path to json file> or -sp <'samples', 'sequenced',  'mlw' or 'images')
 '''
+#number of the month names (the full names are listed first so that 'january' is not read as 'jan'+'uary')
+MONTH_NUMBERS={'january' : '01','february' : '02','march' : '03','april' : '04','may' : '05','june' : '06','july' : '07','august' : '08',
+    'september' : '09','october' : '10','november' : '11','december' : '12','jan' : '01','feb' : '02','mar' : '03','apr' : '04','jun' : '06',
+    'jul' : '07','aug' : '08','sep' : '09','oct' : '10','nov' : '11','dec' : '12'}
+MONTH_PATTERN=re.compile("|".join(MONTH_NUMBERS))
+#dates separated by '.': DD.MM.YY
+DOTTED_DATE_PATTERN=re.compile(r'^[0-3][0-9]\.[0-1][1-9]\.1[0-9]')
+
 def format_display(date_element):
     '''
     fonction for double-digit display when day/month is less than 10. Allow date field to be consistent and compatible with mysql date format (YYYY-MM-DD)
@@ -52,38 +65,38 @@ def format_display(date_element):
         date_element="0"+date_element
     return date_element
 
-def prepare_update(update_dic):
+def clean_species_name(name):
     '''
-    : input update_dic (dic) dictionary of fields to update
-    : return final_statement (str) <field> = <value>, <field> = <value> where <table>_id = <identifier>. No return if there is no field to update
+    : input name (str) species name from the spreadsheet or json
+    : return name (str) name without 'sp.', 'cf.' or 'c.f.' and extra spaces, as sent to the taxonomy server
     '''
-    #if update take place then update the change field and latest field
-    final_statement = ''
-    for field in update_dic:
-        final_statement += field+" = '" + str(update_dic[field]) +"', "
-    return final_statement[:-2]
+    return re.sub(r"\s\s+" , " ", name.replace("sp.","").replace("c.f.","").replace("cf.",""))
 
-def dic_to_str(dic, field_attribute, value_attribute):
-    '''
-    function to transform a dictionary into strings for fields and values to populate the database
-    : input dic (dic) dicionary to insert into db
-    : input field_attribute (str) string of fields to add to the dictionary ones
-    : input value_attribute (str) string of corresponding values to add to the dictionary ones
-    : return field_str (str) field list separated by comma
-    : return val_str (str) corresponding value list separated by comma and apostrophes if necessary
-    '''
-    new_list=[]
-    field_list = list(dic.keys())
-    val_list = list(dic.values())
-    #rewrite  the values in mysql compatible format
-    for element in val_list:
-        if type(element) == str or type(element) == datetime.date:
-             element ="'"+str(element)+"'"
-        new_list.append(element)
-    field_str = ", ".join(field_list) + field_attribute
-    val_str =  ", ".join(str(x) for x in new_list) + str(value_attribute)
-    val_str = val_str.replace('None', 'Null')
-    return field_str, val_str
+def match_species_name(name):
+    '''
+    : input name (str) species name cleaned by clean_species_name
+    : return name (str) spelling of the known species within speciesMatchDistance edits of the name (name itself if there is none)
+    '''
+    if species_index is None:
+        return name
+    match = species_index.match(name)
+    if match is None:
+        return name
+    return match
+
+def species_query(dic):
+    '''
+    : input dic (dic) dictionary of ['field' : value] for species table of the spreadsheet
+    : return query (str) name or taxon_id the species taxonomy is obtained with ("" if none)
+    '''
+    if 'name' in dic and dic['name'] != "":
+        name=clean_species_name(dic['name'])
+        if len(name) > 2:
+            return match_species_name(name)
+        return ""
+    elif 'taxon_id' in dic and dic['taxon_id'] != "":
+        return str(dic['taxon_id'])
+    return ""
 
 def updateSpecies_table(dic):
     '''
@@ -101,33 +114,47 @@ def updateSpecies_table(dic):
     elif 'taxon_id' in dic and dic['taxon_id'] != "":
         ENA_taxo = TaxUtils.getTaxid(dic['taxon_id'])
         if ENA_taxo:
-            dic['strain'] = ENA_taxo[2].replace("'","\"")
+            dic['strain'] = ENA_taxo[2]
             dic['taxon_position'] = ENA_taxo[0]
     '''
     # fonction using NCBI taxonomy server
     #   return dic (dic) updated dictionary with the taxonomy completed i.e. taxon_id or name if strain or taxon_id are provided, respectively, plus the taxon position and common name.
     if 'name' in dic and dic['name'] != "":
-        dic['name']=re.sub("\s\s+" , " ", dic['name'].replace("sp.","").replace("c.f.","").replace("cf.",""))
+        dic['name']=clean_species_name(dic['name'])
         if len(dic['name']) > 2:
+            #spelling variant of a known species: use the existing name (and row)
+            name=match_species_name(dic['name'])
+            if name != dic['name']:
+                #logged for the curators to check that two different species were not merged
+                logging.warning("Species name '"+dic['name']+"' replaced by the known species '"+name+"'")
+                dic['name']=name
+                name_part=name.split(" ")
+                if 'genus' in dic:
+                    dic['genus']=name_part[0]
+                if 'species' in dic and len(name_part) > 1 and not name_part[1].startswith('"'):
+                    dic['species']=name_part[1]
             result_list = TaxUtils.getTaxid(dic['name'])
             if len(result_list) > 0:
                 if result_list[1] != "":
-                    dic['common_name']=result_list[1].replace("'","\"")
+                    dic['common_name']=result_list[1]
                 if result_list[2] !=  "":
                     dic['taxon_position']=result_list[2]
                 if result_list[3] != 0 and 'taxon_id' not in dic:
                     dic['taxon_id']=result_list[3]
+                #later variants of a name new to the database are matched to it
+                if result_list[3] != 0 and species_index is not None:
+                    species_index.add(dic['name'])
         else:
             del dic['name']
     elif 'taxon_id' in dic and dic['taxon_id'] != "":
         result_list = TaxUtils.getTaxid(dic['taxon_id'])
         if len(result_list) > 0:
             if result_list[1] != "":
-                dic['common_name']=result_list[1].replace("'","\"")
+                dic['common_name']=result_list[1]
             if result_list[2] !=  "":
                 dic['taxon_position']=result_list[2]
             if result_list[0] != "":
-                dic['name']=result_list[0].replace("'","\"")
+                dic['name']=result_list[0]
     return dic
 
 def update(update_dic, today, studyDAO, flag, verbose, table, identifier, identifiant, db_dic):
@@ -153,8 +180,7 @@ def update(update_dic, today, studyDAO, flag, verbose, table, identifier, identi
             logging.info(" one update for table "+ table+" could take place but no update flag. Replacing instead")
             logging.info(update_dic)
             logging.info(db_dic)
-        update_statement = prepare_update(update_dic)
-        studyDAO.update(table, update_statement, identifier, identifiant)
+        studyDAO.update_row(table, update_dic, {identifier: identifiant})
     else:
         #create a new record and update the current one [changed from latest =1 to 0]
         if verbose:
@@ -170,20 +196,18 @@ def update(update_dic, today, studyDAO, flag, verbose, table, identifier, identi
             #update the previous record
             to_update['changed'] = today
             to_update['latest'] = 0
-            previous_record_statement = prepare_update(to_update)
             if verbose:
                 logging.info("Updating previous record now: latest = 0 and changed to today's date")
-            studyDAO.update(table, previous_record_statement, identifier, identifiant)
+            studyDAO.update_row(table, to_update, {identifier: identifiant})
             if verbose:
                 logging.info("Creating new latest record now")
             del record_update_dic['latest']
-            field_str, value_str = dic_to_str(record_update_dic, ', latest', "," + str(True))
-            studyDAO.populate_table(table, "("+field_str+")", "(" + value_str+ ")")
+            record_update_dic['latest'] = True
+            studyDAO.insert_row(table, record_update_dic)
         else:
             if verbose:
                 logging.info("Overwriting record now")
-            update_statement = prepare_update(update_dic)
-            studyDAO.update(table, update_statement, identifier, identifiant)
+            studyDAO.update_row(table, update_dic, {identifier: identifiant})
 
 def check_for_update(raw_dic, table, studyDAO, verbose):
     '''
@@ -251,7 +275,7 @@ def populate_table(dic, today, studyDAO, flag, verbose, table, table_identifier,
         dic[foreign2_identifier]=foreign2_id
     dbflag = ""
     final_maxid = []
-    max_id = 0
+    new_id = None
     #check if identifier is already in db
     if len(dic) > 0:
         db_results=studyDAO.getStudyData(table, table_identifier, dic[table_identifier])
@@ -259,34 +283,23 @@ def populate_table(dic, today, studyDAO, flag, verbose, table, table_identifier,
         if len(db_results) == 0:
             if verbose:
                 logging.info("The data are not already present in the table "+table+". Inserting now")
-            field_str = ""
-            val_str = ""
-            #get the latest <table>_id if there is data in db
-            if table not in ('annotations', 'individual_data', 'assembly'):
-                maxid = studyDAO.getmaxIndex(table)
-            #insert into table without chnged and latest fields
+            id_dic = {}
+            #get a new <table>_id for the tables which do not set it themselves
             if table not in ('project', 'annotations', 'individual_data', 'assembly'):
-                if maxid[0]['max('+table+'_id)'] != None:
-                    max_id = int(maxid[0]['max('+table+'_id)'])
-                else:
-                    max_id = 0
-                field_str =  "," + table + "_id"
-                val_str = "," + str(max_id +1)
+                id_dic[table + "_id"] = studyDAO.next_id(table)
             #only keep valid value(s) to insert
             filtered_dic = {k:v for (k,v) in dic.items() if len(str(v)) > 0}
             if len(filtered_dic) > 0:
                 if verbose:
                     logging.info("Preparing insert statement")
-                field, val = dic_to_str(filtered_dic, field_str, val_str)
-                final_field_str = "(" + field + ")"
-                final_val_str = "("+ val +")"
+                row_dic = {**filtered_dic, **id_dic}
                 #insert into table without chnged and latest fields
                 if table not in ('library_type', 'project', 'cv', 'location', 'seq_tech', 'organism_part', 'developmental_stage'):
-                    final_field_str = "(" + field + ", changed, latest )"
-                    final_val_str = "("+ val +", '"+today+"', True )"
+                    row_dic['changed'] = today
+                    row_dic['latest'] = True
                 if verbose:
                     logging.info("Populating table "+table+" now")
-                studyDAO.populate_table(table, final_field_str, final_val_str)
+                new_id = studyDAO.insert_row(table, row_dic)
                 dbflag = "I"
         else:
             #if record exists, get the identifier
@@ -294,57 +307,106 @@ def populate_table(dic, today, studyDAO, flag, verbose, table, table_identifier,
                 logging.info("The record for table "+table+" already exists. Get identifier now")
             if table == 'location':
                 final_maxid =[{'location_id': db_results[0][table+"_id"]}]
-        if table not in ['location', 'individual_data']:
+        if new_id is not None:
+            #the <table>_id of the inserted row is already known
+            final_maxid = [{table+'_id': new_id}]
+        elif table not in ['location', 'individual_data']:
             #get the corresponding <table>_id
-            final_maxid = studyDAO.getIndex(table, table_identifier, dic[table_identifier])
+            final_maxid = studyDAO.getTableData(table, table+"_id", table_identifier+" = %s", data=(dic[table_identifier],))
         #if no previous index, then return 1. To deal with first insertion
         if len(final_maxid) == 0:
-            MaxID = max_id +1
+            MaxID = 1
         else: MaxID = final_maxid[0][table+'_id']
         #return value and action flag
         return MaxID, dbflag
 
+def date_key(date_field):
+    '''
+    : input date_field (str) date as provided in the spreadsheet
+    : return datefield (str) first part of the date (the second part, if present, is the time) with the month names replaced by their number
+    '''
+    return MONTH_PATTERN.sub(lambda x: MONTH_NUMBERS[x.group(0)], date_field.lower().split()[0])
+
+def infer_date_order(datefields):
+    '''
+    infer from all the dates of a source whether its dates separated by "/" start with the day or with the month
+    : input datefields (list) dates of the source (see date_key)
+    : return date_order (dic) 'YYYY' and 'YY' (length of the year): 'DM' if the day comes first, 'MD' otherwise
+    A ValueError is raised if values above 12 are found in both positions (dates written both ways in the source)
+    '''
+    #in the spreadsheets, DD/MM/YYYY (sa spreadsheet) and MM/DD/YY (sp spreadsheet) unless a value above 12 shows otherwise
+    date_order={'YYYY': 'DM', 'YY': 'MD'}
+    for year_format in date_order:
+        first=[]
+        second=[]
+        for datefield in datefields:
+            date_part=re.split(r"[^0-9]", datefield)
+            if "." in datefield or "/" not in datefield or len(date_part) < 3 or not (date_part[0].isdigit() and date_part[1].isdigit()):
+                continue
+            if (len(date_part[2])==4) == (year_format=='YYYY'):
+                first.append(int(date_part[0]))
+                second.append(int(date_part[1]))
+        if len(first) == 0:
+            continue
+        if max(first) > 12 and max(second) > 12:
+            raise ValueError("dates with a "+year_format+" year are written both day first and month first in the same source: fix them before the import")
+        if max(first) > 12:
+            date_order[year_format]='DM'
+        elif max(second) > 12:
+            date_order[year_format]='MD'
+        #every date separated by "/" of the source is read with this order
+        logging.warning(str(len(first))+" distinct dates with a "+year_format+" year read as "+("day/month" if date_order[year_format]=='DM' else "month/day")+
+                        ("" if max(first) > 12 or max(second) > 12 else " (default, no day above 12 to infer it from)"))
+    return date_order
+
+def date_parser(date_order):
+    '''
+    : input date_order (dic) order of the day and month of the dates separated by "/" (see infer_date_order)
+    : return parse_date (function) converting a date (see date_key) to a date, each distinct date being converted once
+    '''
+    parsed={}
+    def parse_date(datefield):
+        if datefield not in parsed:
+            date_part=re.split(r"[^0-9]", datefield)
+            #note that the last part it always the year
+            if "." in datefield:
+                if DOTTED_DATE_PATTERN.match(datefield):
+                    datefield_iso="20"+date_part[2]+"-"+format_display(date_part[1])+"-"+format_display(date_part[0])
+                else:
+                    datefield_iso=datefield
+            elif "/" in datefield:
+                if len(date_part[2])==4:
+                    year=date_part[2]
+                    order=date_order['YYYY']
+                else:
+                    year="20"+date_part[2]
+                    order=date_order['YY']
+                if order=='DM':
+                    datefield_iso=year+"-"+format_display(date_part[1])+"-"+format_display(date_part[0])
+                else:
+                    datefield_iso=year+"-"+format_display(date_part[0])+"-"+format_display(date_part[1])
+            else:
+                datefield_iso=datefield
+            parsed[datefield]=datetime.datetime.strptime(datefield_iso, "%Y-%m-%d").date()
+        return parsed[datefield]
+    return parse_date
+
 def format_date(nested_dic):
     '''
     function to re-format the date fields from the data fromm the spreadsheet in mysql compatible format (YYYY-MM-DD)
+    The order of the day and month is inferred once from all the dates of the spreadsheet and each distinct date is only parsed once
     : input nested_dic (dic) dictionary with sample_id as key and lidt of nested dictionary [{'table' :['field' : value from datasheet]}] as value
     : return nested_dic (dic) updated nested_dic with date formatted as YYYY-MM-DD (only numeric and separated by '-')
     '''
-    date_dic={'jan' : '01','feb' : '02','mar' : '03','apr' : '04','may' : '05','jun' : '06','jul' : '07','aug' : '08','sep' : '09','oct' : '10',
-    'nov' : '11','dec' : '12','january' : '01','february' : '02','march' : '03','april' : '04','may' : '05','june' : '06','july' : '07','august' : '08',
-    'september' : '09','october' : '10','november' : '11','december' : '12'}
-    pattern_date=re.compile(r'^[0-3][0-9]\.[0-1][1-9]\.1[0-9]')
-    pattern_date2 =re.compile(r'^2[0-1][0-9]{2}-[0-1][1-9]-[0-3][0-9]')
-    #extract dictionary for all the field corresponding to a date for each sample (date_field : date provided)
-    for individual in nested_dic:
-        print (" --------- "+individual)
-        for nested_indiv_dic in nested_dic[individual]:
-            print(nested_indiv_dic)
-            if 'individual' in nested_indiv_dic and 'date_collected' in nested_indiv_dic['individual']:
-                date_field = nested_indiv_dic['individual']['date_collected']
-                #generally the first part of a date field is the date itself while the second part, if present, is the time so we'll keep the first part
-                if len(date_field) > 0:
-                    datefield = date_field.lower().split()[0]
-                    #ensure there is only numeric month value by replacing month name if present by month number
-                    for month in date_dic:
-                        datefield = datefield.replace(month, date_dic[month])
-                    #note that the last part it always the year so need to compare the 2 first section to deduce which is day/month
-                    #in the spreadsheet: when sep by "/" : MM-DD-YY (sp spreadsheet) or (sa spreadsheet) while if sep by ".": DD-MM-YY
-                    date_part=re.split(r"[^0-9]", datefield)
-                    print(datefield)
-                    if "." in datefield:
-                        if pattern_date.match(datefield):
-                            date_part="20"+date_part[2]+"-"+format_display(date_part[1])+"-"+format_display(date_part[0])
-                    elif "/" in datefield:
-                        if len(date_part[2])==4:
-                            date_part=date_part[2] +"-" + format_display(date_part[1])+"-"+format_display(date_part[0])
-                        else:
-                            date_part="20"+date_part[2] +"-" + format_display(date_part[0])+"-"+format_display(date_part[1])
-                    elif pattern_date2.match(datefield):
-                            date_part = datefield
-                    #update the input nested_dic with reformatted date
-                    print (date_part)
-                    nested_indiv_dic['individual']['date_collected']=datetime.datetime.strptime(date_part, "%Y-%m-%d").date()
+    #individual entries with a date
+    entries=[x['individual'] for individual in nested_dic for x in nested_dic[individual] if 'individual' in x and
+             'date_collected' in x['individual'] and len(x['individual']['date_collected']) > 0]
+    datefields={x: date_key(x) for x in set([entry['date_collected'] for entry in entries])}
+    date_order=infer_date_order(list(datefields.values()))
+    parse_date=date_parser(date_order)
+    for entry in entries:
+        entry['date_collected']=parse_date(datefields[entry['date_collected']])
+    if verbose: logging.info("  - "+str(len(entries))+" dates formatted ("+str(len(datefields))+" distinct dates)")
     return nested_dic
 
 def extract_individual_name(original_name, studyDAO):
@@ -439,13 +501,12 @@ def parse_spreadsheet(spread_path, studyDAO):
             logging.info("Could not find the spreadsheet at the url indicated. Existing now")
             raise
     spread_dic={}
+    species_list=[]
     lines = res.split("\n")
     #avoid the first line (spreadsheet header)
     for line in lines[start_read:]:
         line=line.rstrip()
         line_dic={}
-        #to avoid issue with apostrophe in field. Need to be updated with a better solution?
-        line=line.replace("'","\"")
         if 'tsv' in spread_path:
             dataline=line.split("\t")[:2]
         else:
@@ -471,7 +532,7 @@ def parse_spreadsheet(spread_path, studyDAO):
             if 'name' in line_dic['species'] and len(line_dic['species']['name']) < 3:
                 del line_dic['species']
             else:
-                line_dic['species'] = updateSpecies_table(line_dic['species'])
+                species_list.append(line_dic['species'])
         if 'location' in line_dic:
             if 'source_location' in line_dic['location'] and ";" in line_dic['location']['source_location']:
                 location_list = line_dic['location']['source_location'].split(";")
@@ -543,7 +604,10 @@ def parse_spreadsheet(spread_path, studyDAO):
             spread_dic[individual_name].append(line_dic)
         else:
             spread_dic[individual_name] =[line_dic]
-    print(spread_dic)
+    #resolve the taxonomy of all the species at once (concurrent queries to NCBI)
+    TaxUtils.prefetch([species_query(x) for x in species_list])
+    for species in species_list:
+        updateSpecies_table(species)
     ready_spread_dic = format_date(spread_dic)
     return ready_spread_dic, spreadsheet
 
@@ -554,6 +618,7 @@ def parse_json(json_path, studyDAO):
     : return json_dic (dic) nested dictionary  with individual_names as keys and values in the format {'table' :['field' : value from datasheet]}
     '''
     json_dic = {}
+    species_list = []
     #define the equivalence between the json attributes and the database table fields
     file_eq= {'ebi_run_acc': 'accession', 'is_paired_read': 'type', 'total_reads': 'nber_reads' , 'md5' : 'md5' }
     project_eq = {'study': 'name', 'study_accession_number': 'accession', 'study_id' : 'ssid', 'study_title' : 'alias'}
@@ -593,8 +658,7 @@ def parse_json(json_path, studyDAO):
                 if dic['attribute'] == 'is_paired_read':
                     data_dic[dic['attribute']] = 'PE'
                 else:
-                    #ensure that there is no apostrophe in the values
-                    data_dic[dic['attribute']] = dic['value'].strip().replace("'","\"")
+                    data_dic[dic['attribute']] = dic['value'].strip()
         new_dic ={}
         #translate the json headers in database headers
         for table in dic_eq:
@@ -615,25 +679,27 @@ def parse_json(json_path, studyDAO):
         if organism_part_name !="":
             new_dic['organism_part']['name'] = organism_part_name
             #get the ontology_id if it exists
-            ontology_list = studyDAO.getTableData('ontology', 'ontology_id', "name like '"+organism_part_name+"%'")
+            ontology_list = studyDAO.getTableData('ontology', 'ontology_id', "name like %s", data=(organism_part_name+"%",))
             if len(ontology_list) > 0:
                 new_dic['organism_part']['ontology_id'] = ontology_list[0]['ontology_id']
-        new_dic['species'] = updateSpecies_table(new_dic['species'])
+        species_list.append(new_dic['species'])
         json_dic[individual_name].append(new_dic)
+    #resolve the taxonomy of all the species at once (concurrent queries to NCBI)
+    TaxUtils.prefetch([species_query(x) for x in species_list])
+    for species in species_list:
+        updateSpecies_table(species)
     return json_dic, json_name
 
-def populate_database(raw_results, entry_name, studyDAO, verbose, mydbconn):
+def get_table_structure(entry_name):
     '''
-    generic function to call for update/population of the database with data from json or spreadsheet
-    : input raw_results (dic)
+    function to define the tables filled from a json file or a spreadsheet
     : input entry_name (str) name of the json file or the Google spreadsheet tab
-    : input studyDAO (connection object) object to connect to the database
-    : input verbose (boolean) when set to True, display messages to user about run progress
-    : input mydbconn (database connection_socket) connection to the Cichlid database
-    : return none
+    : return identifier_dic (dic) field serving as identifier for each table
+    : return independent_table (list) tables without dependent tables
+    : return dependent_table (list) tables with dependent tables, in the order they have to be populated
+    : return dependent_dic (dic) dependent tables of each table
+    : return raw_results_type (str) 'json' or 'spreadsheet'
     '''
-    all_flag = []
-    idflag =""
     if 'json' in entry_name:
         identifier_dic = {'individual' : 'name', 'species' : 'name', 'material' : 'name', 'organism_part' : 'name', 'seq_tech' : 'name',
          'library' : 'ssid' , 'library_type' : 'name', 'lane' : 'accession', 'sample': 'ssid', 'project' : 'ssid', 'file' : 'name', 'ontology' : 'name'}
@@ -649,6 +715,21 @@ def populate_database(raw_results, entry_name, studyDAO, verbose, mydbconn):
         dependent_dic={'developmental_stage':['ontology'], 'individual' : ['species', 'developmental_stage', 'location'], 'material' : ['individual'], 'sample':['material'], 'library' : ['library_type'],
         'lane' : ['seq_tech', 'sample', 'library'], 'file':['lane'], 'image':['individual']}
         raw_results_type = 'spreadsheet'
+    return identifier_dic, independent_table, dependent_table, dependent_dic, raw_results_type
+
+def populate_database(raw_results, entry_name, studyDAO, verbose, mydbconn):
+    '''
+    generic function to call for update/population of the database with data from json or spreadsheet
+    : input raw_results (dic)
+    : input entry_name (str) name of the json file or the Google spreadsheet tab
+    : input studyDAO (connection object) object to connect to the database
+    : input verbose (boolean) when set to True, display messages to user about run progress
+    : input mydbconn (database connection_socket) connection to the Cichlid database
+    : return none
+    '''
+    all_flag = []
+    idflag =""
+    identifier_dic, independent_table, dependent_table, dependent_dic, raw_results_type = get_table_structure(entry_name)
     try:
         for individual_name in raw_results:
             print (individual_name)
@@ -681,7 +762,7 @@ def populate_database(raw_results, entry_name, studyDAO, verbose, mydbconn):
                                 else:
                                     if identifier_dic[sub_table] in raw_entry[table]:
                                         #get the value from db
-                                        dependent_data = studyDAO.getTableData(sub_table, sub_table+"_id", identifier_dic[sub_table] + " = '" +raw_entry[table][identifier_dic[sub_table]]+"'")
+                                        dependent_data = studyDAO.getTableData(sub_table, sub_table+"_id", identifier_dic[sub_table] + " = %s", data=(raw_entry[table][identifier_dic[sub_table]],))
                                         if len(dependent_data) > 0:
                                             asso_dic[sub_table+"_id"] = dependent_data[0][sub_table+"_id"]
                     #now that the dependent table table_id are populated, use them to populate the table
@@ -702,14 +783,14 @@ def populate_database(raw_results, entry_name, studyDAO, verbose, mydbconn):
                            id_dic[table] = table_id
                 #populate allocation table if project and individual tables have id
                 if 'individual' in id_dic and 'project' in id_dic:
-                    allocation_data = studyDAO.getTableData('allocation', 'project_id', 'project_id = '+str(id_dic['project'])+" and individual_id = " +str(id_dic['individual']))
+                    allocation_data = studyDAO.getTableData('allocation', 'project_id', "project_id = %s and individual_id = %s", data=(id_dic['project'], id_dic['individual']))
                     if len(allocation_data) == 0:
-                        studyDAO.populate_table('allocation', '(project_id, individual_id)', '('+ str(id_dic['project']) +','+ str(id_dic['individual']) +')')
+                        studyDAO.insert_row('allocation', {'project_id': id_dic['project'], 'individual_id': id_dic['individual']})
                         all_flag.append("I")
                 #populate cv and individual_data table (particular cases so consider separate ?)
                 if 'individual_data' in raw_entry and len(raw_entry['individual_data']) > 0:
                     if 'value4' in raw_entry['individual_data']:
-                        cv_data = studyDAO.getTableData("cv", "cv_id", "attribute = 'Weight obtained from "+entry_name+" Cichlid spreadsheet'")
+                        cv_data = studyDAO.getTableData("cv", "cv_id", "attribute = %s", data=('Weight obtained from '+entry_name+' Cichlid spreadsheet',))
                         if len(cv_data) == 0:
                             cv_id, idflag = populate_table({'attribute' : 'Weight obtained from '+entry_name+' Cichlid spreadsheet', 'comment' : 'extracted the '+str(today)}, today, studyDAO, flag, verbose, 'cv', 'attribute')
                         else:
@@ -717,7 +798,7 @@ def populate_database(raw_results, entry_name, studyDAO, verbose, mydbconn):
                         individual_data_id, id4flag = populate_table({'value' : raw_entry['individual_data']['value4'], 'unit':'g'}, today, studyDAO, flag, verbose, 'individual_data', 'value', 'cv_id', cv_id, 'individual_id', id_dic['individual'])
                         all_flag.append(id4flag)
                     if 'value2' in raw_entry['individual_data']:
-                        cv_data = studyDAO.getTableData("cv", "cv_id", "attribute = 'Wrongly set as \"sex\" from \""+entry_name+"\" Cichlid spreadsheet'")
+                        cv_data = studyDAO.getTableData("cv", "cv_id", "attribute = %s", data=('Wrongly set as "sex" from "'+entry_name+'" Cichlid spreadsheet',))
                         if len(cv_data) == 0:
                             cv_id, id2flag = populate_table({'attribute' : 'Wrongly set as \"sex\" from "'+entry_name+'" VGP spreadsheet', 'comment' : 'extracted the '+str(today)}, today, studyDAO, flag, verbose, 'cv', 'attribute')
                         else:
@@ -740,8 +821,11 @@ def populate_database(raw_results, entry_name, studyDAO, verbose, mydbconn):
                         cv_id = cv_data[0]['cv_id']
                     individual_data_id, idflag = populate_table({'value' : raw_entry['assembly']['length'], 'unit' : 'Gb'}, today, studyDAO, flag, verbose, 'individual_data', 'value', 'cv_id', cv_id, 'individual_id', id_dic['individual'])
                 all_flag.append(idflag)
+        #send the rows still waiting in the insert batch before committing
+        studyDAO.flush_inserts()
     except:
         logging.error("Rolling back database changes...")
+        studyDAO.clear_cache()
         mydbconn.rollback()
         logging.error("The program failed to import data from the "+raw_results_type+" "+entry_name+" with the below exception:")
         raise
@@ -750,17 +834,127 @@ def populate_database(raw_results, entry_name, studyDAO, verbose, mydbconn):
             logging.info("Committing data from the "+raw_results_type+" "+entry_name+" to the database")
             mydbconn.commit()
 
+def bulk_populate_database(raw_results, entry_name, studyDAO, verbose, mydbconn):
+    '''
+    bootstrap alternative to populate_database for the initial population of the database: the records are gathered per table,
+    written to tab separated files in load_dir and loaded with LOAD DATA LOCAL INFILE, the foreign keys being resolved afterwards by joins
+    on the identifiers. Records already present in the database are left untouched (no update) and when the same identifier
+    is found several times, the records are merged (the last non empty value is kept)
+    : input raw_results (dic)
+    : input entry_name (str) name of the json file or the Google spreadsheet tab
+    : input studyDAO (connection object) object to connect to the database
+    : input verbose (boolean) when set to True, display messages to user about run progress
+    : input mydbconn (database connection_socket) connection to the Cichlid database
+    : return none
+    '''
+    identifier_dic, independent_table, dependent_table, dependent_dic, raw_results_type = get_table_structure(entry_name)
+    table_records = {table: collections.OrderedDict() for table in independent_table + dependent_table}
+    allocation_records = collections.OrderedDict()
+    individual_data_records = collections.OrderedDict()
+    #cv attribute and comment for the fields of individual_data and assembly, and unit of the values
+    cv_dic = {'value4': ('Weight obtained from '+entry_name+' Cichlid spreadsheet', 'extracted the '+str(today), 'g'),
+              'value2': ('Wrongly set as "sex" from "'+entry_name+'" VGP spreadsheet', 'extracted the '+str(today), None),
+              'value': ('morphology', None, None),
+              'length': ('estimated_genome_size', 'extracted the '+str(today) +' from "'+entry_name+'" VGP spreadsheet', 'Gb')}
+    cv_ids = {}
+    #gather the records of each table using the identifier of the parent records for the foreign keys
+    for individual_name in raw_results:
+        for raw_entry in raw_results[individual_name]:
+            for table in independent_table + dependent_table:
+                if table in raw_entry and identifier_dic[table] in raw_entry[table]:
+                    row = {k:v for k,v in raw_entry[table].items() if len(str(v)) > 0 and k != 'row_id'}
+                    for sub_table in dependent_dic.get(table, []):
+                        if sub_table+"_id" in row:
+                            continue
+                        if sub_table in raw_entry and identifier_dic[sub_table] in raw_entry[sub_table]:
+                            row[sub_table+"_key"] = raw_entry[sub_table][identifier_dic[sub_table]]
+                        elif identifier_dic[sub_table] in raw_entry[table]:
+                            row[sub_table+"_key"] = raw_entry[table][identifier_dic[sub_table]]
+                    table_records[table].setdefault(row[identifier_dic[table]], {}).update(row)
+            if 'individual' not in raw_entry or 'name' not in raw_entry['individual']:
+                continue
+            individual_key = raw_entry['individual']['name']
+            if 'project' in raw_entry and identifier_dic['project'] in raw_entry['project']:
+                project_key = raw_entry['project'][identifier_dic['project']]
+                allocation_records[(project_key, individual_key)] = {'project_key': project_key, 'individual_key': individual_key}
+            extra_data = dict(raw_entry.get('individual_data', {}))
+            if 'assembly' in raw_entry and 'length' in raw_entry['assembly']:
+                extra_data['length'] = raw_entry['assembly']['length']
+            for field in cv_dic:
+                if field in extra_data:
+                    if field not in cv_ids:
+                        attribute, comment, unit = cv_dic[field]
+                        cv_data = studyDAO.getTableData("cv", "cv_id", "attribute = %s", data=(attribute,))
+                        if len(cv_data) == 0:
+                            cv_record = {'attribute': attribute}
+                            if comment is not None:
+                                cv_record['comment'] = comment
+                            cv_ids[field], cvflag = populate_table(cv_record, today, studyDAO, flag, verbose, 'cv', 'attribute')
+                        else:
+                            cv_ids[field] = cv_data[0]['cv_id']
+                    data_row = {'value': extra_data[field], 'cv_id': cv_ids[field], 'individual_key': individual_key}
+                    if cv_dic[field][2] is not None:
+                        data_row['unit'] = cv_dic[field][2]
+                    individual_data_records[(individual_key, cv_ids[field], str(extra_data[field]))] = data_row
+    loader = BulkLoader(studyDAO.dataAccessObject, load_dir, studyDAO.id_allocator)
+    inserted = 0
+    try:
+        #the cv rows created above are still waiting in the insert batch
+        studyDAO.flush_inserts()
+        for table in independent_table + dependent_table:
+            if verbose:
+                logging.info("Loading "+str(len(table_records[table]))+" records into table "+table)
+            foreign_keys = [(x+"_id", x, identifier_dic[x], x+"_key") for x in dependent_dic.get(table, [])]
+            #the key field is only present if a record gives the identifier of the parent record
+            foreign_keys = [x for x in foreign_keys if any(x[3] in y for y in table_records[table].values())]
+            id_column = None
+            if table != 'project':
+                id_column = table+"_id"
+            constants = {}
+            if table not in ('library_type', 'project', 'cv', 'location', 'seq_tech', 'organism_part', 'developmental_stage'):
+                constants = {'changed': today, 'latest': 1}
+            inserted += loader.load_table(table, list(table_records[table].values()), id_column, [identifier_dic[table]], foreign_keys, constants)
+        inserted += loader.load_table('allocation', list(allocation_records.values()), None, ['project_id', 'individual_id'],
+                                      [('project_id', 'project', identifier_dic['project'], 'project_key'), ('individual_id', 'individual', 'name', 'individual_key')])
+        inserted += loader.load_table('individual_data', list(individual_data_records.values()), None, ['individual_id', 'cv_id', 'value'],
+                                      [('individual_id', 'individual', 'name', 'individual_key')], {'changed': today, 'latest': 1})
+    except:
+        logging.error("Rolling back database changes...")
+        mydbconn.rollback()
+        logging.error("The program failed to load data from the "+raw_results_type+" "+entry_name+" with the below exception:")
+        raise
+    finally:
+        #the tables have been modified outside of studyDAO
+        studyDAO.clear_cache()
+    if inserted > 0 or len(cv_ids) > 0:
+        logging.info("Committing data from the "+raw_results_type+" "+entry_name+" to the database")
+        mydbconn.commit()
+
 def main(programSetup):
     configSettings = programSetup.config
     config_file_path = programSetup.config_file_path
     #Not in use but could be used to set up working directory: root_result_dir_path = programSetup.root_result_dir_path
     # Create data access object
-    mydbconn = pymysql.connect(user=configSettings["vpUser"], password=configSettings["vpPassword"],
-                               host=configSettings["vpHost"], port=int(configSettings["vpPort"]),
-                               db=configSettings["vpInstance"], autocommit=False,
-                               cursorclass=pymysql.cursors.DictCursor)
+    pool = MySQLConnectionPool.from_config(configSettings, local_infile=bool(load_dir))
+    #the connections are borrowed per unit of work (start-up reads, record or source, lineage) rather than for the whole run
+    mydbconn = pool.borrow()
     dataAccessObjectForVP = MySQLDataAccessObject(mydbconn)
-    studyDAO = StudyDAO.StudyDAO(dataAccessObjectForVP)
+    id_allocator = BlockIdAllocator.from_config(pool, configSettings)
+    studyDAO = StudyDAO.StudyDAO(dataAccessObjectForVP, batch_size, cache_size, id_allocator)
+    #taxonomy results from previous runs, completed with the species already in the database
+    TaxUtils.open_cache(taxonomy_cache, int(configSettings.get("taxonomyCacheDays", 90))*24*3600, int(configSettings.get("taxonomyCacheSize", 100000)),
+                        int(configSettings.get("taxonomyNegativeCacheDays", 7))*24*3600)
+    TaxUtils.cache.warm(studyDAO.getTableData("species", "name, taxon_id, common_name, taxon_position", "taxon_id is not null"))
+    #spelling variants of the species names are matched to the species already in the database
+    global species_index
+    species_index = SpeciesNameIndex([x['name'] for x in studyDAO.getTableData("species", "name", "name is not null")], int(configSettings.get("speciesMatchDistance", 0)))
+    #NCBI outage: after taxonomyMaxFailures failed requests only the cached results are used for taxonomyRetryAfter seconds
+    TaxUtils.open_breaker(float(configSettings.get("taxonomyTimeout", 30)), int(configSettings.get("taxonomyMaxFailures", 5)), float(configSettings.get("taxonomyRetryAfter", 300)))
+    TaxUtils.open_resolver(int(configSettings.get("taxonomyWorkers", 8)), float(configSettings.get("taxonomyRate", 3)))
+    #offline taxonomy (see Taxdump_taxonomy.py) if an index is provided
+    if configSettings.get("taxdumpIndex"):
+        TaxUtils.open_taxdump(configSettings["taxdumpIndex"])
+    pool.release(mydbconn)
     #call for json file parsing and inserting/updating
     jresults = {}
     raw_sp_results ={}
@@ -769,15 +963,41 @@ def main(programSetup):
         #open and parse json file
         if verbose:
             logging.info("Opening the json file")
-        raw_j_results, json_name = parse_json(jpath, studyDAO)
-        populate_database(raw_j_results, json_name, studyDAO, verbose, mydbconn)
+        with pool.connection() as mydbconn:
+            dataAccessObjectForVP.useConnection(mydbconn)
+            raw_j_results, json_name = parse_json(jpath, studyDAO)
+            if load_dir:
+                bulk_populate_database(raw_j_results, json_name, studyDAO, verbose, mydbconn)
+            else:
+                populate_database(raw_j_results, json_name, studyDAO, verbose, mydbconn)
     #call for spreadsheet parsing and inserting/updating
     if len(spath) >0:
         #open spreadsheet url
         if verbose:
             logging.info("Opening the spreadsheet url")
-        raw_sp_results, spreadsheet_name = parse_spreadsheet(spath, studyDAO)
-        populate_database(raw_sp_results, spreadsheet_name, studyDAO, verbose, mydbconn)
+        with pool.connection() as mydbconn:
+            dataAccessObjectForVP.useConnection(mydbconn)
+            raw_sp_results, spreadsheet_name = parse_spreadsheet(spath, studyDAO)
+            if load_dir:
+                bulk_populate_database(raw_sp_results, spreadsheet_name, studyDAO, verbose, mydbconn)
+            else:
+                populate_database(raw_sp_results, spreadsheet_name, studyDAO, verbose, mydbconn)
+    inserted_rows, rows_per_second = studyDAO.insert_rate()
+    logging.info(str(inserted_rows)+" rows inserted ("+str(rows_per_second)+" rows/s)")
+    #lineage of the species new to the taxon_lineage closure table
+    with pool.connection() as mydbconn:
+        dataAccessObjectForVP.useConnection(mydbconn)
+        if LineageClosure(dataAccessObjectForVP).refresh(TaxUtils.getLineages) > 0:
+            mydbconn.commit()
+            studyDAO.invalidate("taxon_lineage")
+    cache_hits, cache_misses = studyDAO.cache_stats()
+    logging.info(str(cache_hits)+" queries answered from the cache, "+str(cache_misses)+" sent to the database")
+    logging.info(str(TaxUtils.cache.hits)+" taxonomy queries answered from "+taxonomy_cache+", "+str(TaxUtils.cache.misses)+" sent to NCBI")
+    if TaxUtils.breaker.skipped > 0:
+        logging.warning(str(TaxUtils.breaker.skipped)+" taxonomy queries not sent while NCBI was failing")
+    TaxUtils.close_cache()
+    TaxUtils.close_resolver()
+    pool.close()
     if verbose:
         logging.info("End of run")
 
@@ -790,6 +1010,14 @@ if __name__ == '__main__':
     parser.add_argument("-j", "--jpath", help="path to json")
     parser.add_argument("-sp", "--spreadsheet", help="choice of 'samples', 'sequenced', 'mlw'")
     parser.add_argument("-v", "--verbose", help="verbose mode", action = 'store_true')
+    parser.add_argument("-b", "--batch_size", type=int, default=500,
+                        help="number of rows grouped in one insert statement (0 to insert row by row). A failed grouped insert is reported, and rolled back, for the whole source")
+    parser.add_argument("-q", "--cache_size", type=int, default=1000,
+                        help="number of query results kept in memory (0 to disable the cache)")
+    parser.add_argument("-t", "--taxonomy_cache", default="taxonomy_cache.sqlite",
+                        help="SQLite file keeping the NCBI taxonomy results between runs")
+    parser.add_argument("-l", "--load_dir",
+                        help="initial population: write the records to tab separated files in this directory and load them with LOAD DATA LOCAL INFILE (requires local_infile=1 on the server)")
     parser.add_argument("-c", "--config",
                         type=argparse.FileType('r'),
                         help="path to config file",
@@ -829,6 +1057,11 @@ if __name__ == '__main__':
     jpath = args['jpath']
     verbose=False
     if args['verbose']: verbose= True
+    batch_size=args['batch_size']
+    cache_size=args['cache_size']
+    load_dir=args['load_dir']
+    taxonomy_cache=args['taxonomy_cache']
+    species_index=None
     flag=False
     if args['overwrite']: flag = True
     main(programSetup)
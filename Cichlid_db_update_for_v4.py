@@ -1,6 +1,8 @@
 #!/Library/Frameworks/Python.framework/Versions/3.7/bin/python3
 
+import io
 import json
+import zipfile
 import collections
 import pymysql
 import logging
@@ -10,10 +12,23 @@ import sys
 import re
 import datetime
 from urllib.request import urlopen
+from concurrent.futures import ProcessPoolExecutor
 from dao.mysql.mysql_db_access_object import MySQLDataAccessObject
+from dao.mysql.mysql_connection_pool import MySQLConnectionPool
+from dao.mysql.id_allocator import BlockIdAllocator
+from dao.mysql.lineage_closure import LineageClosure
 from dao.mysql import StudyDAO
 import Get_taxonomy_from_NCBI as TaxUtils
-import copy
+from Species_name_index import SpeciesNameIndex
+from Spreadsheet_records import RECORD_CLASSES, Material
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __author__ = 'Hubert Denise, Jun. 2020'
 
@@ -37,37 +52,82 @@ usage: Cichlid_db_update.py automates entry of data from input template spreadsh
     Usage: Cichlid_db_update (-o) (-v) (-c) (-sp <'input'>)
 '''
 
+#columns of the input template and the corresponding 'table-field' headers
+FULL_COLUMN_LIST=['option', 'individual_name', 'alias', 'species_name', 'genus', 'species', 'informal', 'taxon_id', 'common_name',
+    'taxon_position', 'date_collected', 'collection_method', 'collection_details', 'collector_name', 'country', 'location',
+    'location_details', 'latitude', 'longitude', 'sex', 'developmental_name', 'individual_weight', 'unit', 'individual_comment',
+    'clade', 'species_subset', 'material_name', 'material_accession', 'organism_part', 'material_type', 'storage_condition',
+    'material_location', 'material_amount', 'material_unit', 'material_provider_name', 'material_comment', 'date_received',
+    'image_name', 'image_path', 'image_comment', 'image_licence', 'project_name', 'project_alias', 'project_ssid', 'project_accession',
+    'sample_name', 'sample_accession', 'sample_ssid', 'sample_comment', 'lane_name', 'lane_accession', 'library_name', 'library_ssid',
+    'seq_centre', 'seq_tech', 'paired-end', 'file_name', 'format', 'file_accession', 'md5', 'filepath', 'nber_reads', 'total_length',
+    'average_length', 'sequence_depth', 'exclusion_code', 'file_comment']
+FULL_HEADER_LIST=['record-option','individual-name','individual-alias', 'species-name', 'species-genus', 'species-species',
+    'species-informal', 'species-taxon_id','species-common_name','species-taxon_position', 'individual-date_collected',
+    'individual-collection_method', 'individual-collection_details','provider-provider_name', 'location-country_of_origin',
+    'location-location', 'location-sub_location','location-latitude','location-longitude', 'individual-sex','developmental_stage-name',
+    'individual_data-weight', 'individual_data-unit', 'individual-comment', 'individual_data-clade', 'individual_data-subset',
+    'material-name','material-accession', 'organism_part-name','material-type', 'material-storage_condition', 'material-storage_location',
+    'material-amount','material-unit', 'mat_provider-provider_name', 'material-comment', 'material-date_received', 'image-filename',
+    'image-filepath','image-comment', 'image-licence','project-name',   'project-alias', 'project-ssid','project-accession', 'sample-name',
+    'sample-accession', 'sample-ssid','sample-comment', 'lane-name','lane-accession', 'library_type-name', 'library-ssid',
+    'seq_centre-name','seq_tech-name', 'file-type', 'file-name','file-format','file-accession','file-md5', 'file-location',
+    'file-nber_reads','file-total_length', 'file-average_length', 'file-coverage', 'file-exclusion', 'file-comment']
+#position of each column of the template in FULL_COLUMN_LIST
+COLUMN_POSITIONS={k: i for i, k in enumerate(FULL_COLUMN_LIST)}
+#dates of the spreadsheet (DD/MM/YYYY) converted by format_date
+DATE_PATTERN=re.compile(r'^[0-3][0-9]/[0-1][0-9]/2[0-1][0-3][0-9]')
+#font families accepted by openpyxl (<family val="34"/> of the template fonts is not)
+FONT_FAMILY_PATTERN=re.compile(r'<family val="([0-9]+)"/>')
+#unit: (multiplier, divisor) converting a weight to g
+WEIGHT_UNITS={'mg': (1, 1000), 'ug': (1, 1000000), 'µg': (1, 1000000), 'kg': (1000, 1)}
+
+class HeaderSchema:
+    '''
+    header of an input compiled once: (table, field, column position) of each column, used to decode the lines into table records
+    : input header_list (list) 'table-field' header of each column, from adjust_header_list
+    : input first_column (int) number of leading columns to ignore in the lines (1 for the 'HEADER' format)
+    '''
+    __slots__ = ('header_list', 'first_column', 'columns')
+
+    def __init__(self, header_list, first_column=0):
+        self.header_list = header_list
+        self.first_column = first_column
+        self.columns = []
+        for position, header in enumerate(header_list):
+            table, field = header.split("-")[:2]
+            if field not in RECORD_CLASSES[table].__slots__:
+                raise KeyError(field+" is not a field of table "+table)
+            self.columns.append((table, field, position + first_column))
+
+    def decode(self, line):
+        '''
+        : input line (str) tab separated line of the input
+        : return line_dic (dic) {'table' : record} for the columns present in the line (after removing leading and trailing space(s)), see Spreadsheet_records.py
+        '''
+        dataline = line.split("\t")
+        line_dic = {}
+        for table, field, position in self.columns:
+            if position >= len(dataline):
+                break
+            if table not in line_dic:
+                line_dic[table] = RECORD_CLASSES[table]()
+            #the fields were checked when the header was compiled
+            setattr(line_dic[table], field, dataline[position].strip())
+        return line_dic
+
 def adjust_header_list(line):
     '''To cope with the fact that not all fields will be present in data to upload '''
-    full_column_list=['option', 'individual_name', 'alias', 'species_name', 'genus', 'species', 'informal', 'taxon_id', 'common_name',
-     'taxon_position', 'date_collected', 'collection_method', 'collection_details', 'collector_name', 'country', 'location',
-     'location_details', 'latitude', 'longitude', 'sex', 'developmental_name', 'individual_weight', 'unit', 'individual_comment',
-     'clade', 'species_subset', 'material_name', 'material_accession', 'organism_part', 'material_type', 'storage_condition',
-     'material_location', 'material_amount', 'material_unit', 'material_provider_name', 'material_comment', 'date_received',
-     'image_name', 'image_path', 'image_comment', 'image_licence', 'project_name', 'project_alias', 'project_ssid', 'project_accession',
-     'sample_name', 'sample_accession', 'sample_ssid', 'sample_comment', 'lane_name', 'lane_accession', 'library_name', 'library_ssid',
-     'seq_centre', 'seq_tech', 'paired-end', 'file_name', 'format', 'file_accession', 'md5', 'filepath', 'nber_reads', 'total_length',
-     'average_length', 'sequence_depth', 'exclusion_code', 'file_comment']
-    full_header_list=['record-option','individual-name','individual-alias', 'species-name', 'species-genus', 'species-species',
-     'species-informal', 'species-taxon_id','species-common_name','species-taxon_position', 'individual-date_collected',
-     'individual-collection_method', 'individual-collection_details','provider-provider_name', 'location-country_of_origin',
-     'location-location', 'location-sub_location','location-latitude','location-longitude', 'individual-sex','developmental_stage-name',
-     'individual_data-weight', 'individual_data-unit', 'individual-comment', 'individual_data-clade', 'individual_data-subset',
-     'material-name','material-accession', 'organism_part-name','material-type', 'material-storage_condition', 'material-storage_location',
-     'material-amount','material-unit', 'mat_provider-provider_name', 'material-comment', 'material-date_received', 'image-filename',
-     'image-filepath','image-comment', 'image-licence','project-name',   'project-alias', 'project-ssid','project-accession', 'sample-name',
-     'sample-accession', 'sample-ssid','sample-comment', 'lane-name','lane-accession', 'library_type-name', 'library-ssid',
-     'seq_centre-name','seq_tech-name', 'file-type', 'file-name','file-format','file-accession','file-md5', 'file-location',
-     'file-nber_reads','file-total_length', 'file-average_length', 'file-coverage', 'file-exclusion', 'file-comment']
     #create list of indexes for the column present in the spreadsheet
     if line.startswith('HEADER'):
         LINE=line.split("\t")[1:]
-        index_list=[full_column_list.index(k) for k in LINE if k != "''"]
+        index_list=[COLUMN_POSITIONS[k.strip().lower()] for k in LINE if k != "''"]
     else:
-        index_list=[full_column_list.index(k) for k in line.split("\t") if k != "''"]
+        #the column names are not case sensitive (e.g. 'Genus' in CichlidDataBaseEntry_templateV2.xlsx)
+        index_list=[COLUMN_POSITIONS[k.strip().lower()] for k in line.split("\t") if k != "''"]
     #create list of corresponding headers
-    header_list=[full_header_list[k] for k in index_list]
-    if verbose and len(full_header_list) != len(header_list): logging.info(" header adjusted from "+str(len(full_header_list)) +" columns to "+str(len(header_list))+" columns.")
+    header_list=[FULL_HEADER_LIST[k] for k in index_list]
+    if verbose and len(FULL_HEADER_LIST) != len(header_list): logging.info(" header adjusted from "+str(len(FULL_HEADER_LIST)) +" columns to "+str(len(header_list))+" columns.")
     return header_list
 
 def compare_and_overwrite_data(table, new_data, database_data, index_dic, cv_id, studyDAO):
@@ -99,11 +159,11 @@ def compare_and_overwrite_data(table, new_data, database_data, index_dic, cv_id,
         if verbose: logging.info(" - differences exist")
         #independent_table cases (project, provider, species, location, library_type, seq_tech, seq_centre, cv and ontology)
         if table not in dependent_table:
-            update_statement=[k+"='"+str(v)+"'" for k, v in differences_dic.items()]
+            update_statement=dict(differences_dic)
             #cases where there is changed and latest fields (provider, species, )
             if table in ['provider', 'species']:
                 try:
-                    studyDAO.update(table, ",".join(update_statement)+", changed = '"+today+"'", table+"_id", database_data[table+"_id"])
+                    studyDAO.update_row(table, {**update_statement, 'changed': today}, {table+"_id": database_data[table+"_id"]})
                 except:
                     logging.info("Could not update the dependent table in the database. Existing now")
                     sys.exit()
@@ -111,48 +171,46 @@ def compare_and_overwrite_data(table, new_data, database_data, index_dic, cv_id,
             #cases where there is no changed and latest fields in table (project, location, library_type, seq_tech, seq_centre, cv and ontology)
             else:
                 try:
-                    studyDAO.update(table, ",".join(update_statement), table+"_id", database_data[table+"_id"])
+                    studyDAO.update_row(table, update_statement, {table+"_id": database_data[table+"_id"]})
                 except:
                     logging.info("Could not update the dependent table in the database. Existing now")
                     sys.exit()
                 #insert in annotations table the date on which data were overwritten (to keep record of changes)
-                insert_data("annotations", {"table_name": table, "table_id": database_data[table+"_id"], "cv_id": cv_id, "value": today}, ",","","", studyDAO)
+                insert_data("annotations", {"table_name": table, "table_id": database_data[table+"_id"], "cv_id": cv_id, "value": today}, {}, studyDAO)
 
-                if verbose: logging.info(field_str+" , "+value_str)
+                if verbose: logging.info(" - overwrite date recorded in annotations for table "+table)
             overwrite_flag+=1
         #dependent_table cases (developmental_stage, organism_part, individual, image, material, sample, lane, library, individual_data, file, table)
         else:
-            update_statement=[k+"='"+str(v)+"'" for k, v in differences_dic.items()]
-            dependent_statement=[k+"_id ='"+str(v)+"'" for k, v in index_dic.items() if k in dependent_dic[table]]
+            update_statement=dict(differences_dic)
+            dependent_statement={k+"_id": v for k, v in index_dic.items() if k in dependent_dic[table]}
             TABLE=table
-            identifier=table+"_id"
             if table=='individual_data':
-                identifiant_statement= str(database_data["individual_id"]) + "' and cv_id='"+str(database_data["cv_id"])
-                identifier="individual_id"
+                where_statement={"individual_id": database_data["individual_id"], "cv_id": database_data["cv_id"]}
             else:
-                identifiant_statement=database_data[table+"_id"]
+                where_statement={table+"_id": database_data[table+"_id"]}
             #annotations table case: data will be overwritten
             if table=='table':
                 TABLE='annotations'
-                dependent_statement=[]
-                identifiant_statement=database_data['table_id'] + "' and table_name ='"+database_data['table_name']
+                dependent_statement={}
+                where_statement={"table_id": database_data['table_id'], "table_name": database_data['table_name']}
             #cases where there is changed and latest fields
             if table not in ['organism_part', 'developmental_stage', 'table']:
                 try:
-                    studyDAO.update(TABLE, ",".join(update_statement+dependent_statement)+", changed = '"+today+"'", identifier, identifiant_statement)
+                    studyDAO.update_row(TABLE, {**update_statement, **dependent_statement, 'changed': today}, where_statement)
                 except:
                     logging.info("Could not update the independent table "+table+" in the database. Existing now1")
                     sys.exit()
                 if verbose: logging.info(update_statement)
             else:
                 try:
-                    studyDAO.update(TABLE, ",".join(update_statement+dependent_statement), table+"_id", identifiant_statement)
+                    studyDAO.update_row(TABLE, {**update_statement, **dependent_statement}, where_statement)
                 except:
                     logging.info("Could not update the independent table "+table+" in the database. Existing now2")
                     sys.exit()
         if cv_id != 6 and table != 'table' and table != 'individual_data':
-            insert_data("annotations", {"table_name": table, "table_id": database_data[table+"_id"], "cv_id": cv_id, "value": today}, ",","","", studyDAO)
-            if verbose: logging.info(field_str, value_str)
+            insert_data("annotations", {"table_name": table, "table_id": database_data[table+"_id"], "cv_id": cv_id, "value": today}, {}, studyDAO)
+            if verbose: logging.info(" - overwrite date recorded in annotations for table "+table)
     overwrite_flag+=1
     if verbose: logging.info(" - dictionary of index for the tables")
     if verbose: logging.info(index_dic)
@@ -189,42 +247,33 @@ def compare_and_update_data(table, new_data, database_data, studyDAO):
             else:
                 table_identifier=table+'_id'
                 table_identifiant=database_data[table+'_id']
-            try:
-                studyDAO.update(table, "latest=0", table_identifier, table_identifiant)
-            except:
-                logging.info("Could not update the data in the database. Existing now")
-                sys.exit()
+            #before the insert: the new row may keep the <table>_id identifying the previous one
+            studyDAO.update_rows(table, table_identifier, [(table_identifiant, "latest", 0)])
         #create new entry with new_data and latest=1
         filtered_database_dic={k:v for k,v in database_data.items() if k not in differences_dic.keys() and k not in ('changed', 'latest')}
         data_to_insert={**differences_dic, **filtered_database_dic}
         if verbose: logging.info("    - insert new data into table "+table+": "+str(data_to_insert))
         if table not in ['project', 'developmental_stage', 'organism_part', 'location', 'seq_centre', 'library_type', 'cv', 'seq_tech', 'table']:
-            insert_data(table, data_to_insert, ",", "","", studyDAO)
-            new_index= studyDAO.getIndex(table, identifier_dic[table][0], "'"+database_data[identifier_dic[table][0]] +"' and latest=1")
-            return_index=new_index[0][table+"_id"]
+            #the new row keeps the <table>_id of the previous one
+            return_index=insert_data(table, data_to_insert, {}, studyDAO)
             if verbose: logging.info("    - new index for table "+table +": "+str(return_index))
         else:
             for identifier in identifier_dic[table]:
                 del data_to_insert[identifier]
+            where_statement={x: database_data[x] for x in identifier_dic[table]}
+            TABLE=table
             #to deal with annotations table case (new data will be appended for this table)
             if table=="table":
                 TABLE='annotations'
                 data_to_insert['value']=str(database_data['value'])+"; "+str(data_to_insert['value'])
-                field_statement=prepare_update(data_to_insert)
-                statement_identifiant=statement_identifiant+"' and table_id = '"+str(database_data["table_id"])
-            else:
-                field_statement=prepare_update(data_to_insert)
-                statement_identifier= identifier_dic[table][0]
-                statement_identifiant=database_data[statement_identifier]
-                TABLE=table
-            if verbose: logging.info("    - update statement" + field_statement+" where "+statement_identifier+": "+statement_identifiant)
+            if verbose: logging.info("    - update statement " + str(data_to_insert)+" where "+str(where_statement))
             try:
-                studyDAO.update(TABLE, field_statement, statement_identifier, statement_identifiant)
+                studyDAO.update_row(TABLE, data_to_insert, where_statement)
             except:
                 logging.info("Could not update the data in the database. Existing now")
                 sys.exit()
             if table != 'table':
-                new_index= studyDAO.getIndex(table, identifier_dic[table][0], "'"+database_data[identifier_dic[table][0]]+"'")
+                new_index= studyDAO.getTableData(table, table+"_id", identifier_dic[table][0]+" = %s", data=(database_data[identifier_dic[table][0]],))
                 return_index=new_index[0][table+"_id"]
                 if verbose: logging.info("    - new index for table "+table +": "+str(return_index))
             else:
@@ -248,38 +297,13 @@ def create_new_name(new_dic, db_dic, studyDAO):
             new_dic['material']['name']=new_dic['individual']['name']
     return new_dic
 
-def dic_to_str(dic, field_attribute="", value_attribute=""):
-    '''
-    function to transform a dictionary into strings for fields and values to populate the database
-    : input dic (dic) dicionary to insert into db
-    : input field_attribute (str) string of fields to add to the dictionary ones
-    : input value_attribute (str) string of corresponding values to add to the dictionary ones
-    : return field_str (str) field list separated by comma
-    : return val_str (str) corresponding value list separated by comma and apostrophes if necessary
-    '''
-    if verbose: logging.info("      - transforming data into string "+str(dic)+" "+field_attribute+" "+str(value_attribute))
-    new_list=[]
-    field_list = list(dic.keys())
-    val_list = list(dic.values())
-    #rewrite  the values in mysql compatible format
-    for element in val_list:
-        if type(element) == str or type(element) == datetime.date:
-             element ="'"+str(element)+"'"
-        new_list.append(element)
-    field_str = (", ".join(field_list) + field_attribute).replace('weight', 'value')
-    val_str =  ", ".join(str(x) for x in new_list) + str(value_attribute)
-    val_str = val_str.replace('None', 'Null')
-    if verbose: logging.info("      - field: "+field_str+", value: "+val_str)
-    return field_str, val_str
-
-def dispatch_data(raw_results, annotations_data, entry_name, studyDAO, mydbconn):
+def dispatch_data(records, entry_name, studyDAO, pool):
     '''
     generic function to call for update/population of the database with data from spreadsheet
-    : input raw_results (dic) parsed data from the spreadsheet
-    : input  (dic) parsed data from the spreadsheet
+    : input records (iterator) (individual_name, line_dic, annotation_dic) for each line parsed from the spreadsheet, processed and committed one at a time
     : input entry_name (str) name of the Google spreadsheet tab
     : input studyDAO (connection object) object to connect to the database
-    : input mydbconn (database connection_socket) connection to the Cichlid database
+    : input pool (MySQLConnectionPool) pool of connections to the Cichlid database, one connection is borrowed per record
     : return none
     '''
     dependent_table =  ['developmental_stage', 'organism_part', 'individual', 'image', 'material', 'sample', 'lane', 'library', 'individual_data', 'file']
@@ -289,19 +313,25 @@ def dispatch_data(raw_results, annotations_data, entry_name, studyDAO, mydbconn)
     insert_flag=0
     update_flag=0
     overwrite_flag=0
-    for individual_name in raw_results:
-        if verbose: logging.info("Dispath data for individual name: "+individual_name)
-        #more than one entry per individual could be encountered
-        for index in range(0,len(raw_results[individual_name])):
-            if 'record' not in raw_results[individual_name][index] or raw_results[individual_name][index]['record']['option'] not in ('update', 'overwrite'):
+    records = iter(records)
+    while True:
+        #a connection is borrowed per record (checked, and reopened if the server closed it): it reads the next line and writes the record
+        with pool.connection() as mydbconn:
+            studyDAO.dataAccessObject.useConnection(mydbconn)
+            record = next(records, None)
+            if record is None:
+                break
+            individual_name, new_data, annotations_data = record
+            if verbose: logging.info("Dispath data for individual name: "+individual_name)
+            if 'record' not in new_data or new_data['record']['option'] not in ('update', 'overwrite'):
                 if verbose: logging.info(" INSERT RECORD INTO DATABASE")
-                insert_flag=insert_entry(raw_results[individual_name][index], annotations_data[individual_name][index], studyDAO)
-            elif raw_results[individual_name][index]['record']['option']=='update':
+                insert_flag=insert_entry(new_data, annotations_data, studyDAO)
+            elif new_data['record']['option']=='update':
                     if verbose: logging.info(" UPDATE RECORD FROM DATABASE")
-                    update_flag=update_entry(raw_results[individual_name][index], annotations_data[individual_name][index], studyDAO)
-            elif raw_results[individual_name][index]['record']['option']=='overwrite':
+                    update_flag=update_entry(new_data, annotations_data, studyDAO)
+            elif new_data['record']['option']=='overwrite':
                     if verbose: logging.info(" OVERWRITE RECORD FROM DATABASE")
-                    overwrite_flag=overwrite_entry(raw_results[individual_name][index], annotations_data[individual_name][index], studyDAO)
+                    overwrite_flag=overwrite_entry(new_data, annotations_data, studyDAO)
             if insert_flag > 0 or update_flag>0 or overwrite_flag>0:
                 logging.info("Committing data from the "+raw_results_type+" "+entry_name+" to the database")
                 if insert_flag > 0: logging.info(" - "+str(insert_flag)+" insertions took place")
@@ -309,9 +339,12 @@ def dispatch_data(raw_results, annotations_data, entry_name, studyDAO, mydbconn)
                 if overwrite_flag > 0: logging.info(" - "+str(overwrite_flag)+" overwritting took place")
             if verbose: logging.info("Committing data changes into the database")
             try:
+                #send the latest flags of the entry (grouped by table) before committing
+                studyDAO.flush_updates()
                 mydbconn.commit()
             except:
                 logging.error("Rolling back database changes...")
+                studyDAO.clear_cache()
                 mydbconn.rollback()
                 logging.error("The program failed to import data from the "+raw_results_type+" "+entry_name+" with the below exception:")
                 raise
@@ -350,17 +383,13 @@ def ensure_data_continuity(entry_dic, studyDAO):
                 to_complete=['lane', 'file']
         for table in link_tables:
             if table not in entry_dic:
-                #get latest table'_id'
-                previous_index=studyDAO.getmaxIndex(table)[0]['max('+table+'_id)']
-                #prepare statement
-                field_str="("+table+"_id, "+",".join([x for x in linked_tables[table] if x[:-3] in entry_dic])+', changed, latest)'
-                value_str="("+str(previous_index+1)+","+",".join([str(entry_dic[x[:-3]]) for x in linked_tables[table] if x[:-3] in entry_dic])+",'"+today+"', 1)"
+                #prepare row with a new table'_id'
+                row_data={table+"_id": studyDAO.next_id(table), **{x: entry_dic[x[:-3]] for x in linked_tables[table] if x[:-3] in entry_dic}, "changed": today, "latest": 1}
                 #populate the database and update entry_dic
-                studyDAO.populate_table(table, field_str, value_str)
-                entry_dic[table]=previous_index+1
+                entry_dic[table]=studyDAO.insert_row(table, row_data)
         #finally update the database with corresponding value to link final table
         if len(to_complete) >0:
-            studyDAO.update(to_complete[link_tables.index(table)], table+"_id = "+str(entry_dic[table]), to_complete[link_tables.index(table)]+"_id", entry_dic[to_complete[link_tables.index(table)]])
+            studyDAO.update_row(to_complete[link_tables.index(table)], {table+"_id": entry_dic[table]}, {to_complete[link_tables.index(table)]+"_id": entry_dic[to_complete[link_tables.index(table)]]})
         return entry_dic
 
 def format_date(entry_date):
@@ -369,31 +398,14 @@ def format_date(entry_date):
     : input entry_date (str) date as provided in the spreadsheet
     : return return_date (date) date formatted as YYYY-MM-DD (only numeric and separated by '-')
     '''
-    pattern_date=re.compile(r'^[0-3][0-9]/[0-1][0-9]/2[0-1][0-3][0-9]')
     return_date = entry_date
-    if pattern_date.match(entry_date):
+    if DATE_PATTERN.match(entry_date):
         date_field_part = entry_date.split("/")
         date_part = date_field_part[2]+"-"+date_field_part[1]+"-"+date_field_part[0]
         return_date=datetime.datetime.strptime(date_part, "%Y-%m-%d").date()
     if verbose: logging.info("      + format data from "+str(entry_date) +" to "+str(return_date))
     return str(return_date)
 
-def format_to_compare(dic):
-    '''
-    Function to reformat the latitude and longitude entries to compare them (ensure it is a string and that it does not end by '0')
-    : input dic (dic) dictionary with location_field:value where location_fields are the fields from the location entry from the spreadsheet
-    : return dic (dic) updated location directory
-    '''
-    previous_data=""
-    for field in ['latitude', 'longitude']:
-        previous_data+=", "+str(dic[field])
-        dic[field] = str(dic[field])
-        #make sure that last digit is not considered if equal to 0
-        if dic[field][-1] =='0':
-            dic[field] = dic[field][:-1]
-    if verbose: logging.info("      + reformat latitude and longitude from "+previous_data[2:]+" to "+str(dic['latitude'])+", "+str(dic['longitude']))
-    return dic
-
 def get_cv_id(studyDAO):
     '''query the database to get the relevant cv_id'''
     cv_dic={}
@@ -426,11 +438,11 @@ def get_database_data(data, studyDAO, flag):
     if 'mat_provider' in table_list:
         material_provider=data["mat_provider"]
         table_list.remove("mat_provider")
-        mat_provider=studyDAO.getIndex("provider", "provider_name", "'"+material_provider["provider_name"]+"'")
+        mat_provider=studyDAO.getTableData("provider", "provider_id", "provider_name = %s", data=(material_provider["provider_name"],))
         #if provider_name is present into the db, add index to database_dic otherwise, insert name into the provider table before geting the index
         if len(mat_provider) == 0:
-            studyDAO.populate_table("provider", "(provider_name, changed, latest)", "('"+material_provider["provider_name"]+"', '"+today+"', 1)")
-            mat_provider=studyDAO.getIndex("provider", "provider_name", "'"+material_provider["provider_name"]+"'")
+            studyDAO.insert_row("provider", {"provider_name": material_provider["provider_name"], "changed": today, "latest": 1})
+            mat_provider=studyDAO.getTableData("provider", "provider_id", "provider_name = %s", data=(material_provider["provider_name"],))
         database_dic["mat_provider"]=mat_provider[0]["provider_id"]
     asso_dic={}
     insert_dic={}
@@ -439,24 +451,21 @@ def get_database_data(data, studyDAO, flag):
         #get all data  for the entry using the identifier (latest entry if the field 'latest' is present)|
         if table not in ['project', 'developmental_stage', 'organism_part', 'location', 'seq_centre', 'library_type', 'seq_tech', 'individual']:
             if identifier_dic[table] in data[table]:
-                db_table_data = studyDAO.getStudyData(table, "latest = 1 and "+identifier_dic[table], data[table][identifier_dic[table]])
+                db_table_data = studyDAO.getTableData(table, "*", "latest = 1 and "+identifier_dic[table]+" = %s", data=(data[table][identifier_dic[table]],))
         elif table=='individual':
             #if there is several individual with the same name, check which one need to be evaluated and eventually updated
             #alias has to be used also to define individual; if no alias, then species_id & sex could be used
             if 'alias' in data[table]:
-                db_table_data = studyDAO.getStudyData(table, "latest = 1 and "+identifier_dic[table]+" like '" +data[table][identifier_dic[table]]+"%' and alias", str(data[table]['alias']))
+                db_table_data = studyDAO.getTableData(table, "*", "latest = 1 and "+identifier_dic[table]+" like %s and alias = %s", data=(data[table][identifier_dic[table]]+"%", str(data[table]['alias'])))
             else:
-                db_table_data = studyDAO.getStudyData(table, identifier_dic[table]+" like '" +data[table][identifier_dic[table]]+"%' and latest", '1')
+                db_table_data = studyDAO.getTableData(table, "*", identifier_dic[table]+" like %s and latest = 1", data=(data[table][identifier_dic[table]]+"%",))
         else:
-            identifier=identifier_dic[table]
+            #the location is identified by all its fields
             if table == 'location' and 'location' in data[table]:
-                value = data[table]['location']
-                data_location = dict(data[table])
-                del data_location['location']
-                identifier_value = value + "' and " + str(data_location)[2:-2].replace("':","=").replace(", '", " and ")
+                criteria = dict(data[table])
             else:
-                identifier_value = data[table][identifier_dic[table]]
-            db_table_data = studyDAO.getStudyData(table, identifier, identifier_value)
+                criteria = {identifier_dic[table]: data[table][identifier_dic[table]]}
+            db_table_data = studyDAO.getTableData(table, "*", " and ".join([x+" = %s" for x in criteria]), data=tuple(criteria.values()))
         #if data are already present in the database  and return dic with id or data depending on the flag
         if len(db_table_data) > 0:
             if flag=='I':
@@ -467,27 +476,31 @@ def get_database_data(data, studyDAO, flag):
     if verbose: logging.info("      + "+str(database_dic))
     return database_dic
 
-def insert_data(table, table_data, index, field_attribute, data_attribute, studyDAO):
-    '''function to insert new data for every table into the database'''
+def insert_data(table, table_data, extra_data, studyDAO):
+    '''
+    function to insert new data for every table into the database
+    : input table_data (dic) dictionary of field: value to insert
+    : input extra_data (dic) additional field: value (e.g. <table>_id or ids of linked tables). Only <table>_id is used for the tables without changed and latest fields
+    : return (int) <table>_id of the new row (None if the table has no <table>_id)
+    '''
     if verbose: logging.info("      + inserting data into database for table "+table)
+    #weight is stored in the 'value' field
+    row_data={('value' if k == 'weight' else k): v for k, v in table_data.items()}
     #prepare data to insert depending the nature of the table
     if table not in ['project', 'developmental_stage', 'organism_part', 'location', 'seq_centre', 'library_type', 'cv', 'seq_tech', 'allocation', 'annotations']:
-        if field_attribute.endswith(", "):
-            field_attribute=field_attribute[:-2]
-            data_attribute=data_attribute[:-2]
-        field_str, value_str = dic_to_str(table_data, field_attribute+", changed, latest ", data_attribute+", '"+today+"', 1")
-    else:
-        if isinstance(index, int):
-            field_str, value_str = dic_to_str(table_data, ","+table+"_id", ","+str(index+1))
-        else:
-            field_str, value_str = dic_to_str(table_data)
+        row_data.update(extra_data)
+        row_data['changed']=today
+        row_data['latest']=1
+    elif table+"_id" in extra_data:
+        row_data[table+"_id"]=extra_data[table+"_id"]
     try:
-        studyDAO.populate_table(table, "("+field_str+")", "("+value_str+")")
+        new_index=studyDAO.insert_row(table, row_data)
     except:
-        logging.info(field_str+" ------ "+ value_str)
+        logging.info(str(row_data))
         logging.info("Could not insert the new dependent data in table "+table+" the database. Existing now")
         sys.exit()
-    if verbose: logging.info("      + data: "+field_str+", "+value_str)
+    if verbose: logging.info("      + data: "+str(row_data))
+    return new_index
 
 def insert_entry(new_data, annotations_data, studyDAO):
     '''manage the fate of the data if 'new_record' flag has been provided'''
@@ -501,12 +514,10 @@ def insert_entry(new_data, annotations_data, studyDAO):
         #not already in db: insert has then to take place
         if table in new_data and table not in database_data:
             if verbose: logging.info("C-INSERT ENTRY")
-            previous_index=studyDAO.getmaxIndex(table)[0]['max('+table+'_id)']
-            insert_data(table, new_data[table], previous_index, ","+table+"_id", ","+ str(previous_index+1), studyDAO)
+            #update database_data with new index for entry
+            database_data[table]=insert_data(table, new_data[table], {table+"_id": studyDAO.next_id(table)}, studyDAO)
             #update the flag value
             insert_flag+=1
-            #update database_data with new index for entry
-            database_data[table]=previous_index+1
     #dependent table have dependencies so this has to be taken into account
     for table in dependent_table:
         if verbose: logging.info("  C1 - inserting entry for dependent_table: "+table)
@@ -523,21 +534,18 @@ def insert_entry(new_data, annotations_data, studyDAO):
                 previous_name=new_data[table]['name']
                 original_new_individual_data=dict(new_data[table])
                 del original_new_individual_data['name']
-                check_statement = prepare_update(original_new_individual_data)
+                check_statement, check_values = prepare_update(original_new_individual_data, " and ")
                 #get data already in database
                 # check if there is entry with all parameters from submitted data
-                param_statement = check_statement.replace(", "," and ")
-                if len(param_statement) > 1:
-                    param_statement=" and "+param_statement + " and"
-                else:
-                    param_statement=" and "
-                param_name=studyDAO.getStudyData(table, "latest", "1'"+ param_statement+" name like '"+previous_name+"%")
+                if len(check_statement) > 0:
+                    check_statement+=" and "
+                param_name=studyDAO.getTableData(table, "*", "latest = 1 and "+check_statement+"name like %s", data=tuple(check_values)+(previous_name+"%",))
                 # if there is no results with all parameters so check if alias can be used for identity
                 if len(param_name)==0 and 'alias' in new_data[table]:
-                        param_name=studyDAO.getStudyData(table, "latest", "1' and alias ='"+new_data[table]['alias']+"' and  name like '"+previous_name+"%")
+                        param_name=studyDAO.getTableData(table, "*", "latest = 1 and alias = %s and name like %s", data=(new_data[table]['alias'], previous_name+"%"))
                 # there is no results with all parameters nor alias only: get data with name only
                 if len(param_name)==0:
-                        names=studyDAO.getStudyData(table, "latest", "1' and name like '"+previous_name+"%")
+                        names=studyDAO.getTableData(table, "*", "latest = 1 and name like %s", data=(previous_name+"%",))
                 # there is results with all parameters or alias so use the individual_id found in the database
                 if len(param_name) > 0:
                     new_data[table]['name']=param_name[0]['name']
@@ -564,15 +572,12 @@ def insert_entry(new_data, annotations_data, studyDAO):
                     if verbose: logging.info("  C2 -individual name changed to "+new_data['individual']['name'])
                     #insert the new individual data
                     linked_dic={k+"_id":v for k,v in database_data.items() if k in dependent_dic[table]}
-                    link_attr, val_attr = dic_to_str(linked_dic)
-                    previous_index=studyDAO.getmaxIndex(table)[0]['max('+table+'_id)']
                     if verbose: logging.info("  C3 - inserting data table: "+table+": "+str(new_data))
-                    insert_data(table, new_data[table], previous_index, ", individual_id, "+link_attr, ", "+str(previous_index+1)+", "+val_attr, studyDAO)
-                    database_data["individual"]=previous_index+1
+                    database_data["individual"]=insert_data(table, new_data[table], {"individual_id": studyDAO.next_id(table), **linked_dic}, studyDAO)
                     #populate the allocation table
                     if 'project' in database_data:
                         if verbose: logging.info("  C4 - inserting data table: allocation: "+str({'project_id':str(database_data["project"]), 'individual_id': str(database_data["individual"])}))
-                        insert_data("allocation", {'project_id':str(database_data["project"]), 'individual_id': str(database_data["individual"])}, ",", "","", studyDAO)
+                        insert_data("allocation", {'project_id':str(database_data["project"]), 'individual_id': str(database_data["individual"])}, {}, studyDAO)
             #case where data are not already in the database for this table: insert
             if table not in database_data:
                 if verbose: logging.info("  C5 - insert into table "+table)
@@ -580,53 +585,41 @@ def insert_entry(new_data, annotations_data, studyDAO):
                 for sub_table in dependent_dic[table]:
                     if verbose: logging.info("    C5a - get data from sub table: "+sub_table+" for table:"+table)
                     if sub_table=='ontology':
-                        database_data['ontology']='NULL'
-                        ontology_id=studyDAO.getIndex('ontology', 'name', "'"+new_data[table]['name']+"'")
+                        database_data['ontology']=None
+                        ontology_id=studyDAO.getTableData('ontology', 'ontology_id', "name = %s", data=(new_data[table]['name'],))
                         if len(ontology_id) >0:
                             database_data['ontology']=ontology_id[0]['ontology_id']
                     if sub_table=='cv':
                         if 'weight' in new_data[table]:
-                            criteria="'weight'"
-                            cv_id=studyDAO.getIndex('cv', 'attribute', criteria)
+                            cv_id=studyDAO.getTableData('cv', 'cv_id', "attribute = %s", data=('weight',))
                             database_data['cv']=cv_id[0]['cv_id']
                     #gather the sub_table ids with the others
                     if sub_table in database_data: dep_dic[sub_table+"_id"]= database_data[sub_table]
                 if verbose: logging.info("    C5b -sub tables data: "+str(database_data))
-                #prepare the insert statement
-                dep_field= ",".join(list(dep_dic.keys()))
-                dep_data=",".join([str(x) for x in dep_dic.values()])
                 #insert data onto table: get index, prepare arguments then insert
                 if table !='individual_data':
-                    index=","+str(studyDAO.getmaxIndex(table)[0]['max('+table+'_id)'] +1 )+", "
-                    field=","+table+"_id, "
+                    extra_data={table+"_id": studyDAO.next_id(table), **dep_dic}
                 else:
                     #if individual_data, there is no 'table_id' so adjust arguments
-                    index=","
-                    field=", "
-                    dep_field+=", comment"
-                    dep_data+=", 'extracted the "+today+" from "+input_name+"'"
-                if verbose: logging.info("    C5c - inserting data into table: "+table+": "+str(new_data[table])+" "+field+ dep_field+" "+index+dep_data)
+                    extra_data={**dep_dic, "comment": "extracted the "+today+" from "+input_name}
+                if verbose: logging.info("    C5c - inserting data into table: "+table+": "+str(new_data[table])+" "+str(extra_data))
                 #only enter weight in individual_data if value is provided
                 if table =='individual_data':
-                    if 'unit' in dep_field and 'weight' in dep_field:
-                        insert_data(table, new_data[table], index, field+ dep_field, index+dep_data, studyDAO)
+                    if 'unit' in extra_data and 'weight' in extra_data:
+                        insert_data(table, new_data[table], extra_data, studyDAO)
                 else:
                     #deal with case where provider name is provided for the material
                     if table =="material" and "material" in new_data:
                         #if provider is provided, it will be added otherwise let blank.
-                        if 'provider_id' in dep_field:
-                           prov_index=dep_field.split(",").index('provider_id')
-                           list_dep_data=dep_data.split(",")
+                        if 'provider_id' in extra_data:
                            if "mat_provider" in database_data:
-                                list_dep_data[prov_index]=str(database_data['mat_provider'])
+                                extra_data['provider_id']=database_data['mat_provider']
                            else:
-                                list_dep_data[prov_index]='NULL'
-                           dep_data=",".join(list_dep_data)
-                    insert_data(table, new_data[table], index, field+ dep_field, index+dep_data, studyDAO)
+                                extra_data['provider_id']=None
+                    new_index=insert_data(table, new_data[table], extra_data, studyDAO)
                 insert_flag+=1
                 #update database_data accordigly
                 if table !='individual_data':
-                    new_index=studyDAO.getmaxIndex(table)[0]['max('+table+'_id)']
                     database_data[table]=new_index
     database_data=ensure_data_continuity(database_data, studyDAO)
     #special case for comment fields
@@ -637,17 +630,17 @@ def insert_entry(new_data, annotations_data, studyDAO):
         #check if value is already in 'individual_data' or 'annotations'
         if table != 'individual':
             for annotation in annotations_data[table]:
-                annotation_query=studyDAO.getTableData("annotations", "cv_id", "table_name = '" +table+"' and table_id= "+str(database_data[table]) +" and value = '"+str(annotations_data[table][annotation])+"'")
+                annotation_query=studyDAO.getTableData("annotations", "cv_id", "table_name = %s and table_id = %s and value = %s", data=(table, database_data[table], str(annotations_data[table][annotation])))
                 if len(annotation_query)==0:
                     if verbose: logging.info("  C6a - insert into table annotations: "+str({"table_name":table, "table_id": str(database_data[table]), "cv_id":str(cv_dic[table]), "value":str(annotations_data[table])}))
-                    insert_data("annotations", {"table_name":table, "table_id": str(database_data[table]), "cv_id":str(cv_dic[table]), "value":str(annotations_data[table][annotation])}, ",", "", "", studyDAO)
+                    insert_data("annotations", {"table_name":table, "table_id": str(database_data[table]), "cv_id":str(cv_dic[table]), "value":str(annotations_data[table][annotation])}, {}, studyDAO)
                     insert_flag+=1
         else:
             if verbose: logging.info(" - insert into table individual_data")
-            individual_data_query=studyDAO.getTableData("individual_data", "cv_id", "individual_id= "+str(database_data[table])+" and value = '"+str(annotations_data[table]['comment'])+"'")
+            individual_data_query=studyDAO.getTableData("individual_data", "cv_id", "individual_id = %s and value = %s", data=(database_data[table], str(annotations_data[table]['comment'])))
             if len(individual_data_query)==0:
                 if verbose: logging.info("  C6b - insert into table individual_data: "+str({"individual_id":str(database_data[table]), "cv_id":str(cv_dic[table]), "value":str(annotations_data[table]['comment']), "comment": 'extracted the '+today+' from '+input_name}))
-                insert_data("individual_data", {"individual_id":str(database_data[table]), "cv_id":str(cv_dic[table]), "value":str(annotations_data[table]['comment']), "comment": 'extracted the '+today+' from '+input_name}, ",", "", "", studyDAO)
+                insert_data("individual_data", {"individual_id":str(database_data[table]), "cv_id":str(cv_dic[table]), "value":str(annotations_data[table]['comment']), "comment": 'extracted the '+today+' from '+input_name}, {}, studyDAO)
                 insert_flag+=1
     if verbose: logging.info("  - "+str(insert_flag)+" insertion(s) took place")
     return insert_flag
@@ -662,7 +655,7 @@ def overwrite_entry(new_data, annotations_data, studyDAO):
     if 'individual' in database_data:
         new_data['individual']['name']=database_data['individual']['name']
     #get cv_id when the date has to be overwritten (track changes when the tables do not have a 'changed' field)
-    cv_id = studyDAO.getIndex("cv", "attribute", "'date overwritten'")[0]["cv_id"]
+    cv_id = studyDAO.getTableData("cv", "cv_id", "attribute = %s", data=('date overwritten',))[0]["cv_id"]
     novel_database_indexes={}
     database_indexes={}
     if verbose: logging.info("B-OVERWRITE ENTRY")
@@ -670,17 +663,12 @@ def overwrite_entry(new_data, annotations_data, studyDAO):
         if table in new_data:
             #if not alreay present: insert has then to take place
             if table not in database_data:
-                #get the index of last entry in table
-                previous_index=studyDAO.getmaxIndex(table)[0]['max('+table+'_id)']
                 if verbose: logging.info(" B2 - insert into independent table "+table+": "+str(new_data[table]))
-                if table not in ['project', 'location', 'ontology', 'cv', 'library_type']:
-                    insert_data(table, new_data[table], previous_index, ","+table+"_id", ","+ str(previous_index+1), studyDAO)
-                else:
-                    insert_data(table, new_data[table], previous_index, ","+table+"_id, changed, latest", ","+ str(previous_index+1)+","+today+", 1", studyDAO)
+                new_index=insert_data(table, new_data[table], {table+"_id": studyDAO.next_id(table)}, studyDAO)
                 overwrite_flag+=1
                 #update database_data with new index for entry
-                novel_database_indexes[table]=previous_index+1
-                database_indexes[table]=previous_index+1
+                novel_database_indexes[table]=new_index
+                database_indexes[table]=new_index
             else:
                 #if present: data have to be compared and overwritten accordingly
                 independent_overwrite_flag, database_indexes= compare_and_overwrite_data(table, new_data[table], database_data[table], database_indexes, cv_id, studyDAO)
@@ -693,35 +681,29 @@ def overwrite_entry(new_data, annotations_data, studyDAO):
         if table not in database_data:
             #special case for individual_data as no individual_data_id
             if table != 'individual_data':
-                #get the index of last entry in table
-                previous_index=studyDAO.getmaxIndex(table)[0]['max('+table+'_id)']
                 dependent_statement_dic={k+"_id":v for k, v in novel_database_indexes.items() if k in dependent_dic[table]}
-                field_str, val_str = dic_to_str(dependent_statement_dic)
-                database_indexes['individual']=previous_index+1
                 #check if there is there is data to insert for the dependent table(s) to the table considered
                 if verbose: logging.info(" B3 - insert into dependent table "+table+": "+str(new_data[table]))
-                if len(field_str) > 1:
-                    insert_data(table, new_data[table], previous_index, ","+table+"_id, " +field_str , ","+ str(previous_index+1)+"," + val_str, studyDAO)
-                else:
-                    insert_data(table, new_data[table], previous_index, ","+table+"_id" , ","+ str(previous_index+1), studyDAO)
-                if verbose: logging.info(field_str +" , "+val_str)
+                new_index=insert_data(table, new_data[table], {table+"_id": studyDAO.next_id(table), **dependent_statement_dic}, studyDAO)
+                database_indexes['individual']=new_index
+                if verbose: logging.info(str(dependent_statement_dic))
                 #update database_data with new index for entry
-                novel_database_indexes[table]=previous_index+1
+                novel_database_indexes[table]=new_index
             else:
                 individual_id=novel_database_indexes['individual']
                 if 'weight' in new_data[table]:
-                    cv_id= studyDAO.getIndex("cv", "attribute", "'weight'")[0]["cv_id"]
+                    cv_id= studyDAO.getTableData("cv", "cv_id", "attribute = %s", data=('weight',))[0]["cv_id"]
                     value=new_data[table]['weight']
                     unit=new_data[table]['unit']
-                    individual_data_from_db=studyDAO.getStudyData("individual_data", "individual_id", str(novel_database_indexes["individual"]) +"' and cv_id ='"+str(cv_id))
+                    individual_data_from_db=studyDAO.getTableData("individual_data", "*", "individual_id = %s and cv_id = %s", data=(novel_database_indexes["individual"], cv_id))
                     if len(individual_data_from_db) == 0:
-                        insert_data(table, new_data[table], 0, ", individual_id , cv_id", ","+ str(individual_id)+","+str(cv_id), studyDAO)
+                        insert_data(table, new_data[table], {"individual_id": individual_id, "cv_id": cv_id}, studyDAO)
                     else:
                         if float(new_data[table]['weight']) != float(individual_data_from_db[0]['value']):
                             #data are present so delete previous entry
-                            insert_data(table, new_data[table], 0, ", individual_id , cv_id, comment", ","+ str(individual_id)+","+str(cv_id)+",'"+individual_data_from_db[0]['comment']+"'", studyDAO)
+                            insert_data(table, new_data[table], {"individual_id": individual_id, "cv_id": cv_id, "comment": individual_data_from_db[0]['comment']}, studyDAO)
                         try:
-                            studyDAO.delete_data(table, "value", individual_data_from_db[0]['value']+" and individual_id =" + str(individual_id)+" and cv_id = "+str(cv_id))
+                            studyDAO.delete_data(table, "value = %s and individual_id = %s and cv_id = %s", (individual_data_from_db[0]['value'], individual_id, cv_id))
                         except:
                             logging.info("Could not delete the data in the database. Existing now")
                             sys.exit()
@@ -734,22 +716,22 @@ def overwrite_entry(new_data, annotations_data, studyDAO):
     #deal with comments fields for the annotations table
     for table in annotations_data:
         #get the cv_ids for the tables with comment
-        cv_id=studyDAO.getIndex('cv', 'comment', "'entry for table "+table+"'")[0]["cv_id"]
+        cv_id=studyDAO.getTableData('cv', 'cv_id', "comment = %s", data=('entry for table '+table,))[0]["cv_id"]
         table_to_overwrite="annotations"
         table_to_compare='table'
-        annotations_data_from_db=studyDAO.getStudyData(table_to_overwrite, "table_name = '" +table+"' and cv_id= "+str(cv_id)+ " and table_id ", novel_database_indexes[table])
+        annotations_data_from_db=studyDAO.getTableData(table_to_overwrite, "*", "table_name = %s and cv_id = %s and table_id = %s", data=(table, cv_id, novel_database_indexes[table]))
         to_insert_dic={"table_name":table, "table_id": novel_database_indexes[table], "cv_id":cv_id, "value": annotations_data[table]}
 
         if table=='individual':
-            cv_id= studyDAO.getIndex("cv", "attribute", "'notes' and comment = 'entry for table individual'")[0]["cv_id"]
+            cv_id= studyDAO.getTableData("cv", "cv_id", "attribute = %s and comment = %s", data=('notes', 'entry for table individual'))[0]["cv_id"]
             table_to_overwrite='individual_data'
             table_to_compare='individual_data'
-            annotations_data_from_db=studyDAO.getStudyData(table_to_overwrite, "cv_id ="+str(cv_id) +" and individual_id", novel_database_indexes[table])
+            annotations_data_from_db=studyDAO.getTableData(table_to_overwrite, "*", "cv_id = %s and individual_id = %s", data=(cv_id, novel_database_indexes[table]))
             to_insert_dic={"individual_id":table, "cv_id":cv_id, "value": annotations_data[table]}
         #if no data in database: insert the comments
         if verbose: logging.info(" B5 - insert into table annotations: "+str(to_insert_dic))
         if len(annotations_data_from_db) == 0:
-            insert_data("annotations", to_insert_dic, ",", "", "", studyDAO)
+            insert_data("annotations", to_insert_dic, {}, studyDAO)
         #if data: compare and update
         else:
             annotations_flag, index = compare_and_overwrite_data(table_to_compare, {"value":annotations_data[table]}, annotations_data_from_db[0], novel_database_indexes, cv_id, studyDAO)
@@ -757,228 +739,432 @@ def overwrite_entry(new_data, annotations_data, studyDAO):
     if verbose: logging.info("  - "+str(overwrite_flag)+" overwrite(s) took place")
     return overwrite_flag
 
-def parse_spreadsheet(spread_path, studyDAO):
+def read_spreadsheet(spread_path):
     '''
-    generic function to open the spreadsheet and reformat the data
+    generator reading the spreadsheet one line at a time (published url or file)
     : input spread_path (str) absolute path to the spreadsheet
-    : input studyDAO (connection object) object to connect to the database
-    : return spread_dic (dic) nested dictionary  with individual_names as key and values in the format [{'table' :['field' : value from datasheet]}]
-    : return annotations_dic (dic) nested dictionary with table as key and dictionaries with header as key and corresponding data from spreadsheet as values
-    : return spreadsheet (str) name of the spreadsheet parsed
+    : return (tuple) (schema, line) for each data line of the spreadsheet, schema being the HeaderSchema of the header above the line
     '''
     firstColumn = 0
-    individual_name =""
-    spread_dic={}
-    new_proj={}
-    annotations_dic={}
-    spreadsheet = 'user spreadsheet'
     if verbose: logging.info("OPENING SPREADSHEET: "+spread_path)
     #define header for each table according to spreadsheet url (create new one if different spreadsheet provided)
     if '1978536442' in spread_path:
-        spreadsheet = 'input_template'
         #cases where data are available online (note for Google spreadsheet or else, the data need to be published as csv first)
         try:
             connection_socket = urlopen(spread_path)
-            tsv_doc = connection_socket.read()
-            res= tsv_doc.decode("utf8")
-            connection_socket.close()
         except:
             logging.info("Could not find the spreadsheet at the url indicated. Existing now")
             raise
-        lines = res.split("\n")
-        header_list=adjust_header_list(lines[0].rstrip())
-        start_read = 2
+        try:
+            #the first line is the header, the second one is not read
+            for line_number, tsv_line in enumerate(connection_socket):
+                line = tsv_line.decode("utf8").rstrip("\n")
+                if line_number == 0:
+                    schema=HeaderSchema(adjust_header_list(line.rstrip()), firstColumn)
+                elif line_number >= 2:
+                    yield schema, line
+        finally:
+            connection_socket.close()
+    elif spread_path.endswith('.xlsx'):
+        yield from read_xlsx(spread_path)
     else:
-        spreadsheet = 'input_user'
-        file=open(spread_path, 'r', encoding='utf8', errors='replace')
-        lines=[]
-        for line in file:
-            if line.startswith('option') or line.startswith('HEADER'):
-                header_list=adjust_header_list(line.rstrip())
-                if line.startswith('HEADER'):
-                    firstColumn=1
-            else:
-                if "test_entry" not in line:
-                    lines.append(line)
-        start_read = 0
-    #avoid the spreadsheet header
-    for line in lines[start_read:]:
-        line=line.rstrip()
-        line_dic={}
-        annotation_entry_dic={}
-        #to avoid issue with apostrophe in field. Need to be updated with a better solution?
-        line=line.replace("'","\"")
-        if firstColumn==1:
-            dataline=line.split("\t")[1:]
-        else:
-            dataline=line.split("\t")
-        #parse the spreadsheet into table and field (after removing leading and trailing space(s))
-        for index in range(0,len(dataline)):
-            table = header_list[index].split("-")[0]
-            field = header_list[index].split("-")[1]
-            if table not in line_dic:
-                line_dic[table] = {}
-            line_dic[table][field] = dataline[index].strip()
-        #individual is the main table and name is the identifier. So if no name is present: do not insert
-        if 'individual' in line_dic and len(line_dic['individual']['name']) > 0:
-            individual_name=line_dic['individual']['name']
-            if 'date_collected' in line_dic['individual'] and len(str(line_dic['individual']['date_collected'])) > 0:
-                line_dic['individual']['date_collected'] = format_date(str(line_dic['individual']['date_collected']))
-            #populate material table
-            if 'material' not in line_dic:
-                line_dic['material'] ={}
-            if 'name' not in line_dic['material'] or len(line_dic['material']['name'])==0:
-                line_dic['material']['name'] = line_dic['individual']['name']
-            if 'date_received' in line_dic['material'] and len(str(line_dic['material']['date_received'])) > 0:
-                line_dic['material']['date_received'] = format_date(str(line_dic['material']['date_received']))
-            if 'amount' in line_dic['material'] and len(str(line_dic['material']['amount'])) >0:
-                line_dic['material']['amount']=transform_weight_unit({'weight': line_dic['material']['amount'], 'unit': line_dic['material']['unit']})
-                line_dic['material']['unit']='g'
-            line_dic['individual']['name'] = individual_name
-            if verbose: logging.info("  - data for table individual: "+str(line_dic['individual']))
-            if 'species' in line_dic:
-                #if the taxon_id is not a number, then parse it as a common_name
-                if 'taxon_id' in line_dic['species']:
-                    try:
-                        tax_id = int(line_dic['species']['taxon_id'])
-                    except ValueError:
-                        line_dic['species']['common_name'] = line_dic['species']['taxon_id']
-                        del line_dic['species']['taxon_id']
-                #cases where genus, species and informal are provided: take precedent to name
-                if len(line_dic['species']['genus']) > 0:
-                    if len(line_dic['species']['informal'])>0 and not line_dic['species']['informal'].startswith("c.f."):
-                        line_dic['species']['informal']='"'+line_dic['species']['informal']+'"'
-                    line_dic['species']['name']=" ".join([line_dic['species'][x] for x in ['genus', 'species', 'informal'] if len(line_dic['species'][x]) > 0])
-                #cases where name is provided but not genus, species and informal
-                if len(line_dic['species']['name']) > 0 and len(line_dic['species']['genus']) == 0:
-                    name_part=line_dic['species']['name'].split(" ")
-                    line_dic['species']['genus']=name_part[0]
-                    if len(name_part) > 2:
-                        if name_part[1].startswith('c.f.'):
-                            line_dic['species']['informal'] = " ".join(name_part[1:])
-                        else:
-                            line_dic['species']['species']=name_part[1]
-                            line_dic['species']['informal'] = '"'+" ".join(name_part[2:])+'"'
-                #deal with case where name is too short (? or other)
-                if 'name' in line_dic['species'] and (len(line_dic['species']['name']) > 0 and  len(line_dic['species']['name'])< 4):
-                    del line_dic['species']
+        with open(spread_path, 'r', encoding='utf8', errors='replace') as file:
+            for line in file:
+                if line.startswith('option') or line.startswith('HEADER'):
+                    if line.startswith('HEADER'):
+                        firstColumn=1
+                    schema=HeaderSchema(adjust_header_list(line.rstrip()), firstColumn)
                 else:
-                    line_dic['species'] = update_Species_table(line_dic['species'])
-                if verbose: logging.info("  - data for table species: "+str(line_dic['species']))
-            if 'file' in line_dic:
-                if line_dic['file']['type']:
-                    line_dic['file']['type']='PE'
-                if 'exclusion' in line_dic['file'] and line_dic['file']['exclusion']:
-                    annotation_entry_dic['file']={'exclusion':line_dic['file']['exclusion']}
-                    del line_dic['file']['exclusion']
+                    if "test_entry" not in line:
+                        yield schema, line
 
-            if 'location' in line_dic and (len(line_dic['location']['latitude']) > 0 and len(line_dic['location']['longitude']) >0):
-                if verbose: logging.info("  => data for table location")
-                line_dic['location'] = format_to_compare(line_dic['location'])
-                if verbose: logging.info("  - data for table location: "+str(line_dic['location']))
-            #added this section to cope with the absence of project accession (required for website). Priority is previous entry/ies from spreadsheet then database and line entry.
-            if 'project' in line_dic and len(line_dic['project']['name']) > 0:
-                #attempts to get the accession from previous submission or from the database
-                if line_dic['project']['name'] in new_proj:
-                    project_acc=new_proj[line_dic['project']['name']]
-                else:
-                    proj_acc = studyDAO.getTableData("project", "accession", "name ='"+line_dic['project']['name'] +"';" )
-                    if len(proj_acc) > 0:
-                        project_acc=proj_acc[0]['accession']
-                    else:
-                        project_acc=""
-                        #if provided in entry sheet, use the entry
-                        if 'accession' in line_dic['project']:
-                            project_acc=line_dic['project']['accession']
-                #if there was no entry after parsing spreadsheet nor in the database: create an accession
-                if len(project_acc)==0:
-                    all_acc = studyDAO.getTableData("project", "accession", "accession like 'NYSUB%';" )
-                    #get data from the db if present
-                    if len(all_acc) >0:
-                        max_db_acc=max([x['accession'] for x in all_acc])
-                    else:
-                        max_db_acc=""
-                    max_new_acc=max(list(new_proj.values()))
-                    if len(max_db_acc) >0 or len(max_new_acc)>0:
-                        max_acc=max(max_db_acc, max_new_acc)
-                    else:
-                        max_acc="0"
-                    #get the length of the numeric part (not counting the 0)
-                    l=len(str(int(max_acc[5:])+1))
-                    max_all_acc="0"*(4-l)+str(int(max_acc[5:])+1)
-                    #prefix is NYSUB for Not Yet SUBmitted
-                    line_dic['project']['accession']="NYSUB"+max_all_acc
-                    new_proj[line_dic['project']['name']]=line_dic['project']['accession']
+def open_xlsx(spread_path):
+    '''
+    open a workbook read-only with the cached values of the formulas
+    : input spread_path (str) path to the .xlsx file
+    : return workbook (openpyxl Workbook)
+    '''
+    try:
+        return openpyxl.load_workbook(spread_path, read_only=True, data_only=True)
+    except ValueError as error:
+        if "stylesheet" not in str(error):
+            raise
+    #openpyxl rejects the font families above 14, e.g. <family val="34"/> in the workbooks saved from older versions of the template
+    logging.warning("Could not read the stylesheet of "+spread_path+", reading it again with the font families above 14 removed")
+    fixed_file = io.BytesIO()
+    with zipfile.ZipFile(spread_path) as source, zipfile.ZipFile(fixed_file, "w", zipfile.ZIP_DEFLATED) as target:
+        for item in source.infolist():
+            content = source.read(item)
+            if item.filename == "xl/styles.xml":
+                content = FONT_FAMILY_PATTERN.sub(lambda x: x.group(0) if int(x.group(1)) <= 14 else "", content.decode("utf8")).encode("utf8")
+            target.writestr(item, content)
+    fixed_file.seek(0)
+    return openpyxl.load_workbook(fixed_file, read_only=True, data_only=True)
+
+def xlsx_value(value):
+    '''
+    : input value (str, int, float, datetime or None) value of a workbook cell
+    : return value (str) value as written in the tab separated export of the template
+    '''
+    if value is None:
+        return ""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        #same format as the spreadsheet dates so that format_date converts it
+        return value.strftime("%d/%m/%Y")
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).replace("\t", " ").replace("\n", " ")
+
+def read_xlsx(spread_path):
+    '''
+    generator reading the rows of a workbook filled from CichlidDataBaseEntry_templateV2.xlsx without loading the whole workbook (read-only mode)
+    : input spread_path (str) path to the .xlsx file. The 'DataBase_entry' sheet is read (first sheet if absent); the rows above the first header (starting with 'option') are ignored
+    : return (tuple) (schema, line) for each data row, line being the row as a tab separated line
+    '''
+    if openpyxl is None:
+        logging.error("openpyxl is needed to read .xlsx files (pip install openpyxl), or export the sheet as tab separated values")
+        raise ImportError("openpyxl")
+    workbook = open_xlsx(spread_path)
+    try:
+        if 'DataBase_entry' in workbook.sheetnames:
+            sheet = workbook['DataBase_entry']
+        else:
+            sheet = workbook.worksheets[0]
+        schema = None
+        for row in sheet.iter_rows(values_only=True):
+            values = [xlsx_value(x) for x in row]
+            #as in the tab separated files, each header row applies to the rows below it
+            if len(values) > 0 and values[0] == 'option':
+                while values[-1] == "":
+                    values.pop()
+                schema = HeaderSchema(adjust_header_list("\t".join(values)))
+                continue
+            if schema is None:
+                continue
+            line = "\t".join(values[:len(schema.columns)])
+            if len(line.strip()) > 0 and "test_entry" not in line:
+                yield schema, line
+    finally:
+        workbook.close()
+
+def decode_line(schema, line):
+    '''
+    split one line of the spreadsheet into table records
+    : input schema (HeaderSchema) header of the line
+    : input line (str) line of the spreadsheet
+    : return line_dic (dic) {'table' : record}, None if the line has no individual name
+    '''
+    line=line.rstrip()
+    #parse the spreadsheet into table and field (after removing leading and trailing space(s))
+    line_dic=schema.decode(line)
+    #individual is the main table and name is the identifier. So if no name is present: do not insert
+    if 'individual' in line_dic and len(line_dic['individual']['name']) > 0:
+        #populate material table
+        if 'material' not in line_dic:
+            line_dic['material'] =Material()
+        if 'name' not in line_dic['material'] or len(line_dic['material']['name'])==0:
+            line_dic['material']['name'] = line_dic['individual']['name']
+        return line_dic
+    return None
+
+def format_dates(dates):
+    '''
+    column version of format_date: each distinct date of the column is converted once
+    : input dates (list) dates as provided in the spreadsheet
+    : return dates (list) dates formatted as YYYY-MM-DD
+    '''
+    formatted={}
+    for entry_date in dates:
+        if entry_date not in formatted:
+            formatted[entry_date]=format_date(entry_date)
+    return [formatted[x] for x in dates]
+
+def format_coordinates(values):
+    '''
+    reformat the latitude or longitude column to compare the values with the database (strings not ending by '0')
+    : input values (list) latitudes or longitudes
+    : return values (list) values as strings, without their last digit if equal to 0
+    '''
+    return [x[:-1] if x.endswith('0') else x for x in map(str, values)]
+
+def convert_weights(weights, units):
+    '''
+    convert the weights of a column to g at once (with numpy if it is installed)
+    : input weights (list) weights as provided in the spreadsheet
+    : input units (list) unit of each weight
+    : return weights (list) weights in g (unchanged if empty or not in mg, ug or kg)
+    '''
+    weights=list(weights)
+    rows=[i for i, unit in enumerate(units) if unit.lower() in WEIGHT_UNITS and len(str(weights[i])) > 0]
+    if len(rows) == 0:
+        return weights
+    factors=[WEIGHT_UNITS[units[i].lower()] for i in rows]
+    if numpy is not None:
+        values=numpy.array([str(weights[i]) for i in rows]).astype(float)
+        converted=(values*numpy.array([x[0] for x in factors], dtype=float)/numpy.array([x[1] for x in factors], dtype=float)).tolist()
+    else:
+        converted=[float(weights[i])*multiplier/divisor for i, (multiplier, divisor) in zip(rows, factors)]
+    for i, weight in zip(rows, converted):
+        weights[i]=weight
+    return weights
+
+def normalize_columns(line_dics):
+    '''
+    reformat the dates, weights and coordinates of consecutive lines one column at a time
+    : input line_dics (list) lines from decode_line, updated in place
+    '''
+    #only the weights use numpy: the dates are converted once per distinct value and the coordinates with one string test, which is faster than building the arrays
+    for table, field in (('individual', 'date_collected'), ('material', 'date_received')):
+        records=[x[table] for x in line_dics if table in x and len(x[table].get(field, "")) > 0]
+        for record, value in zip(records, format_dates([x[field] for x in records])):
+            record[field]=value
+    #the unit of the material is only changed if an amount is given, the one of the individual weight if the column is present
+    for table, field, all_rows in (('material', 'amount', False), ('individual_data', 'weight', True)):
+        records=[x[table] for x in line_dics if table in x and field in x[table] and (all_rows or len(x[table][field]) > 0)]
+        if len(records) == 0:
+            continue
+        for record, value in zip(records, convert_weights([x[field] for x in records], [x['unit'] for x in records])):
+            record[field]=value
+            record['unit']='g'
+        if verbose: logging.info("      - "+str(len(records))+" "+table+" "+field+"(s) converted to g")
+    records=[x['location'] for x in line_dics if 'location' in x and len(x['location']['latitude']) > 0 and len(x['location']['longitude']) > 0]
+    for field in ['latitude', 'longitude']:
+        for record, value in zip(records, format_coordinates([x[field] for x in records])):
+            record[field]=value
+    if verbose and len(records) > 0: logging.info("      + reformat latitude and longitude of "+str(len(records))+" location(s)")
+
+def finish_line(line_dic):
+    '''
+    reformat the species and files of a line and remove the empty fields. There is no database access here so that the lines can be normalized in parallel (see normalize_lines)
+    : input line_dic (dic) line from decode_line, after normalize_columns
+    : return (tuple) (individual_name, line_dic, annotation_dic)
+    '''
+    annotation_entry_dic={}
+    individual_name=line_dic['individual']['name']
+    if verbose: logging.info("  - data for table individual: "+str(line_dic['individual']))
+    if 'species' in line_dic:
+        #genus, species and informal are optional columns (not in CichlidDataBaseEntry_templateV2.xlsx)
+        for field in ['name', 'genus', 'species', 'informal']:
+            if field not in line_dic['species']:
+                line_dic['species'][field]=""
+        #if the taxon_id is not a number, then parse it as a common_name
+        if 'taxon_id' in line_dic['species']:
+            try:
+                tax_id = int(line_dic['species']['taxon_id'])
+            except ValueError:
+                line_dic['species']['common_name'] = line_dic['species']['taxon_id']
+                del line_dic['species']['taxon_id']
+        #cases where genus, species and informal are provided: take precedent to name
+        if len(line_dic['species']['genus']) > 0:
+            if len(line_dic['species']['informal'])>0 and not line_dic['species']['informal'].startswith("c.f."):
+                line_dic['species']['informal']='"'+line_dic['species']['informal']+'"'
+            line_dic['species']['name']=" ".join([line_dic['species'][x] for x in ['genus', 'species', 'informal'] if len(line_dic['species'][x]) > 0])
+        #cases where name is provided but not genus, species and informal
+        if len(line_dic['species']['name']) > 0 and len(line_dic['species']['genus']) == 0:
+            name_part=line_dic['species']['name'].split(" ")
+            line_dic['species']['genus']=name_part[0]
+            if len(name_part) > 2:
+                if name_part[1].startswith('c.f.'):
+                    line_dic['species']['informal'] = " ".join(name_part[1:])
                 else:
-                    line_dic['project']['accession']=project_acc
-                    new_proj[line_dic['project']['name']]=project_acc
-                if verbose: logging.info("  - data for table project: "+str(line_dic['project']))
-            #ensure that the weight, if provided, is in g unit:
-            if 'individual_data' in line_dic:
-                if 'weight' in line_dic['individual_data']:
-                    line_dic['individual_data']['weight']=transform_weight_unit({'weight': line_dic['individual_data']['weight'], 'unit': line_dic['individual_data']['unit']})
-                    line_dic['individual_data']['unit']='g'
-                    if verbose: logging.info("  - data for individual weight: "+str(line_dic['individual_data']))
-            #full copy of dictionary to be able to keep the newly created dictionary while modifying one copy
-            Line_dic=copy.deepcopy(line_dic)
-            #go through the content of the dictionary
-            for table in line_dic:
-                #go through the field for the considered table. Only keep field if there is value associated
-                for field in line_dic[table]:
-                    if not isinstance(line_dic[table][field], datetime.date) and not isinstance(line_dic[table][field], float):
-                        if len(line_dic[table][field]) == 0:
-                            del Line_dic[table][field]
-                    #deal with comment separately
-                    if field == 'comment' and len(line_dic[table][field]) > 0:
-                        if table not in ('image', 'individual', 'individual_data'):
-                            if table not in annotation_entry_dic:
-                                annotation_entry_dic[table]={}
-                            annotation_entry_dic[table][field]=line_dic[table][field]
-                            del Line_dic[table][field]
-                            if verbose: logging.info("  - comments for annotations table: "+str(annotation_entry_dic[table]))
-                        elif table=='individual':
-                            annotation_entry_dic['individual']={'comment':line_dic[table]['comment']}
-                            del Line_dic[table]['comment']
-                #remove table from dic if all is fields have no data associated
-                if len(Line_dic[table]) == 0:
-                    del Line_dic[table]
-            #Line_dic=ensure_data_continuity(Line_dic)
-            #ensure data are processed if same individual listed twice in spreadsheet
-            if individual_name in spread_dic:
-                spread_dic[individual_name].append(Line_dic)
+                    line_dic['species']['species']=name_part[1]
+                    line_dic['species']['informal'] = '"'+" ".join(name_part[2:])+'"'
+        #deal with case where name is too short (? or other)
+        if 'name' in line_dic['species'] and (len(line_dic['species']['name']) > 0 and  len(line_dic['species']['name'])< 4):
+            del line_dic['species']
+        elif verbose: logging.info("  - data for table species: "+str(line_dic['species']))
+    if 'file' in line_dic:
+        if line_dic['file']['type']:
+            line_dic['file']['type']='PE'
+        if 'exclusion' in line_dic['file'] and line_dic['file']['exclusion']:
+            annotation_entry_dic['file']={'exclusion':line_dic['file']['exclusion']}
+            del line_dic['file']['exclusion']
+
+    if verbose and 'location' in line_dic: logging.info("  - data for table location: "+str(line_dic['location']))
+    if verbose and 'individual_data' in line_dic: logging.info("  - data for individual weight: "+str(line_dic['individual_data']))
+    #go through the content of the dictionary
+    for table in list(line_dic):
+        #only keep field if there is value associated (the record is filtered in place, no copy needed)
+        record=line_dic[table].non_empty()
+        #deal with comment separately
+        if 'comment' in record:
+            if table not in ('image', 'individual', 'individual_data'):
+                if table not in annotation_entry_dic:
+                    annotation_entry_dic[table]={}
+                annotation_entry_dic[table]['comment']=record['comment']
+                del record['comment']
+                if verbose: logging.info("  - comments for annotations table: "+str(annotation_entry_dic[table]))
+            elif table=='individual':
+                annotation_entry_dic['individual']={'comment':record['comment']}
+                del record['comment']
+        #remove table from dic if all is fields have no data associated
+        if len(record) == 0:
+            del line_dic[table]
+    #line_dic=ensure_data_continuity(line_dic)
+    return individual_name, line_dic, annotation_entry_dic
+
+def complete_project(line_dic, new_proj, studyDAO):
+    '''
+    give the project of a normalized line an accession. Done in line order as the accessions depend on the database and on the previous lines
+    : input line_dic (dic) normalized line (see normalize_chunk)
+    : input new_proj (dic) project name: accession of the previous lines
+    : input studyDAO (connection object) object to connect to the database
+    '''
+    #added this section to cope with the absence of project accession (required for website). Priority is previous entry/ies from spreadsheet then database and line entry.
+    if 'project' in line_dic and 'name' in line_dic['project']:
+        #attempts to get the accession from previous submission or from the database
+        if line_dic['project']['name'] in new_proj:
+            project_acc=new_proj[line_dic['project']['name']]
+        else:
+            proj_acc = studyDAO.getTableData("project", "accession", "name = %s", data=(line_dic['project']['name'],))
+            if len(proj_acc) > 0:
+                project_acc=proj_acc[0]['accession']
+            else:
+                project_acc=""
+                #if provided in entry sheet, use the entry
+                if 'accession' in line_dic['project']:
+                    project_acc=line_dic['project']['accession']
+        #if there was no entry after parsing spreadsheet nor in the database: create an accession
+        if len(project_acc)==0:
+            all_acc = studyDAO.getTableData("project", "accession", "accession like 'NYSUB%';" )
+            #get data from the db if present
+            if len(all_acc) >0:
+                max_db_acc=max([x['accession'] for x in all_acc])
             else:
-                spread_dic[individual_name] =[Line_dic]
-            annotations_dic[individual_name]=[annotation_entry_dic]
-    if verbose: logging.info("READ DATA FOR "+str(spread_dic.keys()))
-    return spread_dic, annotations_dic, spreadsheet
+                max_db_acc=""
+            max_new_acc=max(list(new_proj.values()))
+            if len(max_db_acc) >0 or len(max_new_acc)>0:
+                max_acc=max(max_db_acc, max_new_acc)
+            else:
+                max_acc="0"
+            #get the length of the numeric part (not counting the 0)
+            l=len(str(int(max_acc[5:])+1))
+            max_all_acc="0"*(4-l)+str(int(max_acc[5:])+1)
+            #prefix is NYSUB for Not Yet SUBmitted
+            line_dic['project']['accession']="NYSUB"+max_all_acc
+            new_proj[line_dic['project']['name']]=line_dic['project']['accession']
+        else:
+            line_dic['project']['accession']=project_acc
+            new_proj[line_dic['project']['name']]=project_acc
+        if verbose: logging.info("  - data for table project: "+str(line_dic['project']))
+
+def normalize_chunk(chunk):
+    '''
+    normalize consecutive lines of the spreadsheet (in this process or in a worker process)
+    : input chunk (list) (schema, line) tuples from read_spreadsheet
+    : return (list) (individual_name, line_dic, annotation_dic) for each line, None if the line has no individual name
+    '''
+    line_dics=[decode_line(schema, line) for schema, line in chunk]
+    normalize_columns([x for x in line_dics if x is not None])
+    return [finish_line(x) if x is not None else None for x in line_dics]
+
+def read_chunks(lines, chunk_size):
+    #group the lines by chunks of chunk_size lines
+    chunk=[]
+    for entry in lines:
+        chunk.append(entry)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk=[]
+    if len(chunk) > 0:
+        yield chunk
+
+def init_worker(verbose_flag):
+    #the worker processes do not go through the command line parsing
+    global verbose
+    verbose=verbose_flag
+
+def normalize_lines(lines, workers=0, chunk_size=1000):
+    '''
+    generator normalizing the lines by chunks of chunk_size lines (the dates, weights and coordinates being converted one column at a time),
+    in parallel if workers > 1, the results being returned in the order of the lines
+    : input lines (iterator) (schema, line) tuples from read_spreadsheet
+    : input workers (int) number of processes (0 or 1 to normalize in this process)
+    : return (tuple) result of normalize_chunk for each line
+    '''
+    if workers <= 1:
+        for chunk in read_chunks(lines, chunk_size):
+            yield from normalize_chunk(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(verbose,)) as executor:
+        #only a few chunks are sent ahead so that the memory used does not depend on the size of the spreadsheet
+        pending=collections.deque()
+        for chunk in read_chunks(lines, chunk_size):
+            pending.append(executor.submit(normalize_chunk, chunk))
+            if len(pending) >= 2*workers:
+                yield from pending.popleft().result()
+        while len(pending) > 0:
+            yield from pending.popleft().result()
+
+def parse_lines(spread_path, studyDAO, workers=0):
+    '''
+    generator reformatting the spreadsheet data one line at a time
+    : input spread_path (str) absolute path to the spreadsheet
+    : input studyDAO (connection object) object to connect to the database
+    : input workers (int) number of processes normalizing the lines (0 to normalize them in this process)
+    : return (tuple) (individual_name, line_dic, annotation_dic) for each line with an individual name, line_dic being the dictionary {'table' :{'field' : value from datasheet}}
+             and annotation_dic the dictionary with table as key and dictionaries with header as key and corresponding data from spreadsheet as values
+    '''
+    new_proj={}
+    for normalized in normalize_lines(read_spreadsheet(spread_path), workers):
+        if normalized is None:
+            continue
+        complete_project(normalized[1], new_proj, studyDAO)
+        #same individual listed twice in spreadsheet: each line is processed in turn
+        yield normalized
 
-def prepare_update(update_dic):
+def parse_spreadsheet(spread_path, studyDAO, batch_size=500, workers=0):
     '''
-    Function to reformat a dictionary into update statement
+    generic function to open the spreadsheet and reformat the data
+    : input spread_path (str) absolute path to the spreadsheet
+    : input studyDAO (connection object) object to connect to the database
+    : input batch_size (int) number of lines whose species are resolved together (concurrent queries to NCBI)
+    : input workers (int) number of processes normalizing the lines (0 to normalize them in this process)
+    : return records (generator) (individual_name, line_dic, annotation_dic) for each line of the spreadsheet (see parse_lines), read as they are consumed
+    : return spreadsheet (str) name of the spreadsheet parsed
+    '''
+    spreadsheet = 'input_user'
+    if '1978536442' in spread_path:
+        spreadsheet = 'input_template'
+    return resolve_species(parse_lines(spread_path, studyDAO, workers), batch_size), spreadsheet
+
+def resolve_species(records, batch_size):
+    '''
+    generator completing the species data of the records by batches, so that only batch_size lines are held in memory
+    : input records (iterator) (individual_name, line_dic, annotation_dic) tuples
+    : return (tuple) the same tuples, with the species taxonomy completed
+    '''
+    batch=[]
+    read=0
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield from resolve_species_batch(batch)
+            read+=len(batch)
+            batch=[]
+    yield from resolve_species_batch(batch)
+    read+=len(batch)
+    if verbose: logging.info("READ DATA FOR "+str(read)+" LINES")
+
+def resolve_species_batch(batch):
+    species_list=[entry['species'] for individual_name, entry, annotations in batch if 'species' in entry]
+    #resolve the taxonomy of all the species of the batch at once (concurrent queries to NCBI)
+    TaxUtils.prefetch([species_query(x) for x in species_list])
+    for species in species_list:
+        update_Species_table(species)
+    return batch
+
+def prepare_update(update_dic, separator=", "):
+    '''
+    Function to reformat a dictionary into update statement (or where clause) with the values bound as parameters
     : input update_dic (dic) dictionary of fields to update
-    : return final_statement (str) <field> = <value>, <field> = <value>.
+    : input separator (str) ", " for the set part of an update, " and " for a where clause
+    : return final_statement (str) <field> = %s, <field> = %s.
+    : return values (list) value of each field, in the order of the statement
     '''
-    final_statement = ''
     if verbose: logging.info("      - preparing update for data: "+str(update_dic))
-    for field in update_dic:
-        final_statement += field+" = '" + str(update_dic[field]) +"', "
-    return final_statement[:-2]
-
-def transform_weight_unit(data_dic):
-    #the dictionary has two keys: unit and weight / value depending of data_dic
-    dic_keys=list(data_dic.keys())
-    #after removing the unit key, dic_keys will be weight / value depending of data_dic
-    dic_keys.remove('unit')
-    #if data_dic['unit'].lower() =='g':
-    new_weight=data_dic[dic_keys[0]]
-    if data_dic['unit'].lower() =='mg':
-        new_weight=float(data_dic[dic_keys[0]])/1000
-    elif data_dic['unit'].lower() =='ug' or data_dic['unit'].lower() =='µg':
-        new_weight=float(data_dic[dic_keys[0]])/1000000
-    elif data_dic['unit'].lower() =='kg':
-        new_weight=float(data_dic[dic_keys[0]])*1000
-    if verbose and new_weight!=data_dic[dic_keys[0]]: logging.info("      - weight changed from "+str(data_dic[dic_keys[0]])+" "+data_dic['unit'].lower()+" to "+str(new_weight)+"g")
-    return new_weight
+    final_statement = separator.join([field+" = %s" for field in update_dic])
+    return final_statement, [str(update_dic[field]) for field in update_dic]
 
 def update_entry(new_data, annotations_data, studyDAO):
     '''manage the fate of the data if 'update' flag has been provided'''
@@ -1000,26 +1186,23 @@ def update_entry(new_data, annotations_data, studyDAO):
             if table not in database_data:
                 if table != 'individual_data':
                     if verbose: logging.info(" A1- Insert into table "+table)
-                    #get the index of last entry in table
-                    previous_index=studyDAO.getmaxIndex(table)[0]['max('+table+'_id)']
-                    insert_data(table, new_data[table], previous_index, ","+table+"_id", ","+ str(previous_index+1), studyDAO)
-                    update_flag+=1
                     #update database_data with new index for entry
-                    novel_database_indexes[table]=previous_index+1
+                    novel_database_indexes[table]=insert_data(table, new_data[table], {table+"_id": studyDAO.next_id(table)}, studyDAO)
+                    update_flag+=1
                 else:
                     if 'weight' in new_data[table]:
                         if verbose: logging.info(" A2- Insert into table "+table+": weight")
-                        cv_id=studyDAO.getIndex('cv', 'attribute', "'weight'")[0]['cv_id']
+                        cv_id=studyDAO.getTableData('cv', 'cv_id', "attribute = %s", data=('weight',))[0]['cv_id']
                         value=new_data[table]['weight']
                         unit=new_data[table]['unit']
-                        individual_data_from_db=studyDAO.getStudyData("individual_data", "individual_id", str(novel_database_indexes["individual"]) +"' and cv_id ='"+str(cv_id))
+                        individual_data_from_db=studyDAO.getTableData("individual_data", "*", "individual_id = %s and cv_id = %s", data=(novel_database_indexes["individual"], cv_id))
                         #no data in the database so insert into the database
                         if len(individual_data_from_db)==0:
                             if len(str(value))>0:
-                                insert_data("individual_data", {"individual_id":str(novel_database_indexes["individual"]), "cv_id":str(cv_id), "value":str(value), "unit":unit}, ",", "", "", studyDAO)
+                                insert_data("individual_data", {"individual_id":str(novel_database_indexes["individual"]), "cv_id":str(cv_id), "value":str(value), "unit":unit}, {}, studyDAO)
                         else:
                             #get current data in the database
-                            data_to_update=studyDAO.getTableData("individual_data", 'value, unit', "individual_id = '"+str(novel_database_indexes["individual"]) +"' and cv_id ='"+str(cv_id)+"'")
+                            data_to_update=studyDAO.getTableData("individual_data", 'value, unit', "individual_id = %s and cv_id = %s", data=(novel_database_indexes["individual"], cv_id))
                             #ensure that we are comparing the weight value properly
                             if float(new_data[table]['weight']) != float(data_to_update[0]['value']):
                                 update_individual_data(individual_data_from_db, new_data[table]['weight'], studyDAO)
@@ -1030,18 +1213,18 @@ def update_entry(new_data, annotations_data, studyDAO):
     #deal with comments fields for the annotations table
     for table in annotations_data:
         #get the cv_ids for the tables with comment
-        cv_id=studyDAO.getIndex('cv', 'comment', "'entry for table "+table+"'")[0]['cv_id']
+        cv_id=studyDAO.getTableData('cv', 'cv_id', "comment = %s", data=('entry for table '+table,))[0]['cv_id']
         if table != 'individual':
-            annotations_data_from_db=studyDAO.getStudyData("annotations", "table_name = '" +table+"' and cv_id = "+str(cv_id)+" and table_id", novel_database_indexes[table])
+            annotations_data_from_db=studyDAO.getTableData("annotations", "*", "table_name = %s and cv_id = %s and table_id = %s", data=(table, cv_id, novel_database_indexes[table]))
             #if no data in database: insert the comments
             if len(annotations_data_from_db) ==0:
                 to_insert_dic={"table_name":table, "table_id": novel_database_indexes[table], "cv_id":cv_id, "value": annotations_data[table]}
-                insert_data(table, to_insert_dic, ",","","", studyDAO)
+                insert_data(table, to_insert_dic, {}, studyDAO)
             #if data: compare and update
             else:
                 annotations_flag, index = compare_and_update_data("table", {"value":annotations_data[table]}, annotations_data_from_db[0], studyDAO)
         else:
-            annotations_data_from_db=studyDAO.getStudyData("individual_data", "cv_id = "+str(cv_id)+ " and individual_id ", novel_database_indexes[table])
+            annotations_data_from_db=studyDAO.getTableData("individual_data", "*", "cv_id = %s and individual_id = %s", data=(cv_id, novel_database_indexes[table]))
             update_individual_data(annotations_data_from_db, annotations_data[table], studyDAO)
         update_flag+=1
     if verbose: logging.info(" "+str(update_flag)+" update(s) took place")
@@ -1058,13 +1241,44 @@ def update_individual_data(db_data, new_data, studyDAO):
     data_updated[0]['unit']='g'
     data_updated[0]['value']=new_data
     if verbose: logging.info("      - inserting new data: "+str(data_updated[0]))
-    insert_data("individual_data", data_updated[0], ",", "","", studyDAO)
+    insert_data("individual_data", data_updated[0], {}, studyDAO)
     if verbose: logging.info("      - updating previous data: "+str(list(db_data)))
-    try:
-        studyDAO.update("individual_data", "changed ='"+today+"', latest =0", "row_id", entry_to_update)
-    except:
-        logging.info("Could not update the comment in the individual data table from the database. Existing now")
-        sys.exit()
+    #sent with the other updates of the entry before it is committed (see dispatch_data), or before the next select of individual_data
+    studyDAO.queue_update("individual_data", "row_id", entry_to_update, "changed", today)
+    studyDAO.queue_update("individual_data", "row_id", entry_to_update, "latest", 0)
+
+def clean_species_name(name):
+    '''
+    : input name (str) species name from the spreadsheet or json
+    : return name (str) name without 'sp.', 'cf.' or 'c.f.' and extra spaces, as sent to the taxonomy server
+    '''
+    return re.sub(r"\s\s+" , " ", name.replace("sp.","").replace("c.f.","").replace("cf.",""))
+
+def match_species_name(name):
+    '''
+    : input name (str) species name cleaned by clean_species_name
+    : return name (str) spelling of the known species within speciesMatchDistance edits of the name (name itself if there is none)
+    '''
+    if species_index is None:
+        return name
+    match = species_index.match(name)
+    if match is None:
+        return name
+    return match
+
+def species_query(dic):
+    '''
+    : input dic (dic) dictionary of ['field' : value] for species table of the spreadsheet
+    : return query (str) name or taxon_id the species taxonomy is obtained with ("" if none)
+    '''
+    if 'name' in dic and dic['name'] != "":
+        name=clean_species_name(dic['name'])
+        if len(name) > 2:
+            return match_species_name(name)
+        return ""
+    elif 'taxon_id' in dic and dic['taxon_id'] != "":
+        return str(dic['taxon_id'])
+    return ""
 
 def update_Species_table(dic):
     '''Function to populate the species information with data from reference sources'''
@@ -1083,34 +1297,48 @@ def update_Species_table(dic):
     elif 'taxon_id' in dic and dic['taxon_id'] != "":
         ENA_taxo = TaxUtils.getTaxid(dic['taxon_id'])
         if ENA_taxo:
-            dic['strain'] = ENA_taxo[2].replace("'","\"")
+            dic['strain'] = ENA_taxo[2]
             dic['taxon_position'] = ENA_taxo[0]
     '''
-    old_dic=copy.deepcopy(dic)
+    old_dic=dict(dic)
     # fonction using NCBI taxonomy server
     #   return dic (dic) updated dictionary with the taxonomy completed i.e. taxon_id or name if strain or taxon_id are provided, respectively, plus the taxon position and common name.
     if 'name' in dic and dic['name'] != "":
-        dic['name']=re.sub("\s\s+" , " ", dic['name'].replace("sp.","").replace("c.f.","").replace("cf.",""))
+        dic['name']=clean_species_name(dic['name'])
         if len(dic['name']) > 2:
+            #spelling variant of a known species: use the existing name (and row)
+            name=match_species_name(dic['name'])
+            if name != dic['name']:
+                #logged for the curators to check that two different species were not merged
+                logging.warning("Species name '"+dic['name']+"' replaced by the known species '"+name+"'")
+                dic['name']=name
+                name_part=name.split(" ")
+                if 'genus' in dic:
+                    dic['genus']=name_part[0]
+                if 'species' in dic and len(name_part) > 1 and not name_part[1].startswith('"'):
+                    dic['species']=name_part[1]
             result_list = TaxUtils.getTaxid(dic['name'])
             if len(result_list) > 0:
                 if result_list[1] != "":
-                    dic['common_name']=result_list[1].replace("'","\"")
+                    dic['common_name']=result_list[1]
                 if result_list[2] !=  "":
                     dic['taxon_position']=result_list[2]
                 if result_list[3] != 0 and 'taxon_id' not in dic:
                     dic['taxon_id']=result_list[3]
+                #later variants of a name new to the database are matched to it
+                if result_list[3] != 0 and species_index is not None:
+                    species_index.add(dic['name'])
         else:
             del dic['name']
     elif 'taxon_id' in dic and dic['taxon_id'] != "":
         result_list = TaxUtils.getTaxid(dic['taxon_id'])
         if len(result_list) > 0:
             if result_list[1] != "":
-                dic['common_name']=result_list[1].replace("'","\"")
+                dic['common_name']=result_list[1]
             if result_list[2] !=  "":
                 dic['taxon_position']=result_list[2]
             if result_list[0] != "":
-                dic['name']=result_list[0].replace("'","\"")
+                dic['name']=result_list[0]
     if verbose: logging.info("      - update species name from "+str(old_dic)+" to  "+str(dic))
     return dic
 
@@ -1119,28 +1347,65 @@ def main(programSetup):
     config_file_path = programSetup.config_file_path
     #Not in use but could be used to set up working directory: root_result_dir_path = programSetup.root_result_dir_path
     # Create data access object
-    mydbconn = pymysql.connect(user=configSettings["vpUser"], password=configSettings["vpPassword"],
-                               host=configSettings["vpHost"], port=int(configSettings["vpPort"]),
-                               db=configSettings["vpInstance"], autocommit=False,
-                               cursorclass=pymysql.cursors.DictCursor)
+    pool = MySQLConnectionPool.from_config(configSettings)
+    #the connections are borrowed per unit of work (start-up reads, record or source, lineage) rather than for the whole run
+    mydbconn = pool.borrow()
     dataAccessObjectForVP = MySQLDataAccessObject(mydbconn)
-    studyDAO = StudyDAO.StudyDAO(dataAccessObjectForVP)
+    id_allocator = BlockIdAllocator.from_config(pool, configSettings)
+    #the rows are inserted one at a time (no insert batch) so that a failed insert is reported by the operation that made it
+    studyDAO = StudyDAO.StudyDAO(dataAccessObjectForVP, 0, cache_size, id_allocator)
+    #taxonomy results from previous runs, completed with the species already in the database
+    TaxUtils.open_cache(taxonomy_cache, int(configSettings.get("taxonomyCacheDays", 90))*24*3600, int(configSettings.get("taxonomyCacheSize", 100000)),
+                        int(configSettings.get("taxonomyNegativeCacheDays", 7))*24*3600)
+    TaxUtils.cache.warm(studyDAO.getTableData("species", "name, taxon_id, common_name, taxon_position", "taxon_id is not null"))
+    #spelling variants of the species names are matched to the species already in the database
+    global species_index
+    species_index = SpeciesNameIndex([x['name'] for x in studyDAO.getTableData("species", "name", "name is not null")], int(configSettings.get("speciesMatchDistance", 0)))
+    #NCBI outage: after taxonomyMaxFailures failed requests only the cached results are used for taxonomyRetryAfter seconds
+    TaxUtils.open_breaker(float(configSettings.get("taxonomyTimeout", 30)), int(configSettings.get("taxonomyMaxFailures", 5)), float(configSettings.get("taxonomyRetryAfter", 300)))
+    TaxUtils.open_resolver(int(configSettings.get("taxonomyWorkers", 8)), float(configSettings.get("taxonomyRate", 3)))
+    #offline taxonomy (see Taxdump_taxonomy.py) if an index is provided
+    if configSettings.get("taxdumpIndex"):
+        TaxUtils.open_taxdump(configSettings["taxdumpIndex"])
+    pool.release(mydbconn)
     raw_sp_results ={}
     insert_flag =[]
     #call for spreadsheet parsing and inserting/updating
     if spath:
         #open spreadsheet url
         if verbose: logging.info("Opening the spreadsheet")
-        raw_sp_results, for_annotations, spreadsheet_name = parse_spreadsheet(spath, studyDAO)
-        dispatch_data(raw_sp_results, for_annotations, spreadsheet_name, studyDAO, mydbconn)
+        records, spreadsheet_name = parse_spreadsheet(spath, studyDAO, workers=workers)
+        dispatch_data(records, spreadsheet_name, studyDAO, pool)
+    inserted_rows, rows_per_second = studyDAO.insert_rate()
+    logging.info(str(inserted_rows)+" rows inserted ("+str(rows_per_second)+" rows/s)")
+    #lineage of the species new to the taxon_lineage closure table
+    with pool.connection() as mydbconn:
+        dataAccessObjectForVP.useConnection(mydbconn)
+        if LineageClosure(dataAccessObjectForVP).refresh(TaxUtils.getLineages) > 0:
+            mydbconn.commit()
+            studyDAO.invalidate("taxon_lineage")
+    cache_hits, cache_misses = studyDAO.cache_stats()
+    logging.info(str(cache_hits)+" queries answered from the cache, "+str(cache_misses)+" sent to the database")
+    logging.info(str(TaxUtils.cache.hits)+" taxonomy queries answered from "+taxonomy_cache+", "+str(TaxUtils.cache.misses)+" sent to NCBI")
+    if TaxUtils.breaker.skipped > 0:
+        logging.warning(str(TaxUtils.breaker.skipped)+" taxonomy queries not sent while NCBI was failing")
+    TaxUtils.close_cache()
+    TaxUtils.close_resolver()
+    pool.close()
     if verbose: logging.info("End of run")
 
 if __name__ == '__main__':
     # Parse script parameters and run program setup
     parser = argparse.ArgumentParser(
         description="Cichlid_db_update import input spreadsheet onto the Cichlid_TRACKING database")
-    parser.add_argument("-sp", "--spreadsheet", help="spreadsheet path or input")
+    parser.add_argument("-sp", "--spreadsheet", help="spreadsheet path (tab separated or .xlsx) or input")
     parser.add_argument("-v", "--verbose", help="verbose mode", action = 'store_true')
+    parser.add_argument("-q", "--cache_size", type=int, default=1000,
+                        help="number of query results kept in memory (0 to disable the cache)")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="number of processes normalizing the spreadsheet lines (0 to use only this process)")
+    parser.add_argument("-t", "--taxonomy_cache", default="taxonomy_cache.sqlite",
+                        help="SQLite file keeping the NCBI taxonomy results between runs")
     parser.add_argument("-c", "--config",
                         type=argparse.FileType('r'),
                         help="path to config file",
@@ -1174,5 +1439,9 @@ if __name__ == '__main__':
             spath = args['spreadsheet']
     verbose=False
     if args['verbose']: verbose= True
+    cache_size=args['cache_size']
+    taxonomy_cache=args['taxonomy_cache']
+    workers=args['workers']
+    species_index=None
     flag=False
     main(programSetup)
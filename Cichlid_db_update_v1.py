@@ -11,6 +11,7 @@ import re
 import datetime
 from urllib.request import urlopen
 from dao.mysql.mysql_db_access_object import MySQLDataAccessObject
+from dao.mysql.mysql_connection_pool import MySQLConnectionPool
 from dao.mysql import StudyDAO
 import Get_taxonomy_from_NCBI as TaxUtils
 import copy
@@ -732,11 +733,9 @@ def main(programSetup):
     config_file_path = programSetup.config_file_path
     #Not in use but could be used to set up working directory: root_result_dir_path = programSetup.root_result_dir_path
     # Create data access object
-    mydbconn = pymysql.connect(user=configSettings["vpUser"], password=configSettings["vpPassword"],
-                               host=configSettings["vpHost"], port=int(configSettings["vpPort"]),
-                               db=configSettings["vpInstance"], autocommit=False,
-                               cursorclass=pymysql.cursors.DictCursor)
-    dataAccessObjectForVP = MySQLDataAccessObject(mydbconn)
+    pool = MySQLConnectionPool.from_config(configSettings)
+    #a connection is borrowed per source (checked, and reopened if the server closed it) rather than for the whole run
+    dataAccessObjectForVP = MySQLDataAccessObject(None)
     studyDAO = StudyDAO.StudyDAO(dataAccessObjectForVP)
     #call for json file parsing and inserting/updating
     jresults = {}
@@ -746,15 +745,20 @@ def main(programSetup):
         #open and parse json file
         if verbose:
             logging.info("Opening the json file")
-        raw_j_results, json_name = parse_json(jpath, studyDAO)
-        populate_database(raw_j_results, json_name, studyDAO, verbose, mydbconn)
+        with pool.connection() as mydbconn:
+            dataAccessObjectForVP.useConnection(mydbconn)
+            raw_j_results, json_name = parse_json(jpath, studyDAO)
+            populate_database(raw_j_results, json_name, studyDAO, verbose, mydbconn)
     #call for spreadsheet parsing and inserting/updating
     if len(spath) >0:
         #open spreadsheet url
         if verbose:
             logging.info("Opening the spreadsheet url")
-        raw_sp_results, spreadsheet_name = parse_spreadsheet(spath, studyDAO)
-        populate_database(raw_sp_results, spreadsheet_name, studyDAO, verbose, mydbconn)
+        with pool.connection() as mydbconn:
+            dataAccessObjectForVP.useConnection(mydbconn)
+            raw_sp_results, spreadsheet_name = parse_spreadsheet(spath, studyDAO)
+            populate_database(raw_sp_results, spreadsheet_name, studyDAO, verbose, mydbconn)
+    pool.close()
     if verbose:
         logging.info("End of run")
 
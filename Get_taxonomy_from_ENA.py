@@ -2,35 +2,134 @@
 
 
 from urllib.request import urlopen
-import sys
-from xml.dom import minidom
 import xml.etree.ElementTree as ET
+from Taxonomy_resolver import TaxonomyResolver
+
+#ENA browser API (can be replaced by a local server for testing)
+ENA_URL = "http://www.ebi.ac.uk/ena/data/view/"
+#seconds a request may take
+timeout = 30
+
+def getTaxids(queries, chunk_size=50, max_workers=4, rate=3.0):
+	'''
+	resolve many names or taxids with one ENA request per chunk of queries (chunks sent concurrently)
+	: input queries (list) names or taxids
+	: input chunk_size (int) number of taxa asked in one request
+	: return results (dic) query: [rank, taxId, scientificName, commonName] (empty list if not found or the request failed)
+	'''
+	distinct = list(dict.fromkeys([str(query).strip() for query in queries if str(query).strip()]))
+	chunks = [tuple(distinct[i:i+chunk_size]) for i in range(0, len(distinct), max(chunk_size, 1))]
+	results = {}
+	resolver = TaxonomyResolver(fetchTaxa, max_workers, rate)
+	try:
+		for chunk_results in resolver.resolve(chunks).values():
+			results.update(chunk_results)
+	finally:
+		resolver.close()
+	return results
+
+def fetchTaxa(queries):
+	'''
+	send one multi-taxon request (Taxon:a,Taxon:b,...) and match every taxon of the answer to its query
+	: input queries (list) names or taxids
+	: return results (dic) query: [rank, taxId, scientificName, commonName] (empty list if not found or the request failed)
+	'''
+	results = {query: list() for query in queries}
+	#a taxon is found by its taxid, scientific name or common name
+	lookup = {query.replace("+"," ").lower(): query for query in queries}
+	url = ENA_URL+"Taxon:"+",Taxon:".join([query.replace(" ","+") for query in queries])+"&display=xml"
+	try:
+		connection_socket = urlopen(url, timeout=timeout)
+		for taxon in iterTaxa(connection_socket):
+			for key in (taxon[1], taxon[2].lower(), taxon[3].lower()):
+				if key in lookup and len(results[lookup[key]]) == 0:
+					results[lookup[key]] = taxon
+		connection_socket.close()
+	except:
+		return results
+	return results
+
+def iterTaxa(xml_file):
+	#yield [rank, taxId, scientificName, commonName] for the top level taxon elements while the xml is read (lineage taxa are skipped)
+	depth = 0
+	for event, element in ET.iterparse(xml_file, events=("start", "end")):
+		if event == "start":
+			depth += 1
+			if depth == 2 and element.tag == "taxon":
+				yield [element.get("rank", ""), element.get("taxId", ""), element.get("scientificName", ""), element.get("commonName", "")]
+		else:
+			depth -= 1
+			#free the elements already read
+			if depth <= 1:
+				element.clear()
+
+def getLineages(taxids, chunk_size=50, max_workers=4, rate=3.0):
+	'''
+	get the lineage of many taxids with one ENA request per chunk of taxids
+	: input taxids (list) taxids
+	: return lineages (dic) taxid: [[taxId, scientificName, rank], ...] from the taxid itself up to the root (empty list if not found or the request failed)
+	'''
+	distinct = list(dict.fromkeys([str(taxid).strip() for taxid in taxids if str(taxid).strip()]))
+	chunks = [tuple(distinct[i:i+chunk_size]) for i in range(0, len(distinct), max(chunk_size, 1))]
+	lineages = {}
+	resolver = TaxonomyResolver(fetchLineages, max_workers, rate)
+	try:
+		for chunk_lineages in resolver.resolve(chunks).values():
+			lineages.update(chunk_lineages)
+	finally:
+		resolver.close()
+	return lineages
+
+def fetchLineages(taxids):
+	#one multi-taxon request for the lineages of the taxids
+	lineages = {taxid: list() for taxid in taxids}
+	url = ENA_URL+"Taxon:"+",Taxon:".join(taxids)+"&display=xml"
+	try:
+		connection_socket = urlopen(url, timeout=timeout)
+		for lineage in iterLineages(connection_socket):
+			if lineage[0][0] in lineages:
+				lineages[lineage[0][0]] = lineage
+		connection_socket.close()
+	except:
+		return lineages
+	return lineages
+
+def iterLineages(xml_file):
+	#yield [[taxId, scientificName, rank], ...] for each top level taxon followed by the taxa of its lineage (listed by ENA from the parent up to the root)
+	#the taxa of the children element are skipped
+	depth = 0
+	lineage = []
+	in_lineage = False
+	for event, element in ET.iterparse(xml_file, events=("start", "end")):
+		if event == "start":
+			depth += 1
+			if depth == 3:
+				in_lineage = element.tag == "lineage"
+			if element.tag == "taxon" and (depth == 2 or (depth == 4 and in_lineage and len(lineage) > 0)):
+				lineage.append([element.get("taxId", ""), element.get("scientificName", ""), element.get("rank", "")])
+		else:
+			depth -= 1
+			if depth == 2:
+				in_lineage = False
+			if depth == 1:
+				if element.tag == "taxon" and len(lineage) > 0:
+					yield lineage
+				lineage = []
+				element.clear()
 
 def getTaxid(user_input):
 	#created by H.DENISE 15-11-18#
 	#replace space with "+" in scientifc name
 	query=user_input.replace(" ","+")
 	#check if a list has been provided and reformat it appropriately
-	if len(query.split(",")) > 1:
-		for i in range(0, len(query.split(","))):
-			if i==0:Query=query.split(",")[0]
-			elif len(query.split(",")[i]) > 0 :
-				Query=Query+",Taxon:"+query.split(",")[i]
-	else : Query = query
-	#Declaration
-	CleanSet=[]
-	tag = 0
-	lineage_tables = {}
-	lineage_tables["query"]=[]
-	taxo_rank = ["superkingdom","phylum","class","order","family","genus","species"]
-	#send back request to ENA and get xml(s) in return
-	url = "http://www.ebi.ac.uk/ena/data/view/Taxon:"+Query+"&display=xml"
+	queries = [x for x in query.split(",") if len(x) > 0]
+	#send back request to ENA and get the first taxon of the xml in return
+	url = ENA_URL+"Taxon:"+",Taxon:".join(queries)+"&display=xml"
 	try:
-		connection_socket = urlopen(url)
-		xml_doc = minidom.parse(connection_socket)
+		connection_socket = urlopen(url, timeout=timeout)
+		res = next(iterTaxa(connection_socket), None)
 		connection_socket.close()
-		res= (xml_doc.getElementsByTagName("taxon"))
 	except:
 		return list()
-	if len(res) > 0:
-		return ([res[0].getAttribute("rank"), res[0].getAttribute("taxId"), res[0].getAttribute("scientificName"), res[0].getAttribute("commonName")])
+	if res is not None:
+		return res
@@ -1,52 +1,338 @@
 #!/Library/Frameworks/Python.framework/Versions/3.7/bin/python3
 
 
-from urllib.request import urlopen
-import sys
-from xml.dom import minidom
-import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+import http.client
+import re
+import time
+import sqlite3
+import threading
+from Taxonomy_resolver import TaxonomyResolver, CircuitBreaker
+from Taxdump_taxonomy import TaxdumpTaxonomy
+import Get_taxonomy_from_ENA
+
+#NCBI taxonomy browser (can be replaced by a local server for testing)
+NCBI_URL = "https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi"
+
+#seconds a request may take and breaker stopping the requests while NCBI keeps failing (see open_breaker)
+timeout = 30
+breaker = CircuitBreaker()
+
+#pages are read by chunks of CHUNK_SIZE bytes; once the fields are found the rest is read (to keep the connection) only if smaller than DRAIN_LIMIT
+CHUNK_SIZE = 8192
+DRAIN_LIMIT = 65536
+#one keep-alive connection per thread, all of them being closed by close_connections
+connections = threading.local()
+open_connections = set()
+connections_lock = threading.Lock()
+#lines of the taxonomy page holding the fields
+TITLE_PATTERN = re.compile(r'<title>Taxonomy browser \((.*)\)</title>')
+COMMON_NAME_PATTERN = re.compile(r'^Genbank common name: <strong>(.*?)</str')
+RANK_PATTERN = re.compile(r'>Rank:(?:\s|<[^>]*>)*([^<]*)</str')
+TAXID_PATTERN = re.compile(r'^Taxonomy ID: (.*?)<small>')
+
+#persistent cache of the results, opened by open_cache (None: every query is sent to NCBI)
+cache = None
+#concurrent resolver used by prefetch, opened by open_resolver, and results prefetched during this run
+resolver = None
+resolved = {}
+#offline taxonomy answering instead of NCBI, opened by open_taxdump
+taxdump = None
+
+class TaxonomyCache:
+	'''
+	SQLite file holding the [title, common_name, rank, taxid] returned by getTaxid, keyed by normalized name and by taxid
+	: input path (str) path of the SQLite file (created if needed)
+	: input ttl (int) number of seconds a result is used before being fetched again
+	: input max_entries (int) maximum number of results kept, the least recently stored ones being removed first
+	: input negative_ttl (int) number of seconds an unknown name (no taxid) is not queried again
+	'''
+	def __init__(self, path, ttl=90*24*3600, max_entries=100000, negative_ttl=7*24*3600):
+		self.ttl = ttl
+		self.negative_ttl = negative_ttl
+		self.max_entries = max_entries
+		self.connection = sqlite3.connect(path)
+		self.connection.execute("CREATE TABLE IF NOT EXISTS taxonomy (query text PRIMARY KEY, title text, common_name text, rank text, taxid text, stored real)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS taxonomy_stored ON taxonomy (stored)")
+		self.connection.commit()
+		self.hits = 0
+		self.misses = 0
+
+	def key(self, user_input):
+		#names are compared without case and extra spaces, taxids as numbers
+		return " ".join(str(user_input).lower().split())
+
+	def get(self, user_input, count=True):
+		row = self.connection.execute("SELECT title, common_name, rank, taxid, stored FROM taxonomy WHERE query = ?", (self.key(user_input),)).fetchone()
+		negative = row is not None and row[3] in ("", "0")
+		if row is None or time.time() - row[4] > (self.negative_ttl if negative else self.ttl):
+			if count: self.misses += 1
+			return None
+		if count: self.hits += 1
+		#unknown names come back as fetchTaxid returns them, with taxid 0
+		if negative:
+			return [row[0], row[1], row[2], 0]
+		return list(row[:4])
+
+	def rows(self, user_input, result, stored):
+		#the result is also stored under its taxid so that a later query by taxid finds it
+		keys = set([self.key(user_input)])
+		if str(result[3]) not in ("", "0"):
+			keys.add(self.key(result[3]))
+		return [(key, result[0], result[1], result[2], str(result[3]), stored) for key in keys]
+
+	def put(self, user_input, result, replace=True):
+		verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+		self.connection.executemany(verb+" INTO taxonomy VALUES (?, ?, ?, ?, ?, ?)", self.rows(user_input, result, time.time()))
+		self.connection.commit()
+
+	def prune(self):
+		#remove the expired results then the oldest ones above max_entries
+		self.connection.execute("DELETE FROM taxonomy WHERE stored < ? OR (taxid IN ('', '0') AND stored < ?)", (time.time() - self.ttl, time.time() - self.negative_ttl))
+		self.connection.execute("DELETE FROM taxonomy WHERE query IN (SELECT query FROM taxonomy ORDER BY stored DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+		self.connection.commit()
+
+	def warm(self, species_rows):
+		'''
+		store the species already in the database (existing results are kept)
+		: input species_rows (list) dictionaries with the name, taxon_id, common_name and taxon_position of the species table
+		'''
+		#all the rows are written in one transaction (one commit instead of one per species)
+		stored = time.time()
+		rows = []
+		for row in species_rows:
+			if row['name'] and row['taxon_id']:
+				rows.extend(self.rows(row['name'], [row['name'], row['common_name'] or "", row['taxon_position'] or "", str(row['taxon_id'])], stored))
+		self.connection.executemany("INSERT OR IGNORE INTO taxonomy VALUES (?, ?, ?, ?, ?, ?)", rows)
+		self.connection.commit()
+
+	def close(self):
+		self.prune()
+		self.connection.close()
+
+def open_cache(path, ttl=90*24*3600, max_entries=100000, negative_ttl=7*24*3600):
+	#make getTaxid use a persistent cache
+	global cache
+	cache = TaxonomyCache(path, ttl, max_entries, negative_ttl)
+	cache.prune()
+	return cache
+
+def close_cache():
+	global cache
+	if cache is not None:
+		cache.close()
+		cache = None
+
+def open_taxdump(index_dir):
+	#answer the queries from an index built by Taxdump_taxonomy.py instead of NCBI
+	global taxdump
+	taxdump = TaxdumpTaxonomy(index_dir)
+	return taxdump
+
+def open_breaker(request_timeout=30, max_failures=5, reset_after=300):
+	#limit each request to request_timeout seconds and answer from the caches only for reset_after seconds after max_failures failed requests in a row
+	global timeout, breaker
+	timeout = request_timeout
+	breaker = CircuitBreaker(max_failures, reset_after)
+	return breaker
+
+def open_resolver(max_workers=8, rate=3.0):
+	#make prefetch send up to max_workers queries at the same time, no more than rate per second
+	global resolver
+	resolver = TaxonomyResolver(fetchTaxid, max_workers, rate)
+	return resolver
+
+def close_resolver():
+	#stop the threads of prefetch and close the keep-alive connections
+	global resolver
+	if resolver is not None:
+		resolver.close()
+		resolver = None
+	close_connections()
+
+def prefetch(queries):
+	#resolve concurrently the queries which are not cached yet so that the following getTaxid calls do not wait on NCBI
+	if resolver is None or taxdump is not None:
+		return
+	todo = [str(query) for query in queries if query and " ".join(str(query).lower().split()) not in resolved]
+	if cache is not None:
+		todo = [query for query in todo if cache.get(query, count=False) is None]
+	for query, result in resolver.resolve(todo).items():
+		if len(result) > 0:
+			resolved[" ".join(query.lower().split())] = result
+			if cache is not None:
+				cache.put(query, result)
+
+def getLineages(taxids):
+	'''
+	lineages of the taxids, from the offline taxonomy if open, otherwise from ENA (by batches of taxids)
+	: input taxids (list) taxids
+	: return lineages (dic) taxid: [[taxid, scientific name, rank], ...] from the taxid itself up to the root (empty list if unknown)
+	'''
+	if taxdump is None:
+		return Get_taxonomy_from_ENA.getLineages(taxids)
+	lineages = {}
+	for taxid in taxids:
+		lineages[str(taxid)] = list()
+		if str(taxid).isdigit():
+			for ancestor in taxdump.lineage(int(taxid)):
+				taxon = taxdump.taxon(ancestor)
+				lineages[str(taxid)].append([taxon[3], taxon[0], taxon[2]])
+	return lineages
 
 def getTaxid(user_input):
+	#return the cached or prefetched result if there is one, otherwise query NCBI
+	if taxdump is not None:
+		return taxdump.getTaxid(user_input)
+	if cache is not None:
+		result = cache.get(user_input)
+		if result is not None:
+			return result
+	if " ".join(str(user_input).lower().split()) in resolved:
+		return resolved[" ".join(str(user_input).lower().split())]
+	result = fetchTaxid(user_input)
+	#failure returns an empty list and is not kept, unknown names (no taxid) are kept for negative_ttl only
+	if len(result) > 0:
+		resolved[" ".join(str(user_input).lower().split())] = result
+		if cache is not None:
+			cache.put(user_input, result)
+	return result
+
+class TaxonomyPageParser:
+	'''
+	extract [title, common_name, rank, taxid] from the taxonomy browser page fed by chunks
+	'''
+	def __init__(self):
+		self.buffer = b""
+		self.title = ""
+		self.common_name = ""
+		self.rank = ""
+		self.taxid = 0
+
+	def done(self):
+		#most taxa have no Genbank common name so it is not waited for
+		return self.title != "" and self.rank != "" and self.taxid != 0
+
+	def feed(self, chunk):
+		#only the complete lines are parsed, the last one waits for the next chunk
+		lines = (self.buffer + chunk).split(b"\n")
+		self.buffer = lines.pop()
+		for line in lines:
+			self.parse_line(line)
+
+	def close(self):
+		self.parse_line(self.buffer)
+		self.buffer = b""
+
+	def parse_line(self, line):
+		line = line.decode("utf8")
+		if '<title>' in line:
+			match = TITLE_PATTERN.search(line)
+			if match:
+				self.title = match.group(1)
+		elif line.startswith('Genbank common name'):
+			match = COMMON_NAME_PATTERN.match(line)
+			if match:
+				self.common_name = match.group(1)
+		elif line.startswith('Taxonomy ID'):
+			match = TAXID_PATTERN.match(line)
+			if match:
+				self.taxid = match.group(1)
+		#the rank follows the Genbank common name on its line, or is on a line of its own for the taxa without one
+		if '>Rank:' in line:
+			match = RANK_PATTERN.search(line)
+			if match:
+				self.rank = match.group(1)
+
+	def result(self):
+		return [self.title, self.common_name, self.rank, self.taxid]
+
+def get_connection(url_parts):
+	#keep-alive connection of this thread to the taxonomy server
+	connection = getattr(connections, "connection", None)
+	if connection is None or connections.netloc != url_parts.netloc:
+		if connection is not None:
+			drop_connection()
+		if url_parts.scheme == "https":
+			connection = http.client.HTTPSConnection(url_parts.netloc, timeout=timeout)
+		else:
+			connection = http.client.HTTPConnection(url_parts.netloc, timeout=timeout)
+		connections.connection = connection
+		connections.netloc = url_parts.netloc
+	with connections_lock:
+		open_connections.add(connection)
+	return connection
+
+def drop_connection():
+	connection = getattr(connections, "connection", None)
+	if connection is not None:
+		connection.close()
+		connections.connection = None
+		with connections_lock:
+			open_connections.discard(connection)
+
+def close_connections():
+	#close the keep-alive connections of every thread (a thread using its connection again reopens it)
+	with connections_lock:
+		for connection in open_connections:
+			connection.close()
+		open_connections.clear()
+
+def fetchPage(url, parser):
+	#send the request on the keep-alive connection (a new one if the server closed it) and feed the page to the parser until it has all the fields
+	url_parts = urlsplit(url)
+	path = url_parts.path + "?" + url_parts.query
+	for attempt in (0, 1):
+		connection = get_connection(url_parts)
+		try:
+			connection.request("GET", path, headers={"Connection": "keep-alive"})
+			response = connection.getresponse()
+			break
+		except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError):
+			drop_connection()
+			if attempt == 1:
+				raise
+	if response.status != 200:
+		drop_connection()
+		raise http.client.HTTPException("taxonomy server answered "+str(response.status))
+	while not parser.done():
+		chunk = response.read(CHUNK_SIZE)
+		if not chunk:
+			break
+		parser.feed(chunk)
+	parser.close()
+	if not response.isclosed():
+		#the connection can only be used again once the whole page is read
+		if response.length is not None and response.length <= DRAIN_LIMIT:
+			response.read()
+		else:
+			drop_connection()
+
+def fetchTaxid(user_input):
 	#created by H.DENISE 15-11-18#
 	#replace space with "+" in scientifc name
 	query=user_input.replace(" ","+")
 	#check if a list has been provided and reformat it appropriately
 	Query = query
-	#Declaration
-	tag = 0
-	lineage_tables = {}
-	lineage_tables["query"]=[]
-	taxo_rank = ["superkingdom","phylum","class","order","family","genus","species"]
 	#send back request to ENA and get xml(s) in return
 	#url = "http://www.ebi.ac.uk/ena/data/view/Taxon:"+Query+"&display=xml"
 	if "+" in Query:
-		url = "https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?name="+Query+"&lvl=0"
+		url = NCBI_URL+"?name="+Query+"&lvl=0"
 	else:
-		url = "https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id="+Query+"&lvl=0"
+		url = NCBI_URL+"?id="+Query+"&lvl=0"
+	#while NCBI keeps failing only the cached results are used
+	if not breaker.allow():
+		return list()
+	parser = TaxonomyPageParser()
 	try:
-		connection_socket = urlopen(url)
-		html_doc = connection_socket.read()
-		res= (html_doc.decode("utf8"))
-		connection_socket.close()
+		fetchPage(url, parser)
 	except:
+		drop_connection()
+		breaker.failure()
 		return list()
+	breaker.success()
 	if Query != "":
-		title =""
-		common_name =""
-		rank =""
-		taxid = 0
-		data = res.split("\n")
-		for line in data:
-			if '<title>Taxonomy browser' in line :
-				end = line.index('</title>')
-				title= line[27:end-1]
-			if line.startswith('Genbank common name'):
-				common_name= line[29:line.index('</str')]
-				end= line[line.index('>Rank:'):].index('</str')
-				rank = line[line.index('>Rank:')+15:end + line.index('>Rank:')]
-			if line.startswith('Taxonomy ID'):
-				taxid = line[13: line.index('<small>')]
-		return [title, common_name, rank, taxid]
+		return parser.result()
 returndic ={}
 '''
 out=open("update","w")
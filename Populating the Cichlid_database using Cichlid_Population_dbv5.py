@@ -19,6 +19,7 @@ insert into provider (provider_name, email, affiliation, address, phone, changed
 ./Cichlid_Population_dbv5.py -sp samples -o
 ./Cichlid_Population_dbv5.py -sp sequenced -o
 ./Cichlid_Population_dbv5.py -sp mlw -o
+Note: on an empty database, steps 3 and 4 can be run with '-l <directory>' (e.g. ./Cichlid_Population_dbv5.py -v -j <json file> -l /tmp/cichlid_load) to write the records to tab separated files and load them with LOAD DATA LOCAL INFILE instead of inserting them one by one. The MySQL instance needs 'set global local_infile=1'. Records already in the database are not updated in this mode.
 5- Update data according to Milan Malinsky’s curation (he found that some species and alias were mislabelled)
 individual_name   wrong_alias   correct_species_name    correct_alias_name
 D23-D10. 	LabFul1	   Labeotropheus fuelleborni		LabFue28
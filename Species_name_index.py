@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+
+'''Index of the species names already known (species.name) used to map the spelling variants of the spreadsheets
+    ("Labidochromis ceraleus", "Trematochranus", "Melanochromis johanni"...) to the existing name instead of looking up
+    and inserting a new species. The names are indexed by their bigrams: one edit changes at most two bigrams so only the
+    names sharing enough bigrams with the query are compared to it.
+'''
+
+def name_key(name):
+	#names are compared without case and extra spaces
+	return " ".join(name.lower().split())
+
+def bigrams(key):
+	#bigrams of the key padded with one space on each side, with their number of occurrences
+	padded = " " + key + " "
+	counts = {}
+	for i in range(len(padded) - 1):
+		counts[padded[i:i+2]] = counts.get(padded[i:i+2], 0) + 1
+	return counts
+
+def edit_distance(first, second, limit):
+	#Levenshtein distance, stopping as soon as it is known to be above limit (limit+1 is returned then)
+	if abs(len(first) - len(second)) > limit:
+		return limit + 1
+	previous = list(range(len(second) + 1))
+	for i, first_char in enumerate(first, 1):
+		current = [i]
+		for j, second_char in enumerate(second, 1):
+			current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (first_char != second_char)))
+		if min(current) > limit:
+			return limit + 1
+		previous = current
+	return previous[-1]
+
+class SpeciesNameIndex:
+	'''
+	bigram index of species names
+	: input names (list) known species names (the first spelling of a name is the one returned by match)
+	: input max_distance (int) maximum number of edits between a name and its match (0 only matches case and space variants)
+	: input min_length (int) number of characters per allowed edit, so that short names need to be closer to match
+	'''
+	def __init__(self, names=(), max_distance=0, min_length=8):
+		self.max_distance = max_distance
+		self.min_length = min_length
+		self.names = {}
+		#bigram: {key: occurrences of the bigram in key}
+		self.postings = {}
+		for name in names:
+			self.add(name)
+
+	def add(self, name):
+		if not name:
+			return
+		key = name_key(name)
+		if key in self.names:
+			return
+		self.names[key] = name
+		for bigram, count in bigrams(key).items():
+			self.postings.setdefault(bigram, {})[key] = count
+
+	def match(self, name):
+		'''
+		: input name (str) species name
+		: return name (str) closest known name within the allowed number of edits (None if there is none)
+		'''
+		key = name_key(name)
+		if key in self.names:
+			return self.names[key]
+		limit = min(self.max_distance, len(key) // self.min_length)
+		if limit <= 0:
+			return None
+		#shared bigrams (counted with their occurrences) of each known name
+		shared = {}
+		for bigram, count in bigrams(key).items():
+			for other, other_count in self.postings.get(bigram, {}).items():
+				shared[other] = shared.get(other, 0) + min(count, other_count)
+		best = None
+		best_distance = limit + 1
+		for other, common in shared.items():
+			#a name within limit edits keeps all but 2*limit of the bigrams of the longest of the two names
+			if common < max(len(key), len(other)) + 1 - 2 * limit:
+				continue
+			distance = edit_distance(key, other, limit)
+			#ties are resolved on the name so that the result does not depend on the order of the names
+			if distance < best_distance or (distance == best_distance and other < best):
+				best, best_distance = other, distance
+		if best is None:
+			return None
+		return self.names[best]
+
+	def __len__(self):
+		return len(self.names)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+
+'''Records of the tables of a spreadsheet line (one class per table of the input template).
+    The fields are kept in __slots__ instead of a dictionary per table and per line. A record keeps the mapping interface
+    of the dictionaries used by the update scripts (record['field'], 'field' in record, items(), dict(record)...), only
+    the fields which have been set being present, and non_empty removes in place the fields without value.
+'''
+
+class Record:
+	'''
+	fields of one table for one line of the spreadsheet
+	: input values (dic) field: value to set
+	'''
+	__slots__ = ()
+
+	def __init__(self, values=None):
+		if values:
+			for field, value in values.items():
+				self[field] = value
+
+	def __getitem__(self, field):
+		try:
+			return getattr(self, field)
+		except (AttributeError, TypeError):
+			raise KeyError(field)
+
+	def __setitem__(self, field, value):
+		if field not in self.__slots__:
+			raise KeyError(field+" is not a field of table "+self.table)
+		setattr(self, field, value)
+
+	def __delitem__(self, field):
+		try:
+			delattr(self, field)
+		except (AttributeError, TypeError):
+			raise KeyError(field)
+
+	def __contains__(self, field):
+		return field in self.__slots__ and hasattr(self, field)
+
+	def get(self, field, default=None):
+		if field in self:
+			return getattr(self, field)
+		return default
+
+	def keys(self):
+		return [field for field in self.__slots__ if hasattr(self, field)]
+
+	def values(self):
+		return [getattr(self, field) for field in self.keys()]
+
+	def items(self):
+		return [(field, getattr(self, field)) for field in self.keys()]
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def __eq__(self, other):
+		if isinstance(other, (Record, dict)):
+			return dict(self.items()) == dict(other.items())
+		return NotImplemented
+
+	def __repr__(self):
+		return repr(dict(self.items()))
+
+	def non_empty(self):
+		#remove the fields set to an empty string (dates and numbers are kept)
+		for field in self.keys():
+			value = getattr(self, field)
+			if isinstance(value, str) and len(value) == 0:
+				delattr(self, field)
+		return self
+
+class Option(Record):
+	table = 'record'
+	__slots__ = ('option',)
+
+class Individual(Record):
+	table = 'individual'
+	__slots__ = ('name', 'alias', 'date_collected', 'collection_method', 'collection_details', 'sex', 'comment')
+
+class Species(Record):
+	table = 'species'
+	__slots__ = ('name', 'genus', 'species', 'informal', 'taxon_id', 'common_name', 'taxon_position')
+
+class Provider(Record):
+	table = 'provider'
+	__slots__ = ('provider_name',)
+
+class Location(Record):
+	table = 'location'
+	__slots__ = ('country_of_origin', 'location', 'sub_location', 'latitude', 'longitude')
+
+class DevelopmentalStage(Record):
+	table = 'developmental_stage'
+	__slots__ = ('name',)
+
+class IndividualData(Record):
+	table = 'individual_data'
+	__slots__ = ('weight', 'unit', 'clade', 'subset')
+
+class Material(Record):
+	table = 'material'
+	__slots__ = ('name', 'accession', 'type', 'storage_condition', 'storage_location', 'amount', 'unit', 'comment', 'date_received')
+
+class OrganismPart(Record):
+	table = 'organism_part'
+	__slots__ = ('name',)
+
+class MaterialProvider(Record):
+	table = 'mat_provider'
+	__slots__ = ('provider_name',)
+
+class Image(Record):
+	table = 'image'
+	__slots__ = ('filename', 'filepath', 'comment', 'licence')
+
+class Project(Record):
+	table = 'project'
+	__slots__ = ('name', 'alias', 'ssid', 'accession')
+
+class Sample(Record):
+	table = 'sample'
+	__slots__ = ('name', 'accession', 'ssid', 'comment')
+
+class Lane(Record):
+	table = 'lane'
+	__slots__ = ('name', 'accession')
+
+class LibraryType(Record):
+	table = 'library_type'
+	__slots__ = ('name',)
+
+class Library(Record):
+	table = 'library'
+	__slots__ = ('ssid',)
+
+class SeqCentre(Record):
+	table = 'seq_centre'
+	__slots__ = ('name',)
+
+class SeqTech(Record):
+	table = 'seq_tech'
+	__slots__ = ('name',)
+
+class File(Record):
+	table = 'file'
+	__slots__ = ('type', 'name', 'format', 'accession', 'md5', 'location', 'nber_reads', 'total_length', 'average_length', 'coverage', 'exclusion', 'comment')
+
+#record class of each table of the template
+RECORD_CLASSES = {record_class.table: record_class for record_class in (Option, Individual, Species, Provider, Location, DevelopmentalStage,
+	IndividualData, Material, OrganismPart, MaterialProvider, Image, Project, Sample, Lane, LibraryType, Library, SeqCentre, SeqTech, File)}
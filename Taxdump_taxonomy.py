@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+
+import os
+import sys
+import mmap
+import array
+import bisect
+import hashlib
+import argparse
+
+'''Offline NCBI taxonomy built from the taxdump files (https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz).
+    Usage: Taxdump_taxonomy.py <directory with names.dmp and nodes.dmp> <index directory>
+    build_index converts names.dmp and nodes.dmp once into an index directory holding:
+        ranks.txt         rank names (the position is the rank code)
+        names.txt         all the names, one per line
+        rank.bin          rank code of each taxid (unsigned char, indexed by taxid)
+        parent.bin        parent taxid of each taxid (unsigned int, indexed by taxid)
+        scientific.bin    offset+1 in names.txt of the scientific name of each taxid (0: unknown taxid)
+        common.bin        offset+1 in names.txt of the genbank common name (or common name) of each taxid (0: none)
+        name_hash.bin     sorted 64 bits hashes of the lower case names (any name class)
+        name_taxid.bin    taxid of the name with the same position in name_hash.bin
+        name_offset.bin   offset in names.txt of the name with the same position in name_hash.bin
+    TaxdumpTaxonomy memory-maps these files and answers getTaxid queries like Get_taxonomy_from_NCBI.getTaxid, without network.
+'''
+
+def name_key(name):
+	#names are compared without case and extra spaces
+	return " ".join(name.lower().split())
+
+def name_hash(name):
+	return int.from_bytes(hashlib.blake2b(name_key(name).encode("utf8"), digest_size=8).digest(), "little")
+
+def read_dmp(path):
+	#taxdump lines are fields separated by '\t|\t' and ended by '\t|'
+	with open(path, "r", encoding="utf8") as dmp:
+		for line in dmp:
+			line = line.rstrip("\n")
+			if line.endswith("\t|"):
+				line = line[:-2]
+			yield line.split("\t|\t")
+
+def build_index(taxdump_dir, index_dir):
+	'''
+	: input taxdump_dir (str) directory with names.dmp and nodes.dmp
+	: input index_dir (str) directory where the index files are written (created if needed)
+	: return none
+	'''
+	os.makedirs(index_dir, exist_ok=True)
+	nodes = {}
+	ranks = []
+	rank_codes = {}
+	for fields in read_dmp(os.path.join(taxdump_dir, "nodes.dmp")):
+		rank = fields[2]
+		if rank not in rank_codes:
+			rank_codes[rank] = len(ranks)
+			ranks.append(rank)
+		nodes[int(fields[0])] = (int(fields[1]), rank_codes[rank])
+	size = max(nodes) + 1
+	rank_array = array.array('B', bytes(size))
+	parent_array = array.array('I', [0]) * size
+	scientific_array = array.array('I', [0]) * size
+	common_array = array.array('I', [0]) * size
+	for taxid, (parent, rank) in nodes.items():
+		rank_array[taxid] = rank
+		parent_array[taxid] = parent
+	#name key: (priority, taxid, offset), the scientific names taking precedence over the other classes for homonyms
+	priority = {'scientific name': 0, 'genbank common name': 1, 'common name': 2}
+	name_dic = {}
+	offset = 0
+	with open(os.path.join(index_dir, "names.txt"), "wb") as names_file:
+		for fields in read_dmp(os.path.join(taxdump_dir, "names.dmp")):
+			taxid = int(fields[0])
+			name = fields[1]
+			name_class = fields[3]
+			if taxid >= size:
+				continue
+			encoded = name.encode("utf8") + b"\n"
+			names_file.write(encoded)
+			if name_class == 'scientific name':
+				scientific_array[taxid] = offset + 1
+			elif name_class == 'genbank common name' or (name_class == 'common name' and common_array[taxid] == 0):
+				common_array[taxid] = offset + 1
+			entry = (priority.get(name_class, 3), taxid, offset)
+			key = name_key(name)
+			if key not in name_dic or entry < name_dic[key]:
+				name_dic[key] = entry
+			offset += len(encoded)
+	entries = sorted([(name_hash(key), taxid, name_offset) for key, (prio, taxid, name_offset) in name_dic.items()])
+	for file_name, values in (("rank.bin", rank_array), ("parent.bin", parent_array), ("scientific.bin", scientific_array),
+							  ("common.bin", common_array), ("name_hash.bin", array.array('Q', [x[0] for x in entries])),
+							  ("name_taxid.bin", array.array('I', [x[1] for x in entries])), ("name_offset.bin", array.array('I', [x[2] for x in entries]))):
+		with open(os.path.join(index_dir, file_name), "wb") as index_file:
+			values.tofile(index_file)
+	with open(os.path.join(index_dir, "ranks.txt"), "w", encoding="utf8") as ranks_file:
+		ranks_file.write("\n".join(ranks) + "\n")
+
+class TaxdumpTaxonomy:
+	'''
+	read-only access to an index written by build_index (the files are memory-mapped, not loaded)
+	: input index_dir (str) directory written by build_index
+	'''
+	def __init__(self, index_dir):
+		self.files = []
+		self.ranks = open(os.path.join(index_dir, "ranks.txt"), "r", encoding="utf8").read().split("\n")[:-1]
+		self.names = self._map(index_dir, "names.txt")
+		self.rank = self._map(index_dir, "rank.bin").cast('B')
+		self.parent = self._map(index_dir, "parent.bin").cast('I')
+		self.scientific = self._map(index_dir, "scientific.bin").cast('I')
+		self.common = self._map(index_dir, "common.bin").cast('I')
+		self.name_hashes = self._map(index_dir, "name_hash.bin").cast('Q')
+		self.name_taxids = self._map(index_dir, "name_taxid.bin").cast('I')
+		self.name_offsets = self._map(index_dir, "name_offset.bin").cast('I')
+
+	def _map(self, index_dir, file_name):
+		index_file = open(os.path.join(index_dir, file_name), "rb")
+		self.files.append(index_file)
+		if os.fstat(index_file.fileno()).st_size == 0:
+			return memoryview(b"")
+		return memoryview(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+	def _name(self, offset):
+		end = self.names.obj.find(b"\n", offset)
+		return bytes(self.names[offset:end]).decode("utf8")
+
+	def name_to_taxid(self, name):
+		#binary search of the hash, then check the name itself in case two names share the hash
+		key = name_key(name)
+		value = name_hash(key)
+		position = bisect.bisect_left(self.name_hashes, value)
+		while position < len(self.name_hashes) and self.name_hashes[position] == value:
+			if name_key(self._name(self.name_offsets[position])) == key:
+				return self.name_taxids[position]
+			position += 1
+		return 0
+
+	def taxon(self, taxid):
+		#return [scientific name, common name, rank, taxid] of a taxid or None if unknown
+		if taxid <= 0 or taxid >= len(self.scientific) or self.scientific[taxid] == 0:
+			return None
+		common_name = ""
+		if self.common[taxid] > 0:
+			common_name = self._name(self.common[taxid] - 1)
+		return [self._name(self.scientific[taxid] - 1), common_name, self.ranks[self.rank[taxid]], str(taxid)]
+
+	def lineage(self, taxid):
+		#return the taxids from taxid up to the root
+		lineage = []
+		while 0 < taxid < len(self.parent) and self.scientific[taxid] != 0 and taxid not in lineage:
+			lineage.append(taxid)
+			taxid = self.parent[taxid]
+		return lineage
+
+	def getTaxid(self, user_input):
+		#same result as Get_taxonomy_from_NCBI.getTaxid: [title, common_name, rank, taxid] for a name or a taxid
+		query = str(user_input).strip()
+		if query.isdigit():
+			result = self.taxon(int(query))
+		else:
+			result = self.taxon(self.name_to_taxid(query))
+		if result is None:
+			return ["", "", "", 0]
+		return result
+
+	def close(self):
+		for index_file in self.files:
+			index_file.close()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Build the offline taxonomy index from NCBI names.dmp and nodes.dmp")
+	parser.add_argument("taxdump_dir", help="directory with names.dmp and nodes.dmp")
+	parser.add_argument("index_dir", help="directory where the index is written")
+	args = vars(parser.parse_args())
+	build_index(args['taxdump_dir'], args['index_dir'])
+	sys.exit()
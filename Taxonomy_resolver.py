@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class RateLimiter:
+	'''
+	spread the requests sent by several threads so that no more than rate requests are started per second
+	: input rate (float) requests per second (0 for no limit)
+	'''
+	def __init__(self, rate):
+		self.interval = 1.0/rate if rate > 0 else 0
+		self.next_time = time.monotonic()
+		self.lock = threading.Lock()
+
+	def wait(self):
+		#book the next free slot then sleep outside of the lock until it comes
+		with self.lock:
+			now = time.monotonic()
+			start = max(now, self.next_time)
+			self.next_time = start + self.interval
+		if start > now:
+			time.sleep(start - now)
+
+class CircuitBreaker:
+	'''
+	stop calling a failing server: after max_failures consecutive failures no request is allowed for reset_after seconds,
+	then a single request is let through and its success closes the breaker again
+	: input max_failures (int) consecutive failures opening the breaker (0 never opens it)
+	: input reset_after (float) seconds before a new request is tried
+	'''
+	def __init__(self, max_failures=5, reset_after=300):
+		self.max_failures = max_failures
+		self.reset_after = reset_after
+		self.failures = 0
+		self.opened = None
+		self.skipped = 0
+		self.lock = threading.Lock()
+
+	def allow(self):
+		with self.lock:
+			if self.opened is None:
+				return True
+			if time.monotonic() - self.opened >= self.reset_after:
+				#half open: this request decides whether the server is back
+				self.opened = time.monotonic()
+				return True
+			self.skipped += 1
+			return False
+
+	def success(self):
+		with self.lock:
+			self.failures = 0
+			self.opened = None
+
+	def failure(self):
+		with self.lock:
+			self.failures += 1
+			if self.max_failures > 0 and self.failures >= self.max_failures:
+				if self.opened is None:
+					logging.warning(str(self.failures)+" taxonomy requests failed in a row, no request sent for "+str(self.reset_after)+"s")
+				self.opened = time.monotonic()
+
+class TaxonomyResolver:
+	'''
+	resolve many taxonomy queries (species names or taxids) concurrently
+	: input lookup (function) function taking one query and returning its result (e.g. Get_taxonomy_from_NCBI.fetchTaxid)
+	: input max_workers (int) number of queries sent at the same time
+	: input rate (float) maximum number of queries started per second (0 for no limit)
+	The threads are kept between the calls to resolve (so is anything the lookup keeps per thread, e.g. a keep-alive connection) until close
+	'''
+	def __init__(self, lookup, max_workers=8, rate=3.0):
+		self.lookup = lookup
+		self.max_workers = max(max_workers, 1)
+		self.limiter = RateLimiter(rate)
+		self.executor = None
+
+	def _lookup(self, query):
+		self.limiter.wait()
+		return self.lookup(query)
+
+	def resolve(self, queries):
+		'''
+		: input queries (list) names or taxids, empty ones and duplicates are ignored
+		: return results (dic) query: result of lookup
+		'''
+		distinct = list(dict.fromkeys([query for query in queries if query]))
+		if len(distinct) == 0:
+			return {}
+		if self.executor is None:
+			self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+		results = list(self.executor.map(self._lookup, distinct))
+		return dict(zip(distinct, results))
+
+	def close(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
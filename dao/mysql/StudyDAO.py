@@ -1,5 +1,8 @@
 __author__ = 'hudenise'
 
+import time
+import logging
+import collections
 
 
 class StudyDAO:
@@ -7,51 +10,332 @@ class StudyDAO:
 	Data access object for for the tables in VGP_TRACKING
 	"""
 
-	def __init__(self, dataAccessObject):
+	def __init__(self, dataAccessObject, batch_size=0, cache_size=0, id_allocator=None):
 		"""
 		Constructor
+		: input batch_size (int) number of rows grouped in one insert statement by populate_table and insert_row. 0 disables batching.
+			The queued rows are sent by flush_inserts, before the next select, update or commit, so an insert error is raised there and not by the insert_row call:
+			only batch in a flow whose error handling covers the whole unit of work up to the commit (e.g. one source of Cichlid_Population_dbv5.populate_database)
+		: input cache_size (int) number of select results kept in memory. 0 disables the cache
+		: input id_allocator (BlockIdAllocator) source of new <table>_id. If None, max(<table>_id)+1 is used
 		"""
 		self.dataAccessObject = dataAccessObject
+		self.id_allocator = id_allocator
+		self.batch_size = batch_size
+		#pending inserts: consecutive rows sharing the same (kind, table, columns) are sent as one statement
+		self.pending_key = None
+		self.pending_values = []
+		self.inserted_rows = 0
+		self.insert_time = 0.0
+		#deferred updates sent by flush_updates: (table, key column): [(key, field, value)]
+		self.pending_updates = {}
+		#parameterized statements, one per (operation, table, columns)
+		self.statements = {}
+		#least recently used select results (normalized query: rows) and the queries reading each table
+		self.cache_size = cache_size
+		self.cache = collections.OrderedDict()
+		self.cache_tables = {}
+		self.cache_hits = 0
+		self.cache_misses = 0
 
-	def delete_data(self, table, identifier, identifiant):
-		query= "DELETE from "+table+" where "+identifier+" = "+identifiant
-		return self.dataAccessObject._runQuery(query)
+	def _run(self, query, compact=False, data=None):
+		#any other statement may depend on the pending rows so send them first
+		self.flush_inserts()
+		return self.dataAccessObject._runQuery(query, compact, data)
+
+	def _select(self, query, *tables, compact=False, data=None):
+		"""
+		Run a select through the result cache
+		: input tables (str) tables read by the query, used to invalidate the result when one of them is modified
+		: input compact (boolean) return read-only CompactRow instead of dict
+		: input data (tuple) values bound to the %s placeholders of the query
+		"""
+		#the deferred updates of these tables (e.g. latest = 0 of a previous row) must be seen by the select and by the cache
+		self.flush_updates(*tables)
+		if self.cache_size <= 0:
+			return self._run(query, compact, data)
+		key = " ".join(query.split())
+		if data is not None:
+			key += " " + repr(tuple(data))
+		if compact:
+			key = "compact " + key
+		if key in self.cache:
+			self.cache.move_to_end(key)
+			self.cache_hits += 1
+			if compact:
+				return list(self.cache[key])
+			#callers modify the returned rows so give them a copy
+			return [dict(x) for x in self.cache[key]]
+		self.cache_misses += 1
+		results = self._run(query, compact, data)
+		if compact:
+			self.cache[key] = list(results)
+		else:
+			self.cache[key] = [dict(x) for x in results]
+		for table in tables:
+			self.cache_tables.setdefault(table, set()).add(key)
+		if len(self.cache) > self.cache_size:
+			old_key, old_results = self.cache.popitem(last=False)
+			for keys in self.cache_tables.values():
+				keys.discard(old_key)
+		return results
+
+	def invalidate(self, table):
+		"""
+		Remove from the cache the results of the queries reading the table
+		"""
+		for key in self.cache_tables.pop(table, ()):
+			self.cache.pop(key, None)
+
+	def clear_cache(self):
+		self.cache.clear()
+		self.cache_tables = {}
+
+	def cache_stats(self):
+		"""
+		: return (int) number of select results served from the cache (hits) and from the database (misses)
+		"""
+		return self.cache_hits, self.cache_misses
+
+	def _queue(self, key, value):
+		if key != self.pending_key:
+			self.flush_inserts()
+			self.pending_key = key
+		self.pending_values.append(value)
+		if len(self.pending_values) >= self.batch_size:
+			self.flush_inserts()
+
+	def flush_inserts(self):
+		"""
+		Send the pending rows as one insert statement (multi-VALUES for literal rows, executemany for parameterized ones)
+		"""
+		if len(self.pending_values) == 0:
+			return
+		kind, table, columns = self.pending_key
+		values = self.pending_values
+		self.pending_key = None
+		self.pending_values = []
+		start = time.time()
+		if kind == 'literal':
+			self.dataAccessObject._runQuery("insert INTO "+table +" "+columns+" values "+", ".join(values))
+		else:
+			self.dataAccessObject._runInsertMany(self.statement('insert', table, columns), values, len(values))
+		elapsed = time.time() - start
+		self.inserted_rows += len(values)
+		self.insert_time += elapsed
+		logging.debug("batch of "+str(len(values))+" rows inserted into "+table+" in "+str(round(elapsed, 3))+"s")
+
+	def statement(self, operation, table, columns, where_columns=()):
+		"""
+		Return the parameterized statement for the operation, compiled once per (operation, table, columns)
+		: input operation (str) 'insert' or 'update'
+		: input columns (tuple) columns to insert or to set
+		: input where_columns (tuple) columns of the where clause (update only)
+		: return (str) statement with one %s placeholder per value
+		"""
+		key = (operation, table, columns, where_columns)
+		if key not in self.statements:
+			if operation == 'insert':
+				sql = "insert INTO "+table+" ("+", ".join(columns)+") values ("+", ".join(["%s"]*len(columns))+")"
+			elif operation == 'update':
+				sql = "update "+table+" set "+", ".join([x+" = %s" for x in columns])+" where "+" and ".join([x+" = %s" for x in where_columns])
+			else:
+				raise VGDBError("unknown statement operation "+operation)
+			self.statements[key] = sql
+		return self.statements[key]
+
+	def next_id(self, table):
+		"""
+		: return (int) <table>_id to use for the next row inserted into the table (None if set by auto-increment)
+		"""
+		if self.id_allocator is not None:
+			return self.id_allocator.next_id(table)
+		max_id = self.getmaxIndex(table)[0]['max('+table+'_id)']
+		if max_id is None:
+			return 1
+		return max_id + 1
+
+	def insert_row(self, table, data):
+		"""
+		Insert one row with values bound as parameters
+		: input data (dic) dictionary of field: value to insert. A <table>_id set to None is left to auto-increment
+		: return (int) <table>_id of the new row (None if the table has no <table>_id field in data)
+		"""
+		auto_increment = table+"_id" in data and data[table+"_id"] is None
+		if auto_increment:
+			data = {k:v for k,v in data.items() if k != table+"_id"}
+		columns = tuple(data.keys())
+		values = tuple(data[x] for x in columns)
+		self.invalidate(table)
+		#the id given by auto-increment is needed straight away so these rows are not batched
+		if self.batch_size > 0 and not auto_increment:
+			self._queue(('insert', table, columns), values)
+			return data.get(table+"_id")
+		start = time.time()
+		self.flush_inserts()
+		lastrowid = self.dataAccessObject._runInsertStatement(self.statement('insert', table, columns), values)
+		self.insert_time += time.time() - start
+		self.inserted_rows += 1
+		if auto_increment:
+			return lastrowid
+		return data.get(table+"_id")
+
+	def update_row(self, table, data, where):
+		"""
+		Update rows with values bound as parameters
+		: input data (dic) dictionary of field: new value
+		: input where (dic) dictionary of field: value identifying the rows to update
+		: return (int) number of rows updated
+		"""
+		columns = tuple(data.keys())
+		where_columns = tuple(where.keys())
+		self.invalidate(table)
+		self.flush_inserts()
+		return self.dataAccessObject._runStatement(self.statement('update', table, columns, where_columns), tuple(data[x] for x in columns) + tuple(where[x] for x in where_columns))
+
+	def update_rows(self, table, key_column, updates):
+		"""
+		Update many rows with grouped statements (one CASE per column for each batch of batch_size values)
+		: input key_column (str) field identifying the rows to update (e.g. row_id or <table>_id)
+		: input updates (list) (key, field, new value) triples
+		: return (int) number of rows updated
+		"""
+		self.invalidate(table)
+		self.flush_inserts()
+		if self.batch_size > 0:
+			return self.dataAccessObject._runUpdateMany(table, key_column, updates, self.batch_size)
+		return self.dataAccessObject._runUpdateMany(table, key_column, updates)
+
+	def queue_update(self, table, key_column, key, field, value):
+		"""
+		Defer the update of one field of one row until flush_updates, so that the updates of a unit of work (e.g. the latest flags of the previous rows of a spreadsheet entry) are sent together by update_rows.
+		The updates of a table are sent before the next select reading it. The row must be identified by a key the rows inserted in the meantime do not share
+		: input key_column (str) field identifying the row to update (e.g. row_id)
+		"""
+		self.invalidate(table)
+		self.pending_updates.setdefault((table, key_column), []).append((key, field, value))
+
+	def flush_updates(self, *tables):
+		"""
+		Send the deferred updates, one update_rows call per table and key field
+		: input tables (str) only send the updates of these tables (all of them if none is given)
+		: return (int) number of rows updated
+		"""
+		changed = 0
+		for (table, key_column) in list(self.pending_updates):
+			if len(tables) == 0 or table in tables:
+				changed += self.update_rows(table, key_column, self.pending_updates.pop((table, key_column)))
+		return changed
+
+	def insert_rate(self):
+		"""
+		: return (int) number of rows inserted through populate_table and insert_row and the corresponding rows per second
+		"""
+		self.flush_inserts()
+		if self.insert_time > 0:
+			return self.inserted_rows, int(self.inserted_rows / self.insert_time)
+		return self.inserted_rows, 0
+
+	def delete_data(self, table, criteria, data):
+		"""
+		: input criteria (str) where clause with one %s per value
+		: input data (tuple) values of the where clause, bound as parameters
+		"""
+		query= "DELETE from "+table+" where "+criteria
+		self.invalidate(table)
+		return self._run(query, data=data)
 
 	def getLinkData(self, table1, field1, table2, field2, returnfield, identifier, crit_table):
 		query = "SELECT "+returnfield+" from " + table1 +" t1 join " +table2+" t2 on t1."+field1 +" = t2."+field2 +" where "+ crit_table + " = \'{0}\'""".format(identifier)
-		return self.dataAccessObject._runQuery(query)
+		return self._select(query, table1, table2)
 
-	def getStudyData(self, table, field, identifier):
-		query = "SELECT * from " + table+ " where " + field + " = \'{0}\'".format(identifier)
+	def getStudyData(self, table, field, identifier, compact=False):
+		"""
+		: input identifier (str) value of field, bound as a parameter
+		"""
+		query = "SELECT * from " + table+ " where " + field + " = %s"
 		print(query)
-		return self.dataAccessObject._runQuery(query)
+		return self._select(query, table, compact=compact, data=(identifier,))
 
-	def getTableData(self, table, return_field, identifier):
+	def getTableData(self, table, return_field, identifier, compact=False, data=None):
+		"""
+		: input identifier (str) where clause. If data is given, one %s per value ('%' written '%%')
+		: input data (tuple) values of the where clause, bound as parameters
+		"""
 		query = "SELECT " + return_field +" from " + table+ " where " +identifier
 		print(query)
-		return self.dataAccessObject._runQuery(query)
+		return self._select(query, table, compact=compact, data=data)
+
+	def iter_studyData(self, table, field, identifier, compact=False):
+		"""
+		Streaming counterpart of getStudyData: rows are yielded one at a time from a server-side cursor
+		"""
+		query = "SELECT * from " + table+ " where " + field + " = \'{0}\'".format(identifier)
+		self.flush_inserts()
+		self.flush_updates(table)
+		return self.dataAccessObject._iterQuery(query, compact=compact)
+
+	def iter_tableData(self, table, return_field, identifier, compact=False):
+		"""
+		Streaming counterpart of getTableData: rows are yielded one at a time from a server-side cursor
+		"""
+		query = "SELECT " + return_field +" from " + table+ " where " +identifier
+		self.flush_inserts()
+		self.flush_updates(table)
+		return self.dataAccessObject._iterQuery(query, compact=compact)
+
+	def getTableColumns(self, table, return_field, identifier):
+		"""
+		Columnar counterpart of getTableData for reports over whole tables (e.g. weights in individual_data)
+		: return (dic) field: array of the values (numpy array if numpy is installed)
+		"""
+		query = "SELECT " + return_field +" from " + table+ " where " +identifier
+		self.flush_inserts()
+		self.flush_updates(table)
+		return self.dataAccessObject._runColumnarQuery(query)
+
+	def getTaxonIndividuals(self, ancestor, return_field="i.*"):
+		"""
+		Individuals of the species descending from a taxon (genus, tribe...), through the taxon_lineage closure table
+		: input ancestor (str) taxid or scientific name of the taxon
+		"""
+		if str(ancestor).isdigit():
+			criteria = "l.ancestor_taxid = "+str(ancestor)
+		else:
+			criteria = "l.ancestor_name = \'{0}\'".format(ancestor)
+		query = "SELECT " + return_field + " from individual i join species s on s.species_id = i.species_id join taxon_lineage l on l.descendant_taxid = s.taxon_id where " + criteria
+		return self._select(query, 'individual', 'species', 'taxon_lineage')
 
 	def getmaxIndex(self, table):
 		query = """SELECT max(""" + table+"""_id) from """ + table
-		return self.dataAccessObject._runQuery(query)
+		return self._select(query, table)
 
 	def getIndex(self, table, field, criteria):
 		query = "SELECT " + table +"_id from " + table +" where " +field + " = {0}".format(criteria)
-		return self.dataAccessObject._runQuery(query)
+		return self._select(query, table)
 
 	def populate_table(self, table, field_str, value_str):
+		self.invalidate(table)
+		if self.batch_size > 0:
+			self._queue(('literal', table, " ".join(field_str.split())), value_str)
+			return []
 		query = "insert INTO "+table +" "+field_str+" values "+value_str
 		print(query)
-		return self.dataAccessObject._runQuery(query)
+		start = time.time()
+		results = self.dataAccessObject._runQuery(query)
+		self.insert_time += time.time() - start
+		self.inserted_rows += 1
+		return results
 
 	def update(self, table, field_statement, identifier, identifiant):
 		query = "update "+table +" set "+field_statement +" where " + identifier +" = '" + str(identifiant) +"'"
 		print(query)
-		return self.dataAccessObject._runQuery(query)
+		self.invalidate(table)
+		return self._run(query)
 
 	def createViews(self, view_name, table_name):
 		query = "create or replace view `"+view_name + "` as select * from "+table_name +" where latest = true;"
-		return self.dataAccessObject._runQuery(query)
+		return self._run(query)
 
 class VGDBError(Exception):
 	"""VG Data access exception"""
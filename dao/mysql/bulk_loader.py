@@ -0,0 +1,134 @@
+import os
+import time
+import logging
+
+__author__ = 'hudenise'
+
+"""
+Bulk population of empty or nearly empty tables with LOAD DATA LOCAL INFILE.
+
+"""
+
+
+class BulkLoader:
+    """
+    Loads whole tables from tab separated files instead of inserting the rows one at a time.
+    Each table is written to <directory>/<table>.tsv, loaded into a temporary staging table with
+    LOAD DATA LOCAL INFILE, then copied into the table with one INSERT ... SELECT which resolves
+    the foreign keys by joining the staging table to the parent tables on their identifier.
+    Note: the connection must be opened with local_infile=True and the server must allow local_infile
+    """
+
+    def __init__(self, dataAccessObject, directory, id_allocator=None):
+        """
+        Constructor
+        :parameter dataAccessObject: type MySQLDataAccessObject
+        :parameter directory: type str, directory where the tab separated files are written (created if needed)
+        :parameter id_allocator: type BlockIdAllocator, source of the new primary keys. If None, they follow max(id_column)
+        """
+        self.dataAccessObject = dataAccessObject
+        self.directory = directory
+        self.id_allocator = id_allocator
+        os.makedirs(directory, exist_ok=True)
+
+    def _escape(self, value):
+        """Returns the value written in LOAD DATA default format (\\N for NULL, escaped tab, newline and backslash)"""
+        if value is None:
+            return "\\N"
+        return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+    def write_tsv(self, table, columns, rows):
+        """
+        :parameter table: type str
+        :parameter columns: type list(str)
+        :parameter rows: type list(dict), missing columns are written as NULL
+
+        write_tsv(self, table, columns, rows) -> str
+
+        Writes the rows to <directory>/<table>.tsv with a header line and returns the path of the file
+        """
+        file_path = os.path.join(self.directory, table + ".tsv")
+        with open(file_path, "w", encoding="utf8") as tsv_file:
+            tsv_file.write("\t".join(columns) + "\n")
+            for row in rows:
+                tsv_file.write("\t".join([self._escape(row.get(column)) for column in columns]) + "\n")
+        return file_path
+
+    def load_table(self, table, rows, id_column=None, identifiers=(), foreign_keys=(), constants=None):
+        """
+        :parameter table: type str
+        :parameter rows: type list(dict), field: value for each row. Foreign keys are given by the identifier of the parent row
+        :parameter id_column: type str, primary key numbered in the order of the rows from the first id of a range reserved
+                          with the id allocator, or from max(id_column)+1 without allocator (None to leave it to MySQL)
+        :parameter identifiers: type list(str), fields identifying a row: rows already in the table with the same values are not loaded
+        :parameter foreign_keys: type list(tuple), (field, parent table, parent identifier, key) where key is the field of the rows
+                                 holding the parent identifier and field is set to the <parent table>_id of the matching parent row
+        :parameter constants: type dict, field: value set on every row (e.g. changed and latest)
+
+        load_table(self, table, rows, id_column, identifiers, foreign_keys, constants) -> int
+
+        Loads the rows into the table and returns the number of rows inserted
+        """
+        if len(rows) == 0:
+            return 0
+        constants = constants or {}
+        keys = [x[3] for x in foreign_keys]
+        columns = []
+        for row in rows:
+            for column in row:
+                if column not in columns:
+                    columns.append(column)
+        data_columns = [x for x in columns if x not in keys]
+        start = time.time()
+        file_path = self.write_tsv(table, columns, rows)
+        stage = "stage_" + table
+        self.dataAccessObject._runStatement("DROP TEMPORARY TABLE IF EXISTS " + stage)
+        self.dataAccessObject._runStatement(
+            "CREATE TEMPORARY TABLE " + stage + " (stage_row int NOT NULL AUTO_INCREMENT PRIMARY KEY, " +
+            ", ".join(["`" + x + "` varchar(255)" if x in keys else "`" + x + "` text" for x in columns]) +
+            "".join([", KEY (`" + x + "`)" for x in keys]) + ")")
+        self.dataAccessObject._runLoadData(stage, file_path, ["`" + x + "`" for x in columns])
+        insert_columns = []
+        select_columns = []
+        data = []
+        if id_column is not None and self.id_allocator is not None:
+            # one id per staged row, also reserved for the rows skipped as already in the table (they leave gaps)
+            first_id = self.id_allocator.reserve(table, len(rows))
+            if first_id is not None:
+                insert_columns.append(id_column)
+                select_columns.append(str(first_id - 1) + " + st.stage_row")
+        elif id_column is not None:
+            max_id = self.dataAccessObject._runQuery("SELECT COALESCE(MAX(" + id_column + "), 0) AS max_id FROM " + table)
+            insert_columns.append(id_column)
+            select_columns.append(str(max_id[0]['max_id']) + " + st.stage_row")
+        for column in data_columns:
+            insert_columns.append(column)
+            select_columns.append("st.`" + column + "`")
+        joins = ""
+        for i, (field, parent, parent_identifier, key) in enumerate(foreign_keys):
+            insert_columns.append(field)
+            select_columns.append("p" + str(i) + ".parent_id")
+            # several versions of a parent row share its <parent>_id so one id per identifier is kept
+            joins += " LEFT JOIN (SELECT " + parent_identifier + " AS parent_key, MAX(" + parent + "_id) AS parent_id FROM " + \
+                     parent + " GROUP BY " + parent_identifier + ") p" + str(i) + " ON p" + str(i) + ".parent_key = st.`" + key + "`"
+        for column, value in constants.items():
+            insert_columns.append(column)
+            select_columns.append("%s")
+            data.append(value)
+        sql = "INSERT INTO " + table + " (" + ", ".join(insert_columns) + ") SELECT " + ", ".join(select_columns) + \
+              " FROM " + stage + " st" + joins
+        if len(identifiers) > 0:
+            expressions = dict(zip(insert_columns, select_columns))
+            sql += " WHERE NOT EXISTS (SELECT 1 FROM " + table + " x WHERE " + \
+                   " and ".join(["x." + x + " <=> " + expressions[x] for x in identifiers]) + ")"
+        inserted = self.dataAccessObject._runStatement(sql, tuple(data))
+        self.dataAccessObject._runStatement("DROP TEMPORARY TABLE " + stage)
+        elapsed = time.time() - start
+        if elapsed > 0:
+            logging.info("Loaded " + str(inserted) + " rows into table " + table + " (" + str(int(inserted / elapsed)) +
+                         " rows/s)")
+        return inserted
+
+
+if __name__ == '__main__':
+    pass
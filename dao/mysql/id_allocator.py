@@ -0,0 +1,108 @@
+import sys
+import logging
+import threading
+import pymysql
+
+__author__ = 'hudenise'
+
+"""
+Allocation of primary keys (<table>_id) shared between concurrent importers.
+
+"""
+
+
+class BlockIdAllocator:
+    """
+    Hands out <table>_id values from blocks reserved in the id_allocation table.
+    A block is reserved in its own committed transaction on a separate connection of the pool, so two importers
+    never receive the same id and a rollback of the import does not give ids back (unused ids leave gaps).
+    The <table> rows are only read with plain consistent SELECTs: a locking read would wait for the rows inserted,
+    but not committed yet, by the import transaction that asked for the block.
+    """
+
+    def __init__(self, pool, block_size=50, auto_increment_tables=()):
+        """
+        Constructor
+        :parameter pool: type MySQLConnectionPool, pool used to borrow the connection reserving the blocks
+        :parameter block_size: type int, number of ids reserved at a time for a table
+        :parameter auto_increment_tables: type list(str), tables whose <table>_id is set by MySQL (next_id returns None)
+        """
+        self.pool = pool
+        self.block_size = max(block_size, 1)
+        self.auto_increment_tables = set(auto_increment_tables)
+        # table: [next id to hand out, first id of the next block]
+        self.blocks = {}
+        self.lock = threading.Lock()
+        with self.pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("CREATE TABLE IF NOT EXISTS id_allocation (table_name varchar(64) NOT NULL PRIMARY KEY, "
+                           "next_id int NOT NULL)")
+            connection.commit()
+
+    @classmethod
+    def from_config(cls, pool, configSettings):
+        """
+        :parameter configSettings: type dict, content of Cichlid_Population_db.json
+
+        Creates the allocator with the optional 'idBlockSize' and 'autoIncrementTables' settings
+        """
+        return cls(pool, int(configSettings.get("idBlockSize", 50)), configSettings.get("autoIncrementTables", []))
+
+    def next_id(self, table):
+        """
+        :parameter table: type str
+
+        next_id(self, table) -> int
+
+        Returns the next free <table>_id, or None if the table is auto-increment (use cursor.lastrowid after insert)
+        """
+        if table in self.auto_increment_tables:
+            return None
+        with self.lock:
+            block = self.blocks.get(table)
+            if block is None or block[0] >= block[1]:
+                start = self._reserve(table)
+                block = [start, start + self.block_size]
+                self.blocks[table] = block
+            block[0] += 1
+            return block[0] - 1
+
+    def reserve(self, table, count):
+        """
+        :parameter table: type str
+        :parameter count: type int, number of ids
+
+        reserve(self, table, count) -> int
+
+        Reserves count consecutive <table>_id (e.g. for a bulk load) and returns the first one, or None if the table is auto-increment
+        """
+        if table in self.auto_increment_tables:
+            return None
+        return self._reserve(table, max(count, 1))
+
+    def _reserve(self, table, count=None):
+        """Reserves the next count ids (a block by default) for the table and returns the first one"""
+        if count is None:
+            count = self.block_size
+        try:
+            with self.pool.connection() as connection:
+                cursor = connection.cursor()
+                # rows inserted without the allocator (older scripts, manual curation) must not be reused
+                cursor.execute("SELECT COALESCE(MAX(" + table + "_id), 0) + 1 AS next_id FROM " + table)
+                table_next_id = cursor.fetchone()['next_id']
+                cursor.execute("INSERT IGNORE INTO id_allocation (table_name, next_id) VALUES (%s, %s)",
+                               (table, table_next_id))
+                cursor.execute("SELECT next_id FROM id_allocation WHERE table_name = %s FOR UPDATE", (table,))
+                start = max(cursor.fetchone()['next_id'], table_next_id)
+                cursor.execute("UPDATE id_allocation SET next_id = %s WHERE table_name = %s",
+                               (start + count, table))
+                connection.commit()
+        except pymysql.err.Error:
+            logging.error("Could not reserve ids for table %s: %s", table, sys.exc_info()[1])
+            raise
+        logging.debug("Reserved ids " + str(start) + " to " + str(start + count - 1) + " for table " + table)
+        return start
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,90 @@
+import sys
+import logging
+import pymysql
+
+__author__ = 'hudenise'
+
+"""
+Closure table of the taxonomy lineage of the species.
+
+"""
+
+
+class LineageClosure:
+    """
+    Maintains the taxon_lineage table: one (ancestor_taxid, descendant_taxid, depth) row for every ancestor of every
+    taxon_id of the species table, depth 0 being the taxon itself. The name and rank of the ancestor are kept on the row
+    so that the individuals of a genus or tribe are found by an indexed join instead of a LIKE on the species names:
+    SELECT i.* FROM individual i JOIN species s ON s.species_id = i.species_id
+    JOIN taxon_lineage l ON l.descendant_taxid = s.taxon_id WHERE l.ancestor_name = 'Haplochromini'
+    """
+
+    def __init__(self, dataAccessObject):
+        """
+        Constructor
+        :parameter dataAccessObject: type MySQLDataAccessObject
+        """
+        self.dataAccessObject = dataAccessObject
+        self.dataAccessObject._runStatement(
+            "CREATE TABLE IF NOT EXISTS taxon_lineage (ancestor_taxid int NOT NULL, descendant_taxid int NOT NULL, "
+            "depth int NOT NULL, ancestor_name varchar(255), ancestor_rank varchar(64), "
+            "PRIMARY KEY (ancestor_taxid, descendant_taxid), KEY taxon_lineage_descendant (descendant_taxid, depth), "
+            "KEY taxon_lineage_name (ancestor_name))")
+
+    def missing_taxids(self):
+        """
+        missing_taxids(self) -> list(str)
+
+        Returns the taxon_id of the species which are not in the closure table yet
+        """
+        rows = self.dataAccessObject._runQuery(
+            "SELECT DISTINCT s.taxon_id FROM species s LEFT JOIN taxon_lineage l ON l.descendant_taxid = s.taxon_id "
+            "and l.depth = 0 WHERE s.taxon_id IS NOT NULL and s.taxon_id > 0 and l.descendant_taxid IS NULL")
+        return [str(x['taxon_id']) for x in rows]
+
+    def add_lineages(self, lineages):
+        """
+        :parameter lineages: type dict, taxid: [[taxid, name, rank], ...] from the taxid itself up to the root
+
+        add_lineages(self, lineages) -> int
+
+        Inserts the closure rows of the lineages (rows already present are kept) and returns the number of taxids added
+        """
+        rows = []
+        added = 0
+        for taxid, lineage in lineages.items():
+            if len(lineage) == 0:
+                continue
+            added += 1
+            for depth, (ancestor, name, rank) in enumerate(lineage):
+                rows.append((int(ancestor), int(taxid), depth, name, rank))
+        if len(rows) > 0:
+            try:
+                self.dataAccessObject._runInsertMany(
+                    "INSERT IGNORE INTO taxon_lineage (ancestor_taxid, descendant_taxid, depth, ancestor_name, "
+                    "ancestor_rank) values (%s, %s, %s, %s, %s)", rows)
+            except pymysql.err.Error:
+                logging.error("Could not add the lineages to taxon_lineage: %s", sys.exc_info()[1])
+                raise
+        return added
+
+    def refresh(self, getLineages):
+        """
+        :parameter getLineages: type function, taking a list of taxids and returning their lineages
+                                (e.g. Get_taxonomy_from_NCBI.getLineages)
+
+        refresh(self, getLineages) -> int
+
+        Adds the lineage of the species new to the closure table and returns the number of taxids added
+        """
+        taxids = self.missing_taxids()
+        if len(taxids) == 0:
+            return 0
+        added = self.add_lineages(getLineages(taxids))
+        logging.info("Lineage of " + str(added) + " taxids added to taxon_lineage (" + str(len(taxids) - added) +
+                     " not found)")
+        return added
+
+
+if __name__ == '__main__':
+    pass
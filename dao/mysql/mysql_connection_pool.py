@@ -0,0 +1,191 @@
+import sys
+import time
+import logging
+import threading
+import pymysql
+
+__author__ = 'hudenise'
+
+"""
+Pool of MySQL connections shared by the population and update scripts.
+
+"""
+
+
+class MySQLPoolError(Exception):
+    """Connection pool exception"""
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class MySQLConnectionPool:
+    """Pool of warm pymysql connections with a health check on borrow"""
+
+    def __init__(self, min_size=1, max_size=5, timeout=30, **connect_args):
+        """
+        Constructor
+        :parameter min_size: type int, number of connections opened straight away and kept idle
+        :parameter max_size: type int, maximum number of connections open at the same time
+        :parameter timeout: type int, seconds to wait for a free connection before raising MySQLPoolError
+        :parameter connect_args: arguments given to pymysql.connect
+        """
+        if max_size < max(min_size, 1):
+            raise MySQLPoolError("max_size (" + str(max_size) + ") must be at least min_size (" + str(min_size) + ")")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connect_args = connect_args
+        self.idle = []
+        self.in_use = set()
+        self.closed = False
+        #connections being opened, checked or rolled back outside the lock, counted against max_size
+        self.pending = 0
+        self.lock = threading.Condition()
+        for i in range(min_size):
+            self.idle.append(self._connect())
+
+    @classmethod
+    def from_config(cls, configSettings, min_size=None, max_size=None, local_infile=False):
+        """
+        :parameter configSettings: type dict, content of Cichlid_Population_db.json
+        :parameter min_size: type int, overrides the 'poolMinSize' setting
+        :parameter max_size: type int, overrides the 'poolMaxSize' setting
+        :parameter local_infile: type bool, allow LOAD DATA LOCAL INFILE on the connections
+
+        Creates the pool from the database connection details of the configuration file
+        """
+        if min_size is None:
+            min_size = int(configSettings.get("poolMinSize", 1))
+        if max_size is None:
+            max_size = int(configSettings.get("poolMaxSize", 5))
+        return cls(min_size, max_size, user=configSettings["vpUser"], password=configSettings["vpPassword"],
+                   host=configSettings["vpHost"], port=int(configSettings["vpPort"]),
+                   db=configSettings["vpInstance"], autocommit=False, local_infile=local_infile,
+                   cursorclass=pymysql.cursors.DictCursor)
+
+    def _connect(self):
+        """Opens a new connection"""
+        try:
+            return pymysql.connect(**self.connect_args)
+        except pymysql.err.OperationalError:
+            logging.error("Could not connect to the database: %s", sys.exc_info()[1])
+            raise
+
+    def _is_alive(self, connection):
+        """Pings the server, reconnecting the socket if the server closed it (e.g. after wait_timeout)"""
+        try:
+            connection.ping(reconnect=True)
+            return True
+        except pymysql.err.Error:
+            logging.info("Discarding a connection that could not be re-established")
+            return False
+
+    def borrow(self):
+        """
+        borrow(self) -> connection
+
+        Returns a healthy connection, opening a new one if none is idle and the pool is not full.
+        The lock is only held to pick a connection: the ping and the connect run outside it
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            with self.lock:
+                while True:
+                    if self.closed:
+                        raise MySQLPoolError("The connection pool is closed")
+                    if self.idle:
+                        connection = self.idle.pop()
+                        break
+                    if len(self.in_use) + self.pending < self.max_size:
+                        connection = None
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise MySQLPoolError("No database connection available after " + str(self.timeout) + "s")
+                    self.lock.wait(remaining)
+                self.pending += 1
+            try:
+                if connection is None:
+                    connection = self._connect()
+                elif not self._is_alive(connection):
+                    self._close(connection)
+                    connection = None
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                    if connection is not None:
+                        self.in_use.add(connection)
+                    else:
+                        self.lock.notify()
+            if connection is not None:
+                return connection
+
+    def release(self, connection):
+        """
+        :parameter connection: connection obtained from borrow
+
+        Gives the connection back to the pool. Uncommitted changes are rolled back.
+        """
+        with self.lock:
+            if connection not in self.in_use:
+                return
+            self.in_use.discard(connection)
+            #counted against max_size until it is idle again
+            self.pending += 1
+        #the rollback is a round trip to the server so it runs outside the lock, as the ping and connect of borrow
+        try:
+            connection.rollback()
+        except pymysql.err.Error:
+            logging.info("Closing a connection that failed on release")
+            self._close(connection)
+            connection = None
+        with self.lock:
+            self.pending -= 1
+            if connection is not None:
+                if self.closed:
+                    self._close(connection)
+                else:
+                    self.idle.append(connection)
+            self.lock.notify()
+
+    def connection(self):
+        """
+        with pool.connection() as connection: ...
+
+        Context manager borrowing a connection and releasing it at the end of the block
+        """
+        return _PooledConnection(self)
+
+    def close(self):
+        """Closes the idle connections. Borrowed connections are closed when they are released"""
+        with self.lock:
+            self.closed = True
+            while self.idle:
+                self._close(self.idle.pop())
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except pymysql.err.Error:
+            pass
+
+
+class _PooledConnection:
+    """Context manager returned by MySQLConnectionPool.connection"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.connection = None
+
+    def __enter__(self):
+        self.connection = self.pool.borrow()
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.pool.release(self.connection)
+        return False
+
+
+if __name__ == '__main__':
+    pass
@@ -1,6 +1,14 @@
 import sys
+import time
+import array
 import pymysql
 import logging
+from pymysql.constants import FIELD_TYPE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __author__ = 'Maxim Scheremetjew, EMBL-EBI'
 __author__ = 'Simon Potter, EMBL-EBI'
@@ -11,6 +19,61 @@ Created on 07/12/2015
 """
 
 
+# array.array typecode of the numeric MySQL column types (other types are returned as lists)
+COLUMN_TYPECODES = {FIELD_TYPE.TINY: 'q', FIELD_TYPE.SHORT: 'q', FIELD_TYPE.LONG: 'q', FIELD_TYPE.LONGLONG: 'q',
+                    FIELD_TYPE.INT24: 'q', FIELD_TYPE.YEAR: 'q', FIELD_TYPE.FLOAT: 'd', FIELD_TYPE.DOUBLE: 'd',
+                    FIELD_TYPE.DECIMAL: 'd', FIELD_TYPE.NEWDECIMAL: 'd'}
+
+
+class CompactRow:
+    """
+    Read-only row of a query result: the values are kept in a tuple and the column names in a
+    layout (column: position) shared by all the rows of the result, instead of one dict per row.
+    Supports the dict read access used by the scripts (row['name'], get, keys, items, in, dict(row))
+    """
+    __slots__ = ('_layout', '_values')
+
+    def __init__(self, layout, values):
+        self._layout = layout
+        self._values = values
+
+    def __getitem__(self, column):
+        return self._values[self._layout[column]]
+
+    def get(self, column, default=None):
+        if column in self._layout:
+            return self._values[self._layout[column]]
+        return default
+
+    def keys(self):
+        return self._layout.keys()
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return list(zip(self._layout, self._values))
+
+    def __contains__(self, column):
+        return column in self._layout
+
+    def __iter__(self):
+        return iter(self._layout)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, CompactRow):
+            return self.items() == other.items()
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
 class MySQLDataAccessObject:
     """Database access object"""
 
@@ -19,103 +82,274 @@ class MySQLDataAccessObject:
         Constructor
         """
         self.dbConnection = dbConnection
+        self.dbCursor = None
+
+    def useConnection(self, dbConnection):
+        """
+        :parameter dbConnection: type pymysql connection, e.g. a connection borrowed from the pool for one unit of work
 
-    def _runQuery(self, query):
-        """Runs the query"""
-        cursor = self.dbConnection.cursor()
-        cursor.execute(query)
+        Runs the following queries on dbConnection (the cursor is recreated on the next query)
+        """
+        self.dbConnection = dbConnection
+
+    def _getCursor(self):
+        """Returns the cursor of the connection, creating it on first use (one cursor is reused per connection)"""
+        if self.dbCursor is None or self.dbCursor.connection is not self.dbConnection:
+            self.dbCursor = self.dbConnection.cursor()
+        return self.dbCursor
+
+    def _runQuery(self, query, compact=False, data=None):
+        """
+        :parameter query: type str
+        :parameter compact: type bool, return the rows as CompactRow instead of dict
+        :parameter data: type tuple, values bound to the %s placeholders of the query (None if the query has none)
+
+        Runs the query
+        """
+        if compact:
+            return self._runCompactQuery(query, data)
+        cursor = self._getCursor()
+        cursor.execute(query, data)
         results = []
         result = cursor.fetchone()
+        if result is not None:
+            # column names are the same for every row so only read them once
+            keys = [column[0] for column in cursor.description]
         while result is not None:
-            numCols = len(result)
             item = {}
-            for col in range(0, numCols):
-                key = cursor.description[col][0]
-                value = None
-                if hasattr(result[key], 'read'):
-                    # handle oracle clob datatypes
-                    try:
-                        value = result[key].read()
-                    except AttributeError as e:
-                        if hasattr(e, 'reason'):
-                            logging.error(e.reason, sys.exc_info()[0])
-                        elif hasattr(e, 'code'):
-                            logging.error('Error code: ', e.code)
-                        raise
-                    except:
-                        logging.error("Unexpected error:", sys.exc_info()[0])
-                        raise
-                else:
-                    value = result[key]
-                item[key] = value
-                # item = {cursor.description[col][0]: result[col] for col in range(0, numCols)}
+            for key in keys:
+                item[key] = self._readValue(result[key])
             results.append(item)
             result = cursor.fetchone()
         return results
 
-    def _runInsert(self, table, columns, rows):
+    def _runCompactQuery(self, query, data=None):
+        """Runs the query on a tuple cursor and returns the rows as CompactRow sharing one column layout"""
+        cursor = self.dbConnection.cursor(pymysql.cursors.Cursor)
         try:
-            """Runs the given insert statement"""
-            logging.debug("Running insert statement for table " + table)
-            cursor = self.dbConnection.cursor()
-            sql = "INSERT INTO " + table + " (" + ",".join(columns) + ") values (" + ("%s," * len(columns))[:-1] + ")"
-            for row in rows:
-                for i in range(len(row)):
-                    if row[i] == 'null':
-                        row[i] = None
-                cursor.execute(sql, row)
+            cursor.execute(query, data)
+            if cursor.description is None:
+                return []
+            layout = {column[0]: i for i, column in enumerate(cursor.description)}
+            return [CompactRow(layout, tuple([self._readValue(x) for x in row])) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def _iterQuery(self, query, fetch_size=1000, compact=False):
+        """
+        :parameter query: type str
+        :parameter fetch_size: type int, number of rows read from the socket at a time
+        :parameter compact: type bool, yield the rows as CompactRow instead of dict
+
+        iterQuery(self, query, fetch_size, compact) -> generator(dict)
+
+        Runs the query on an unbuffered server-side cursor and yields the rows one at a time,
+        so memory use does not depend on the size of the result.
+        Note: no other statement can be run on the connection until the generator is exhausted or closed
+        """
+        cursor = self.dbConnection.cursor(pymysql.cursors.SSCursor)
+        try:
+            cursor.execute(query)
+            if cursor.description is None:
+                return
+            keys = [column[0] for column in cursor.description]
+            layout = {keys[col]: col for col in range(len(keys))}
+            rows = cursor.fetchmany(fetch_size)
+            while rows:
+                for row in rows:
+                    if compact:
+                        yield CompactRow(layout, tuple([self._readValue(x) for x in row]))
+                    else:
+                        yield {keys[col]: self._readValue(row[col]) for col in range(len(keys))}
+                rows = cursor.fetchmany(fetch_size)
+        finally:
+            cursor.close()
+
+    def _runColumnarQuery(self, query, fetch_size=1000):
+        """
+        :parameter query: type str
+        :parameter fetch_size: type int, number of rows read from the socket at a time
+
+        runColumnarQuery(self, query, fetch_size) -> dict
+
+        Runs the query on an unbuffered cursor and returns the result by column (column: values) instead of by row.
+        Integer columns are filled into array.array('q') and decimal/float columns into array.array('d'),
+        NULL being stored as nan (an integer column with NULL becomes 'd'). Other columns are lists.
+        If numpy is installed, the arrays are returned as numpy arrays
+        """
+        cursor = self.dbConnection.cursor(pymysql.cursors.SSCursor)
+        try:
+            cursor.execute(query)
+            if cursor.description is None:
+                return {}
+            names = [column[0] for column in cursor.description]
+            columns = []
+            for column in cursor.description:
+                if column[1] in COLUMN_TYPECODES:
+                    columns.append(array.array(COLUMN_TYPECODES[column[1]]))
+                else:
+                    columns.append([])
+            rows = cursor.fetchmany(fetch_size)
+            while rows:
+                for col in range(len(names)):
+                    values = [row[col] for row in rows]
+                    if isinstance(columns[col], array.array):
+                        if None in values:
+                            if columns[col].typecode == 'q':
+                                columns[col] = array.array('d', columns[col])
+                            values = [float('nan') if x is None else x for x in values]
+                        if columns[col].typecode == 'd':
+                            values = [float(x) for x in values]
+                        columns[col].extend(values)
+                    else:
+                        columns[col].extend([self._readValue(x) for x in values])
+                rows = cursor.fetchmany(fetch_size)
+        finally:
+            cursor.close()
+        if numpy is not None:
+            columns = [numpy.frombuffer(x, dtype=x.typecode) if isinstance(x, array.array) else numpy.array(x, dtype=object)
+                       for x in columns]
+        return dict(zip(names, columns))
+
+    def _readValue(self, value):
+        """Returns the value of a column, reading it first if it is a clob"""
+        if hasattr(value, 'read'):
+            # handle oracle clob datatypes
+            try:
+                return value.read()
+            except AttributeError as e:
+                if hasattr(e, 'reason'):
+                    logging.error(e.reason, sys.exc_info()[0])
+                elif hasattr(e, 'code'):
+                    logging.error('Error code: ', e.code)
+                raise
+            except:
+                logging.error("Unexpected error:", sys.exc_info()[0])
+                raise
+        return value
+
+    def _runInsert(self, table, columns, rows, batch_size=1000):
+        """
+        :parameter table: type str
+        :parameter columns: type list(str)
+        :parameter rows: type list(list)
+        :parameter batch_size: type int, number of rows sent per executemany call
+
+        runInsert(self, table, columns, rows, batch_size) -> int
+
+        Runs the given insert statement in batches and returns the number of rows inserted
+        """
+        logging.debug("Running insert statement for table " + table)
+        sql = "INSERT INTO " + table + " (" + ",".join(columns) + ") values (" + ("%s," * len(columns))[:-1] + ")"
+        for row in rows:
+            for i in range(len(row)):
+                if row[i] == 'null':
+                    row[i] = None
+        start = time.time()
+        self._runInsertMany(sql, rows, batch_size)
+        elapsed = time.time() - start
+        if elapsed > 0:
+            logging.info("Inserted " + str(len(rows)) + " rows into table " + table + " (" +
+                         str(int(len(rows) / elapsed)) + " rows/s)")
+        return len(rows)
+
+    def _runInsertMany(self, insert_stmt, rows, batch_size=1000):
+        """
+        :parameter insert_stmt: type str, parameterized insert statement
+        :parameter rows: type list(list), one list of values per row
+        :parameter batch_size: type int, number of rows sent per executemany call
+
+        Runs the given insert statement for all the rows (pymysql rewrites each batch into one multi-row INSERT)
+        """
+        try:
+            cursor = self._getCursor()
+            step = max(batch_size, 1)
+            for i in range(0, len(rows), step):
+                cursor.executemany(insert_stmt, rows[i:i + step])
         except UnicodeEncodeError as unicode_error:
-            logging.error("Encoding error: ", unicode_error.reason, sys.exc_info()[0])
+            logging.error("Encoding error: %s %s", unicode_error.reason, sys.exc_info()[0])
             raise
-        except pymysql.err.IntegrityError as e:
-            logging.error("MySQL integrity error. An entry with that primary key constraint does already exist.", \
-                          sys.exc_info()[0])
+        except pymysql.err.IntegrityError:
+            logging.error("MySQL integrity error. An entry with that primary key constraint does already exist: %s",
+                          sys.exc_info()[1])
             raise
         except:
-            logging.error("Unexpected error: ", sys.exc_info()[0])
+            logging.error("Unexpected error: %s", sys.exc_info()[0])
             raise
 
     def _runUpdate(self, table, rows):
         """
         :parameter table: type str
-        :parameter rows: type list(list)
+        :parameter rows: type list(list), [column name, value, sample_id] for each value to update
 
         runUpdate(self, table, columns, rows) -> None
 
-        Runs the given insert statement
+        Runs the given updates, grouped in multi-row update statements
+        """
+        logging.debug("Running update statements for table " + table)
+        updates = []
+        for row in rows:
+            value = None if row[1] == 'null' else row[1]
+            updates.append((row[2], row[0], value))
+        self._runUpdateMany(table, "sample_id", updates)
+
+    def _runUpdateMany(self, table, key_column, updates, batch_size=1000):
         """
+        :parameter table: type str
+        :parameter key_column: type str, column identifying the rows to update (e.g. row_id or <table>_id)
+        :parameter updates: type list(tuple), (key, column, value) triples
+        :parameter batch_size: type int, number of triples sent per statement
+
+        runUpdateMany(self, table, key_column, updates, batch_size) -> int
+
+        Applies the updates with one statement per batch, each column being set with a CASE on the key:
+        UPDATE table SET col = CASE key_column WHEN key THEN value ... ELSE col END WHERE key_column IN (keys)
+        Returns the number of rows changed
+        """
+        changed = 0
+        step = max(batch_size, 1)
         try:
-            logging.debug("Running update statements for table " + table)
-            cursor = self.dbConnection.cursor()
-            for row in rows:
-                column_name = row[0]
-                sql = "UPDATE " + table + " SET " + column_name + " = %s where sample_id = %s"
-                for i in range(len(row)):
-                    if row[i] == 'null':
-                        row[i] = None
-                # Remove column name from the list (which is the first element)
-                row.pop(0)
-                cursor.execute(sql, row)
+            cursor = self._getCursor()
+            for i in range(0, len(updates), step):
+                # column: {key: value}, a later value for the same key and column replaces the earlier one
+                columns = {}
+                keys = {}
+                for key, column, value in updates[i:i + step]:
+                    columns.setdefault(column, {})[key] = value
+                    keys[key] = None
+                set_clauses = []
+                data = []
+                for column, values in columns.items():
+                    set_clauses.append(column + " = CASE " + key_column + " " + "WHEN %s THEN %s " * len(values) +
+                                       "ELSE " + column + " END")
+                    for key, value in values.items():
+                        data.extend((key, value))
+                data.extend(keys)
+                sql = "UPDATE " + table + " SET " + ", ".join(set_clauses) + " WHERE " + key_column + " IN (" + \
+                      ", ".join(["%s"] * len(keys)) + ")"
+                changed += cursor.execute(sql, data)
         except UnicodeEncodeError as unicode_error:
-            logging.error("Encoding error: ", unicode_error.reason, sys.exc_info()[0])
+            logging.error("Encoding error: %s %s", unicode_error.reason, sys.exc_info()[0])
             raise
-        except pymysql.err.IntegrityError as e:
-            logging.error("MySQL integrity error. An entry with that primary key constraint does already exist.", \
-                          sys.exc_info()[0])
+        except pymysql.err.IntegrityError:
+            logging.error("MySQL integrity error. An entry with that primary key constraint does already exist: %s",
+                          sys.exc_info()[1])
             raise
         except:
-            logging.error("Unexpected error: ", sys.exc_info()[0])
+            logging.error("Unexpected error: %s", sys.exc_info()[0])
             raise
+        return changed
 
     def _runInsertStatement(self, insert_stmt, data=None):
         try:
             """Runs the given insert statement"""
             logging.debug("Running the following insert statement: " + insert_stmt)
-            cursor = self.dbConnection.cursor()
+            cursor = self._getCursor()
             if data:
                 cursor.execute(insert_stmt, data)
             else:
                 cursor.execute(insert_stmt)
+            return cursor.lastrowid
         except UnicodeEncodeError as unicode_error:
             logging.error("Encoding error: ", unicode_error.reason, sys.exc_info()[0])
             raise
@@ -127,6 +361,50 @@ class MySQLDataAccessObject:
             logging.error("Unexpected error: ", sys.exc_info()[0])
             raise
 
+    def _runStatement(self, stmt, data=None):
+        """
+        :parameter stmt: type str, statement with %s placeholders
+        :parameter data: type tuple, values bound to the placeholders
+
+        runStatement(self, stmt, data) -> int
+
+        Runs the given update or delete statement and returns the number of rows affected
+        """
+        try:
+            logging.debug("Running the following statement: " + stmt)
+            cursor = self._getCursor()
+            return cursor.execute(stmt, data)
+        except UnicodeEncodeError as unicode_error:
+            logging.error("Encoding error: %s %s", unicode_error.reason, sys.exc_info()[0])
+            raise
+        except:
+            logging.error("Unexpected error: %s", sys.exc_info()[0])
+            raise
+
+    def _runLoadData(self, table, file_path, columns):
+        """
+        :parameter table: type str
+        :parameter file_path: type str, tab separated file on the client with one header line
+        :parameter columns: type list(str), columns of the table in the order of the file
+
+        runLoadData(self, table, file_path, columns) -> int
+
+        Loads the file into the table with LOAD DATA LOCAL INFILE and returns the number of rows loaded
+        """
+        try:
+            logging.debug("Loading " + file_path + " into table " + table)
+            cursor = self._getCursor()
+            return cursor.execute("LOAD DATA LOCAL INFILE %s INTO TABLE " + table + " CHARACTER SET utf8mb4 " +
+                                  "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' IGNORE 1 LINES (" +
+                                  ", ".join(columns) + ")", (file_path,))
+        except pymysql.err.OperationalError:
+            logging.error("Could not load " + file_path + " (is local_infile enabled on the client and the server?): %s",
+                          sys.exc_info()[1])
+            raise
+        except:
+            logging.error("Unexpected error: %s", sys.exc_info()[0])
+            raise
+
 
 if __name__ == '__main__':
     pass